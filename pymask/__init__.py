@@ -5,6 +5,7 @@ from .madpoint import *
 from .madxp import *
 from .pymasktools import *
 from .lumi import *
+from .fillingscheme import *
 from .coupling import *
 from .tunechroma import *
 
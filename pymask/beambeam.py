@@ -1,10 +1,19 @@
 import copy
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
 
 import pandas as pd
 import numpy as np
 from scipy.special import erf, erfinv
+from scipy.constants import e as qe, epsilon_0, m_p, c as clight
 
-from .madpoint import MadPoint
+from .madpoint import MadPoint, MadPointArray, _rotation_matrices
+from .madxp import get_table_rows, FrozenTable, FrozenTables, Madxp, run_seqedit
 
 _sigma_names = [11, 12, 13, 14, 22, 23, 24, 33, 34, 44]
 _beta_names = ["betx", "bety"]
@@ -51,51 +60,164 @@ def get_elements(seq, ele_type=None, slot_id=None):
 
 
 def get_points_twissdata_for_elements(
-    ele_names, mad, seq_name, use_survey=True, use_twiss=True
+    ele_names, mad, seq_name, use_survey=True, use_twiss=True,
+    skip_mad_use=False
 ):
 
-    mad.use(sequence=seq_name)
+    if not skip_mad_use:
+        mad.use(sequence=seq_name)
 
-    mad.twiss()
+        mad.twiss()
 
-    if use_survey:
-        mad.survey()
+        if use_survey:
+            mad.survey()
 
-    bb_xyz_points = []
-    bb_twissdata = {
-        kk: []
-        for kk in _sigma_names
-        + _beta_names
-        + "dispersion_x dispersion_y x y".split()
-    }
-    for eename in ele_names:
-        bb_xyz_points.append(
-            MadPoint(
-                eename + ":1", mad, use_twiss=use_twiss, use_survey=use_survey
-            )
-        )
+    mad_names = [eename + ":1" for eename in ele_names]
+    bb_xyz_points = MadPointArray(
+        mad_names, mad, use_twiss=use_twiss, use_survey=use_survey
+    )
 
-        i_twiss = np.where(mad.table.twiss.name == (eename + ":1"))[0][0]
+    twiss = mad.table.twiss
+    i_twiss = get_table_rows(mad, 'twiss', mad_names)
 
-        for sn in _sigma_names:
-            bb_twissdata[sn].append(
-                getattr(mad.table.twiss, "sig%d" % sn)[i_twiss]
-            )
+    bb_twissdata = {}
+    for sn in _sigma_names:
+        bb_twissdata[sn] = getattr(twiss, "sig%d" % sn)[i_twiss]
 
-        for kk in ["betx", "bety"]:
-            bb_twissdata[kk].append(mad.table.twiss[kk][i_twiss])
-        gamma = mad.table.twiss.summary.gamma
-        beta = np.sqrt(1.0 - 1.0 / (gamma * gamma))
-        for pp in ["x", "y"]:
-            bb_twissdata["dispersion_" + pp].append(
-                mad.table.twiss["d" + pp][i_twiss] * beta
-            )
-            bb_twissdata[pp].append(mad.table.twiss[pp][i_twiss])
-        # , 'dx', 'dy']:
+    for kk in ["betx", "bety"]:
+        bb_twissdata[kk] = twiss[kk][i_twiss]
+    gamma = twiss.summary.gamma
+    beta = np.sqrt(1.0 - 1.0 / (gamma * gamma))
+    for pp in ["x", "y"]:
+        bb_twissdata["dispersion_" + pp] = twiss["d" + pp][i_twiss] * beta
+        bb_twissdata[pp] = twiss[pp][i_twiss]
 
     return bb_xyz_points, bb_twissdata
 
 
+class EncounterInThickElementError(ValueError):
+    '''
+    Raised when an encounter cannot be reached by a drift from the previous
+    element of a table, as it falls inside a thick element.
+    '''
+
+def _rows_and_drift_lengths(table, s_positions):
+    '''
+    For each s position, find the last table row located before it and the
+    length of the drift between the two. EncounterInThickElementError is
+    raised if a position falls inside a thick element.
+    '''
+    s_table = table.s
+    s_positions = np.mod(np.asarray(s_positions, dtype=float), s_table[-1])
+
+    rows = np.searchsorted(s_table, s_positions, side='right') - 1
+    drift_lengths = s_positions - s_table[rows]
+
+    next_rows = np.minimum(rows + 1, len(s_table) - 1)
+    inside_element = ((s_positions > s_table[next_rows] - table.l[next_rows])
+            & (table.l[next_rows] > 0)
+            & (table.keyword[next_rows] != 'drift'))
+    if np.any(inside_element):
+        raise EncounterInThickElementError('Encounters inside thick elements: '
+                f'{list(table.name[next_rows[inside_element]])}')
+
+    return rows, drift_lengths
+
+def _propagate_sigma_in_drift(sigmas, drift_lengths):
+    '''
+    Sigma matrix (4x4 transverse block) transported through drifts.
+    sigmas is a dictionary with keys in _sigma_names.
+    '''
+    n_points = len(drift_lengths)
+    sigma_matrix = np.zeros((n_points, 4, 4))
+    for ss in _sigma_names:
+        ii, jj = [int(cc) - 1 for cc in str(ss)]
+        sigma_matrix[:, ii, jj] = sigmas[ss]
+        sigma_matrix[:, jj, ii] = sigmas[ss]
+
+    drift_matrix = np.tile(np.eye(4), (n_points, 1, 1))
+    drift_matrix[:, 0, 1] = drift_lengths
+    drift_matrix[:, 2, 3] = drift_lengths
+
+    sigma_matrix = np.matmul(drift_matrix,
+            np.matmul(sigma_matrix, drift_matrix.transpose(0, 2, 1)))
+
+    return {ss: sigma_matrix[:, int(str(ss)[0]) - 1, int(str(ss)[1]) - 1]
+            for ss in _sigma_names}
+
+def get_points_twissdata_at_s(mad, seq_name, names, s_positions,
+        skip_mad_use=False):
+    '''
+    Same output as get_points_twissdata_for_elements for points that are not
+    elements of the sequence. Orbit, optics and survey frame are obtained
+    from the closest upstream element propagating through the drift.
+
+    Args:
+        mad: the MAD-X handle
+        seq_name: name of the sequence
+        names: names to be given to the points
+        s_positions: s positions of the points in the sequence
+        skip_mad_use: if True the tables present in MAD-X are used
+    Returns:
+        A MadPointArray and the dictionary of the twiss data (as for
+        get_points_twissdata_for_elements).
+    '''
+
+    if not skip_mad_use:
+        mad.use(sequence=seq_name)
+        mad.twiss()
+        mad.survey()
+
+    twiss = mad.table.twiss
+    survey = mad.table.survey
+
+    i_tw, l_tw = _rows_and_drift_lengths(twiss, s_positions)
+    i_sv, l_sv = _rows_and_drift_lengths(survey, s_positions)
+
+    # Closed orbit
+    tpx = twiss.px[i_tw]
+    tpy = twiss.py[i_tw]
+    tx = twiss.x[i_tw] + l_tw * tpx
+    ty = twiss.y[i_tw] + l_tw * tpy
+
+    # Survey (straight line along the local ez)
+    wm = _rotation_matrices(survey.theta[i_sv], survey.phi[i_sv],
+            survey.psi[i_sv])
+    ez = wm[:, :, 2]
+    sp = (np.array([survey.x[i_sv], survey.y[i_sv], survey.z[i_sv]]).T
+            + ez * l_sv[:, None])
+
+    points = MadPointArray.from_arrays(
+            names, tx=tx, ty=ty, tpx=tpx, tpy=tpy, sp=sp,
+            ex=wm[:, :, 0], ey=wm[:, :, 1], ez=ez)
+
+    twissdata = _propagate_sigma_in_drift(
+            {sn: getattr(twiss, "sig%d" % sn)[i_tw] for sn in _sigma_names},
+            l_tw)
+    for pp in ["x", "y"]:
+        bet = twiss["bet" + pp][i_tw]
+        alf = twiss["alf" + pp][i_tw]
+        twissdata["bet" + pp] = (bet - 2 * alf * l_tw
+                + (1 + alf ** 2) / bet * l_tw ** 2)
+    gamma = twiss.summary.gamma
+    beta = np.sqrt(1.0 - 1.0 / (gamma * gamma))
+    for pp in ["x", "y"]:
+        twissdata["dispersion_" + pp] = (twiss["d" + pp][i_tw]
+                + l_tw * twiss["dp" + pp][i_tw]) * beta
+    twissdata["x"] = tx
+    twissdata["y"] = ty
+
+    return points, twissdata
+
+def get_encounter_s_positions(mad, bb_df):
+    '''
+    Position in the sequence of the bb encounters (where the dummy lenses
+    would be installed, i.e. atPosition from the ip) from the twiss table.
+    '''
+    i_ips = get_table_rows(mad, 'twiss', bb_df['ip_name'] + ':1')
+    return mad.table.twiss.s[i_ips] + bb_df['atPosition'].values
+
+
 def get_bb_names_madpoints_sigmas(
     mad, seq_name, use_survey=True, use_twiss=True
 ):
@@ -117,6 +239,15 @@ def get_bb_names_madpoints_sigmas(
 
 # %% From https://github.com/giadarol/WeakStrong/blob/master/slicing.py
 def constant_charge_slicing_gaussian(N_part_tot, sigmaz, N_slices):
+    # Slicing with unit intensity memoized, copies are returned
+    z_centroids, z_cuts, N_part_per_slice = _unit_charge_slicing_gaussian(
+            float(sigmaz), int(N_slices))
+    return (z_centroids.copy(), copy.copy(z_cuts),
+            N_part_per_slice * N_part_tot)
+
+@functools.lru_cache(maxsize=None)
+def _unit_charge_slicing_gaussian(sigmaz, N_slices):
+    N_part_tot = 1.
     if N_slices>1:
         # working with intensity 1. and rescling at the end
         Qi = (np.arange(N_slices)/float(N_slices))[1:]
@@ -152,6 +283,56 @@ def constant_charge_slicing_gaussian(N_part_tot, sigmaz, N_slices):
 
     return z_centroids, z_cuts, N_part_per_slice
 
+def get_piwinski_angle(half_crossing_angle, sigma_z, sigma_x):
+    return half_crossing_angle * sigma_z / sigma_x
+
+def get_ho_slices_from_piwinski_angle(piwinski_angle, accuracy=0.5,
+        max_slices=None):
+    '''
+    Odd number of head-on slices such that the transverse offset between
+    the collision points of neighbouring slices, in units of the transverse
+    beam size, is about accuracy (one slice for small Piwinski angles).
+    The number of slices is limited to the largest odd number not above
+    max_slices.
+    '''
+    n_slices = 2 * int(np.floor(piwinski_angle / accuracy + 0.5)) + 1
+    if max_slices is not None:
+        if max_slices < 1:
+            raise ValueError('max_slices must be at least 1')
+        n_slices = min(n_slices, max_slices - (1 - max_slices % 2))
+    return n_slices
+
+def get_auto_ho_slices(geometry, ip_names, sigt, accuracy=0.5,
+        max_slices=None):
+    '''
+    Number of head-on slices per IP from the Piwinski angle, with the
+    crossing angle and beam size at the IP taken from the twiss tables of
+    the two beams (geometry is a GeometrySnapshot).
+
+    Returns:
+        A dictionary ip_name -> number of slices.
+    '''
+    twiss = {beam: geometry['lhc'+beam].table.twiss for beam in ['b1', 'b2']}
+    i_ips = {beam: get_table_rows(geometry['lhc'+beam], 'twiss',
+                                  [ip_nn + ':1' for ip_nn in ip_names])
+             for beam in ['b1', 'b2']}
+
+    n_slices = {}
+    for ii, ip_nn in enumerate(ip_names):
+        dp = {pp: twiss['b1'][pp][i_ips['b1'][ii]]
+                  - twiss['b2'][pp][i_ips['b2'][ii]] for pp in ['px', 'py']}
+        # Crossing plane from the largest angle difference
+        if abs(dp['px']) >= abs(dp['py']):
+            half_crossing_angle = abs(dp['px']) / 2.
+            sigma_x = np.sqrt(twiss['b1']['sig11'][i_ips['b1'][ii]])
+        else:
+            half_crossing_angle = abs(dp['py']) / 2.
+            sigma_x = np.sqrt(twiss['b1']['sig33'][i_ips['b1'][ii]])
+        n_slices[ip_nn] = get_ho_slices_from_piwinski_angle(
+                get_piwinski_angle(half_crossing_angle, sigt, sigma_x),
+                accuracy=accuracy, max_slices=max_slices)
+    return n_slices
+
 
 # %% define elementDefinition function
 import numpy as np
@@ -175,6 +356,33 @@ def elementInstallation(element_name, element_class, atPosition, fromLocation=No
     else:
         return f'install, element={element_name}, class={element_class}, at={atPosition}, from={fromLocation};'
 
+# %% Vectorized versions (same text as the scalar functions above)
+def _as_str(values):
+    # Same formatting as f'{value}', one object array of python strings
+    return np.asarray(values).astype(str).astype(object)
+
+def _element_names(label, IRNumber, beam, identifier):
+    identifier = np.asarray(identifier)
+    sideTag = np.where(identifier > 0, '.r',
+            np.where(identifier < 0, '.l', '.c')).astype(object)
+    return (_as_str(label) + sideTag + _as_str(IRNumber) + _as_str(beam)
+            + '_' + np.char.zfill(np.abs(identifier).astype(str), 2).astype(object))
+
+def _element_definitions(elementName, elementClass, elementAttributes):
+    return (_as_str(elementName) + ' : ' + _as_str(elementClass) + ', '
+            + _as_str(elementAttributes) + ';')
+
+def _element_installations(element_name, element_class, atPosition,
+        fromLocation=None):
+    installation = ('install, element=' + _as_str(element_name)
+            + ', class=' + _as_str(element_class)
+            + ', at=' + _as_str(atPosition))
+    if fromLocation is None:
+        return installation + ';'
+    fromLocation = np.asarray(fromLocation, dtype=object)
+    return np.where(pd.isnull(fromLocation), installation + ';',
+            installation + ', from=' + _as_str(fromLocation) + ';')
+
 
 def generate_set_of_bb_encounters_1beam(
     circumference=26658.8832,
@@ -205,9 +413,11 @@ def generate_set_of_bb_encounters_1beam(
         myBBLR['self_num_particles'] = bunch_num_particles
         myBBLR['self_particle_charge'] = bunch_particle_charge
         myBBLR['self_relativistic_beta'] = relativistic_beta
-        myBBLR['elementName']=myBBLR.apply(lambda x: elementName(x.label, x.ip_name.replace('ip', ''), x.beam, x.identifier), axis=1)
-        myBBLR['other_elementName']=myBBLR.apply(
-                lambda x: elementName(x.label, x.ip_name.replace('ip', ''), x.other_beam, x.identifier), axis=1)
+        IRNumber = np.char.replace(_as_str(myBBLR['ip_name']).astype(str), 'ip', '')
+        myBBLR['elementName'] = _element_names(
+                myBBLR['label'], IRNumber, myBBLR['beam'], myBBLR['identifier'])
+        myBBLR['other_elementName'] = _element_names(
+                myBBLR['label'], IRNumber, myBBLR['other_beam'], myBBLR['identifier'])
         # where circ is used
         BBSpacing = circumference / harmonic_number * bunch_spacing_buckets / 2.
         myBBLR['atPosition']=BBSpacing*myBBLR['identifier']
@@ -217,29 +427,42 @@ def generate_set_of_bb_encounters_1beam(
         myBBLR = pd.DataFrame()
 
     # Head-On
-    numberOfSliceOnSide=int((numberOfHOSlices-1)/2)
+    # numberOfHOSlices can be given per IP (list or dictionary)
+    if isinstance(numberOfHOSlices, dict):
+        ho_slices = [numberOfHOSlices[ip_nn] for ip_nn in ip_names]
+    elif np.isscalar(numberOfHOSlices):
+        ho_slices = [numberOfHOSlices] * len(ip_names)
+    else:
+        ho_slices = list(numberOfHOSlices)
     # to check: sigz of the luminous region
     # where sigt is used
     sigzLumi=sigt/2
-    z_centroids, z_cuts, N_part_per_slice = constant_charge_slicing_gaussian(1,sigzLumi,numberOfHOSlices)
     myBBHOlist=[]
 
-    for ip_nn in ip_names:
-        for identifier in (list(range(-numberOfSliceOnSide,0))+[0]+list(range(1,numberOfSliceOnSide+1))):
-            myBBHOlist.append({'label':'bb_ho', 'ip_name':ip_nn, 'other_beam':other_beam_name, 'beam':beam_name, 'identifier':identifier})
+    for ip_nn, n_slices_ip in zip(ip_names, ho_slices):
+        numberOfSliceOnSide=int((n_slices_ip-1)/2)
+        z_centroids, z_cuts, N_part_per_slice = constant_charge_slicing_gaussian(1,sigzLumi,n_slices_ip)
+        for identifier, z_centroid in zip(
+                (list(range(-numberOfSliceOnSide,0))+[0]+list(range(1,numberOfSliceOnSide+1))),
+                z_centroids):
+            myBBHOlist.append({'label':'bb_ho', 'ip_name':ip_nn, 'other_beam':other_beam_name, 'beam':beam_name, 'identifier':identifier,
+                'self_num_particles': bunch_num_particles/n_slices_ip,
+                'atPosition': z_centroid})
 
     myBBHO=pd.DataFrame(myBBHOlist)[['beam','other_beam', 'ip_name','label','identifier']]
 
 
-    myBBHO['self_num_particles'] = bunch_num_particles/numberOfHOSlices
+    myBBHO['self_num_particles'] = [ee['self_num_particles'] for ee in myBBHOlist]
     myBBHO['self_particle_charge'] = bunch_particle_charge
     myBBHO['self_relativistic_beta'] = relativistic_beta
-    for ip_nn in ip_names:
-        myBBHO.loc[myBBHO['ip_name']==ip_nn, 'atPosition']=list(z_centroids)
+    myBBHO['atPosition'] = [ee['atPosition'] for ee in myBBHOlist]
     myBBHO['s_crab'] = myBBHO['atPosition']
 
-    myBBHO['elementName']=myBBHO.apply(lambda x: elementName(x.label, x.ip_name.replace('ip', ''), x.beam, x.identifier), axis=1)
-    myBBHO['other_elementName']=myBBHO.apply(lambda x: elementName(x.label, x.ip_name.replace('ip', ''), x.other_beam, x.identifier), axis=1)
+    IRNumber = np.char.replace(_as_str(myBBHO['ip_name']).astype(str), 'ip', '')
+    myBBHO['elementName'] = _element_names(
+            myBBHO['label'], IRNumber, myBBHO['beam'], myBBHO['identifier'])
+    myBBHO['other_elementName'] = _element_names(
+            myBBHO['label'], IRNumber, myBBHO['other_beam'], myBBHO['identifier'])
     # assuming a sequence rotated in IR3
 
     myBB=pd.concat([myBBHO, myBBLR],sort=False)
@@ -252,98 +475,111 @@ def generate_set_of_bb_encounters_1beam(
 
     return myBB
 
-def generate_mad_bb_info(bb_df, mode='dummy', madx_reference_bunch_num_particles=1):
+_bb_slot_ids = {'bb_lr': 4, 'bb_ho': 6} # need to add 60 for central
+
+def generate_mad_bb_info(bb_df, mode='dummy', madx_reference_bunch_num_particles=1,
+        sequence_name=None):
+    '''
+    Generate the MAD-X definition and installation strings of the bb lenses
+    (columns elementDefinition and elementInstallation of bb_df).
+
+    If sequence_name is given, the full MAD-X input installing the lenses
+    in that sequence is also returned as a single string.
+    '''
 
     if mode == 'dummy':
         bb_df['elementClass']='beambeam'
-        eattributes = lambda charge, label:'sigx = 0.1, '   + \
+        eattributes = ('sigx = 0.1, '   + \
                     'sigy = 0.1, '   + \
                     'xma  = 1, '     + \
                     'yma  = 1, '     + \
-                    f'charge = 0*{charge}, ' +\
-                    'slot_id = %d'%({'bb_lr': 4, 'bb_ho': 6}[label]) # need to add 60 for central
-        bb_df['elementDefinition']=bb_df.apply(lambda x: elementDefinition(x.elementName, x.elementClass, eattributes(x['self_num_particles'], x['label'])), axis=1)
-        bb_df['elementInstallation']=bb_df.apply(lambda x: elementInstallation(x.elementName, x.elementClass, x.atPosition, x.ip_name), axis=1)
+                    'charge = 0*' + _as_str(bb_df['self_num_particles']) + ', ' + \
+                    'slot_id = ' + _as_str(bb_df['label'].map(_bb_slot_ids)))
     elif mode=='from_dataframe':
         bb_df['elementClass']='beambeam'
-        eattributes = lambda sigx, sigy, xma, yma, charge, label:f'sigx = {sigx}, '   + \
-                    f'sigy = {sigy}, '   + \
-                    f'xma  = {xma}, '     + \
-                    f'yma  = {yma}, '     + \
-                    f'charge := on_bb_charge*{charge}, ' +\
-                    'slot_id = %d'%({'bb_lr': 4, 'bb_ho': 6}[label]) # need to add 60 for central
-        bb_df['elementDefinition']=bb_df.apply(lambda x: elementDefinition(x.elementName, x.elementClass,
-            eattributes(np.sqrt(x['other_Sigma_11']),np.sqrt(x['other_Sigma_33']),
-                x['xma'], x['yma'],
-                x['other_particle_charge']*x['other_num_particles']/madx_reference_bunch_num_particles, x['label'])), # patch due to the fact that mad-x takes n_part from the weak beam
-            axis=1)
-        bb_df['elementInstallation']=bb_df.apply(lambda x: elementInstallation(x.elementName, x.elementClass, x.atPosition, x.ip_name), axis=1)
+        # patch due to the fact that mad-x takes n_part from the weak beam
+        charge = (bb_df['other_particle_charge'].values
+                * bb_df['other_num_particles'].values
+                / madx_reference_bunch_num_particles)
+        eattributes = ('sigx = ' + _as_str(np.sqrt(bb_df['other_Sigma_11'].values)) + ', '   + \
+                    'sigy = ' + _as_str(np.sqrt(bb_df['other_Sigma_33'].values)) + ', '   + \
+                    'xma  = ' + _as_str(bb_df['xma']) + ', '     + \
+                    'yma  = ' + _as_str(bb_df['yma']) + ', '     + \
+                    'charge := on_bb_charge*' + _as_str(charge) + ', ' + \
+                    'slot_id = ' + _as_str(bb_df['label'].map(_bb_slot_ids)))
     else:
         raise ValueError("mode must be 'dummy' or 'from_dataframe")
 
+    bb_df['elementDefinition'] = _element_definitions(
+            bb_df['elementName'], bb_df['elementClass'], eattributes)
+    bb_df['elementInstallation'] = _element_installations(
+            bb_df['elementName'], bb_df['elementClass'],
+            bb_df['atPosition'], bb_df['ip_name'])
+
+    if sequence_name is not None:
+        return get_mad_bb_input(bb_df, sequence_name)
+
+def get_mad_bb_input(bb_df, sequence_name):
+    '''
+    Single MAD-X input defining the bb lenses and installing them in the
+    sequence (to be sent with one mad.input call).
+    '''
+    return '\n'.join([
+        bb_df['elementDefinition'].str.cat(sep='\n'),
+        f'seqedit, sequence={sequence_name};',
+        'flatten;',
+        bb_df['elementInstallation'].str.cat(sep='\n'),
+        'flatten;',
+        'endedit;'])
+
+
+# Sign of the coordinates of the counter-rotating beam (b1->b3, b2->b4):
+# x -> -x and s -> -s, hence dx/ds -> dx/ds and dy/ds -> -dy/ds
+_counter_rotating_coord_parity = {'x': -1., 'px': 1., 'y': 1., 'py': -1.}
+
+def _get_counter_rotating_parity():
+    sigma_coords = {'1': 'x', '2': 'px', '3': 'y', '4': 'py'}
+    pp = _counter_rotating_coord_parity
+
+    parity = {'atPosition': -1.}
+    for ww in ['self', 'other']:
+        for ss in _sigma_names:
+            ii, jj = str(ss)
+            parity[f'{ww}_Sigma_{ss}'] = (
+                    pp[sigma_coords[ii]] * pp[sigma_coords[jj]])
+    parity['separation_x'] = pp['x']
+    parity['separation_y'] = pp['y']
+    parity['xma'] = pp['x']
+    parity['yma'] = pp['y']
+    parity['dpx'] = pp['px']
+    parity['dpy'] = pp['py']
+    for ww in ['self', 'other']:
+        for coord in ['x', 'px', 'y', 'py']:
+            parity[f'{ww}_{coord}_crab'] = pp[coord]
 
-def get_counter_rotating(bb_df):
-
-    c_bb_df = pd.DataFrame(index=bb_df.index)
+    return parity
 
-    c_bb_df['beam'] = bb_df['beam']
-    c_bb_df['other_beam'] = bb_df['other_beam']
-    c_bb_df['ip_name'] = bb_df['ip_name']
-    c_bb_df['label'] = bb_df['label']
-    c_bb_df['identifier'] = bb_df['identifier']
-    c_bb_df['elementClass'] = bb_df['elementClass']
-    c_bb_df['elementName'] = bb_df['elementName']
-    c_bb_df['self_num_particles'] = bb_df['self_num_particles']
-    c_bb_df['other_num_particles'] = bb_df['other_num_particles']
-    c_bb_df['self_particle_charge'] = bb_df['self_particle_charge']
-    c_bb_df['other_particle_charge'] = bb_df['other_particle_charge']
-    c_bb_df['other_elementName'] = bb_df['other_elementName']
+_counter_rotating_parity = _get_counter_rotating_parity()
 
-    c_bb_df['atPosition'] = bb_df['atPosition'] * (-1.)
+# Columns copied unchanged to the counter-rotating bb dataframe
+_counter_rotating_copied_columns = ['beam', 'other_beam', 'ip_name', 'label',
+    'identifier', 'elementClass', 'elementName', 'self_num_particles',
+    'other_num_particles', 'self_particle_charge', 'other_particle_charge',
+    'other_elementName', 'other_relativistic_beta']
 
-    c_bb_df['elementDefinition'] = np.nan
-    c_bb_df['elementInstallation'] = np.nan
+def get_counter_rotating(bb_df):
 
-    c_bb_df['self_lab_position'] = np.nan
-    c_bb_df['other_lab_position'] = np.nan
-
-    c_bb_df['self_Sigma_11'] = bb_df['self_Sigma_11'] * (-1.) * (-1.)                  # x * x
-    c_bb_df['self_Sigma_12'] = bb_df['self_Sigma_12'] * (-1.) * (-1.) * (-1.)          # x * dx / ds
-    c_bb_df['self_Sigma_13'] = bb_df['self_Sigma_13'] * (-1.)                          # x * y
-    c_bb_df['self_Sigma_14'] = bb_df['self_Sigma_14'] * (-1.) * (-1.)                  # x * dy / ds
-    c_bb_df['self_Sigma_22'] = bb_df['self_Sigma_22'] * (-1.) * (-1.) * (-1.) * (-1.)  # dx / ds * dx / ds
-    c_bb_df['self_Sigma_23'] = bb_df['self_Sigma_23'] * (-1.) * (-1.)                  # dx / ds * y
-    c_bb_df['self_Sigma_24'] = bb_df['self_Sigma_24'] * (-1.) * (-1.) * (-1.)          # dx / ds * dy / ds
-    c_bb_df['self_Sigma_33'] = bb_df['self_Sigma_33']                                  # y * y
-    c_bb_df['self_Sigma_34'] = bb_df['self_Sigma_34'] * (-1.)                          # y * dy / ds
-    c_bb_df['self_Sigma_44'] = bb_df['self_Sigma_44'] * (-1.) * (-1.)                  # dy / ds * dy / ds
-
-    c_bb_df['other_Sigma_11'] = bb_df['other_Sigma_11'] * (-1.) * (-1.)
-    c_bb_df['other_Sigma_12'] = bb_df['other_Sigma_12'] * (-1.) * (-1.) * (-1.)
-    c_bb_df['other_Sigma_13'] = bb_df['other_Sigma_13'] * (-1.)
-    c_bb_df['other_Sigma_14'] = bb_df['other_Sigma_14'] * (-1.) * (-1.)
-    c_bb_df['other_Sigma_22'] = bb_df['other_Sigma_22'] * (-1.) * (-1.) * (-1.) * (-1.)
-    c_bb_df['other_Sigma_23'] = bb_df['other_Sigma_23'] * (-1.) * (-1.)
-    c_bb_df['other_Sigma_24'] = bb_df['other_Sigma_24'] * (-1.) * (-1.) * (-1.)
-    c_bb_df['other_Sigma_33'] = bb_df['other_Sigma_33']
-    c_bb_df['other_Sigma_34'] = bb_df['other_Sigma_34'] * (-1.)
-    c_bb_df['other_Sigma_44'] = bb_df['other_Sigma_44'] * (-1.) * (-1.)
-
-    c_bb_df['other_relativistic_beta']=bb_df['other_relativistic_beta']
-    c_bb_df['separation_x'] = bb_df['separation_x'] * (-1.)
-    c_bb_df['separation_y'] = bb_df['separation_y']
-    c_bb_df['xma'] = bb_df['xma'] * (-1.)
-    c_bb_df['yma'] = bb_df['yma']
-
-    c_bb_df['dpx'] = bb_df['dpx'] * (-1.) * (-1.)
-    c_bb_df['dpy'] = bb_df['dpy'] * (-1.)
+    c_bb_df = bb_df[_counter_rotating_copied_columns].copy()
 
-    for ww in ['self', 'other']:
-        c_bb_df[f'{ww}_x_crab'] = bb_df[f'{ww}_x_crab'] * (-1)
-        c_bb_df[f'{ww}_px_crab'] = bb_df[f'{ww}_px_crab'] * (-1) * (-1)
-        c_bb_df[f'{ww}_y_crab'] = bb_df[f'{ww}_y_crab']
-        c_bb_df[f'{ww}_py_crab'] = bb_df[f'{ww}_py_crab'] * (-1)
+    # Apply the parity transformation in one go
+    parity_columns = list(_counter_rotating_parity.keys())
+    parity = np.array([_counter_rotating_parity[cc] for cc in parity_columns])
+    c_bb_df = pd.concat([c_bb_df, pd.DataFrame(
+        bb_df[parity_columns].values.astype(float) * parity,
+        index=bb_df.index, columns=parity_columns)], axis=1)
 
+    c_bb_df['elementDefinition'] = np.nan
+    c_bb_df['elementInstallation'] = np.nan
 
     # Compute phi and alpha from dpx and dpy
     compute_local_crossing_angle_and_plane(c_bb_df)
@@ -353,31 +589,169 @@ def get_counter_rotating(bb_df):
 def install_lenses_in_sequence(mad, bb_df, sequence_name,
         regenerate_mad_bb_info_in_df=True):
 
-    if regenerate_mad_bb_info_in_df:
+    # Compact dataframes do not store the MAD-X strings
+    if (regenerate_mad_bb_info_in_df
+            or 'elementDefinition' not in bb_df.columns
+            or bb_df['elementDefinition'].isna().any()):
         madx_reference_bunch_num_particles = mad.sequence[sequence_name].beam.npart
-        generate_mad_bb_info(bb_df, mode='from_dataframe',
-                madx_reference_bunch_num_particles=madx_reference_bunch_num_particles)
-
-    mad.input(bb_df['elementDefinition'].str.cat(sep='\n'))
-
-    # %% seqedit
-    mad.input(f'seqedit, sequence={sequence_name};')
-    mad.input('flatten;')
-    mad.input(bb_df['elementInstallation'].str.cat(sep='\n'))
-    mad.input('flatten;')
-    mad.input(f'endedit;')
+        mad_input = generate_mad_bb_info(bb_df, mode='from_dataframe',
+                madx_reference_bunch_num_particles=madx_reference_bunch_num_particles,
+                sequence_name=sequence_name)
+    else:
+        mad_input = get_mad_bb_input(bb_df, sequence_name)
+
+    # Definitions and seqedit in a single call
+    mad.input(mad_input)
+
+# Columns with few distinct values, stored as categoricals
+_bb_df_categorical_columns = ['beam', 'other_beam', 'ip_name', 'label',
+    'elementClass']
+# MAD-X strings, regenerated on demand by generate_mad_bb_info
+_bb_df_mad_info_columns = ['elementDefinition', 'elementInstallation']
+
+def compact_bb_df(bb_df):
+    '''
+    Copy of a bb dataframe with only numeric, categorical and name columns.
+    The MAD-X definition and installation strings are dropped (they are
+    regenerated when the lenses are installed).
+    '''
+    c_bb_df = bb_df.drop(columns=[cc for cc in _bb_df_mad_info_columns
+        if cc in bb_df.columns])
+    for cc in _bb_df_categorical_columns:
+        if cc in c_bb_df.columns:
+            c_bb_df[cc] = c_bb_df[cc].astype('category')
+    return c_bb_df
 
-def get_geometry_and_optics_b1_b2(mad, bb_df_b1, bb_df_b2):
+def save_bb_df(bb_df, filename):
+    '''
+    Write a bb dataframe in compact form to a parquet file or to a feather
+    file (if the filename ends with .feather).
+    '''
+    # The MAD-X strings are kept as empty columns, to preserve the order of
+    # the columns
+    c_bb_df = compact_bb_df(bb_df)
+    for ii, cc in enumerate(bb_df.columns):
+        if cc in _bb_df_mad_info_columns:
+            c_bb_df.insert(ii, cc, None)
+    # The index is the elementName column
+    c_bb_df = c_bb_df.reset_index(drop=True)
+    if str(filename).endswith('.feather'):
+        c_bb_df.to_feather(filename)
+    else:
+        c_bb_df.to_parquet(filename)
+
+def load_bb_df(filename, memory_map=True):
+    '''
+    Read a bb dataframe written by save_bb_df. Feather files are memory
+    mapped if memory_map is True. The columns stay categorical (as in
+    compact_bb_df) and the MAD-X strings are empty (to be regenerated with
+    generate_mad_bb_info).
+    '''
+    if str(filename).endswith('.feather'):
+        import pyarrow.feather as feather
+        bb_df = feather.read_feather(filename, memory_map=memory_map)
+    else:
+        bb_df = pd.read_parquet(filename)
+    # The index is made of the element names
+    if isinstance(bb_df['elementName'].dtype, pd.CategoricalDtype):
+        bb_df['elementName'] = bb_df['elementName'].astype(
+                bb_df['elementName'].cat.categories.dtype)
+    if not bb_df['elementName'].is_unique:
+        raise ValueError(f'Duplicated element names in {filename}')
+    return bb_df.set_index('elementName', drop=False)
+
+_snapshot_twiss_columns = ['name', 'keyword', 's', 'l',
+        'x', 'px', 'y', 'py', 'betx', 'alfx', 'bety', 'alfy',
+        'dx', 'dpx', 'dy', 'dpy'] + [f'sig{sn}' for sn in _sigma_names]
+_snapshot_survey_columns = ['name', 'keyword', 's', 'l',
+        'x', 'y', 'z', 'theta', 'phi', 'psi']
+
+class GeometrySnapshot:
+    '''
+    Twiss and survey tables of a set of sequences, taken once (a single use,
+    twiss and survey per sequence) and shared by the functions configuring
+    the beam-beam. With a Madxp handle the tables are taken again if an
+    input has possibly modified the model in the meantime (see
+    Madxp.model_version). Otherwise, and in any case after editing the
+    sequences directly through _libmadx, invalidate has to be called.
+    '''
+
+    def __init__(self, mad, sequence_names=('lhcb1', 'lhcb2')):
+        self.mad = mad
+        self.sequence_names = list(sequence_names)
+        self.invalidate()
+
+    def invalidate(self):
+        self._tables = {}
+        self._version = None
+
+    def _mad_version(self):
+        # Only a Madxp handle tracks its inputs
+        if isinstance(self.mad, Madxp):
+            return self.mad.model_version
+        return None
+
+    def __getitem__(self, seq_name):
+        version = self._mad_version()
+        if version != self._version:
+            self._tables = {}
+            self._version = version
+
+        if seq_name not in self._tables:
+            mad = self.mad
+            mad.use(sequence=seq_name)
+            mad.twiss()
+            mad.survey()
+            self._tables[seq_name] = FrozenTables(
+                twiss=FrozenTable.from_mad(mad, 'twiss',
+                    columns=_snapshot_twiss_columns),
+                survey=FrozenTable.from_mad(mad, 'survey',
+                    columns=_snapshot_survey_columns))
+
+        return self._tables[seq_name]
+
+    def take(self):
+        for seq_name in self.sequence_names:
+            self[seq_name]
+        return self
+
+    @property
+    def taken(self):
+        return (self._version == self._mad_version()
+                and all(nn in self._tables for nn in self.sequence_names))
+
+    def keep(self):
+        '''
+        Keep the tables through the inputs sent since they were taken, for
+        changes not affecting them (e.g. installing the dummy lenses, when
+        the encounters are located by s).
+        '''
+        self._version = self._mad_version()
+
+def get_geometry_and_optics_b1_b2(mad, bb_df_b1, bb_df_b2,
+        lenses_in_sequence=True, geometry=None):
+
+    if geometry is None:
+        geometry = GeometrySnapshot(mad)
 
     for beam, bbdf in zip(['b1', 'b2'], [bb_df_b1, bb_df_b2]):
-        # Get positions of the bb encounters (absolute from survey), closed orbit
-        # and orientation of the local reference system (MadPoint objects)
-        names, positions, sigmas = get_bb_names_madpoints_sigmas(
-            mad, seq_name="lhc"+beam
-        )
+        tables = geometry["lhc"+beam]
+        names = list(bbdf.index)
 
-        temp_df = pd.DataFrame()
-        temp_df['self_lab_position'] = positions
+        # Get positions of the bb encounters (absolute from survey), closed orbit
+        # and orientation of the local reference system (MadPointArray)
+        if lenses_in_sequence:
+            positions, twissdata = get_points_twissdata_for_elements(
+                names, tables, seq_name="lhc"+beam, skip_mad_use=True)
+        else:
+            # No dummy lenses, propagate from closest element
+            positions, twissdata = get_points_twissdata_at_s(
+                tables, "lhc"+beam, names=[nn + ":1" for nn in names],
+                s_positions=get_encounter_s_positions(tables, bbdf),
+                skip_mad_use=True)
+        sigmas = {kk: twissdata[kk] for kk in _sigma_names}
+
+        temp_df = pd.DataFrame(positions.to_columns('self_lab_position'))
         temp_df['elementName'] = names
         for ss in sigmas.keys():
             temp_df[f'self_Sigma_{ss}'] = sigmas[ss]
@@ -388,17 +762,19 @@ def get_geometry_and_optics_b1_b2(mad, bb_df_b1, bb_df_b2):
             bbdf[cc] = temp_df[cc]
 
 def get_survey_ip_position_b1_b2(mad,
-        ip_names = ['ip1', 'ip2', 'ip5', 'ip8']):
+        ip_names = ['ip1', 'ip2', 'ip5', 'ip8'], geometry=None):
 
     # Get ip position in the two surveys
 
+    if geometry is None:
+        geometry = GeometrySnapshot(mad)
+
     ip_position_df = pd.DataFrame()
 
     for beam in ['b1', 'b2']:
-        mad.use("lhc"+beam)
-        mad.survey()
+        tables = geometry["lhc"+beam]
         for ipnn in ip_names:
-            ip_position_df.loc[ipnn, beam] = MadPoint.from_survey((ipnn + ":1").lower(), mad)
+            ip_position_df.loc[ipnn, beam] = MadPoint.from_survey((ipnn + ":1").lower(), tables)
 
     return ip_position_df
 
@@ -410,17 +786,23 @@ def get_partner_corrected_position_and_optics(bb_df_b1, bb_df_b2, ip_position_df
 
         self_df = dict_dfs[self_beam_nn]
 
-        for ee in self_df.index:
-            other_beam_nn = self_df.loc[ee, 'other_beam']
+        for other_beam_nn in np.unique(self_df['other_beam'].values):
             other_df = dict_dfs[other_beam_nn]
-            other_ee = self_df.loc[ee, 'other_elementName']
+            mask = (self_df['other_beam'] == other_beam_nn).values
+
+            # Join on the name of the partner encounter
+            partner_df = other_df.loc[
+                    self_df.loc[mask, 'other_elementName'].values]
 
             # Get position of the other beam in its own survey
-            other_lab_position = copy.deepcopy(other_df.loc[other_ee, 'self_lab_position'])
+            other_lab_position = MadPointArray.from_dataframe(
+                    partner_df, 'self_lab_position')
 
             # Compute survey shift based on closest ip
-            closest_ip = self_df.loc[ee, 'ip_name']
-            survey_shift = (
+            closest_ips = self_df.loc[mask, 'ip_name'].values
+            survey_shift = np.zeros((len(partner_df), 3))
+            for closest_ip in np.unique(closest_ips):
+                survey_shift[closest_ips == closest_ip, :] = (
                     ip_position_df.loc[closest_ip, other_beam_nn].p
                   - ip_position_df.loc[closest_ip, self_beam_nn].p)
 
@@ -428,46 +810,94 @@ def get_partner_corrected_position_and_optics(bb_df_b1, bb_df_b2, ip_position_df
             other_lab_position.shift_survey(survey_shift)
 
             # Store positions
-            self_df.loc[ee, 'other_lab_position'] = other_lab_position
+            for kk, vv in other_lab_position.to_columns(
+                    'other_lab_position').items():
+                self_df.loc[mask, kk] = vv
 
             # Get sigmas of the other beam in its own survey
             for ss in _sigma_names:
-                self_df.loc[ee, f'other_Sigma_{ss}'] = other_df.loc[other_ee, f'self_Sigma_{ss}']
+                self_df.loc[mask, f'other_Sigma_{ss}'] = (
+                        partner_df[f'self_Sigma_{ss}'].values)
             # Get charge of other beam
-            self_df.loc[ee, 'other_num_particles'] = other_df.loc[other_ee, 'self_num_particles']
-            self_df.loc[ee, 'other_particle_charge'] = other_df.loc[other_ee, 'self_particle_charge']
-            self_df.loc[ee, 'other_relativistic_beta'] = other_df.loc[other_ee, 'self_relativistic_beta']
+            for qq in ['num_particles', 'particle_charge',
+                       'relativistic_beta']:
+                self_df.loc[mask, f'other_{qq}'] = (
+                        partner_df[f'self_{qq}'].values)
 
 def compute_separations(bb_df):
 
     sep_x, sep_y = find_bb_separations(
-        points_weak=bb_df['self_lab_position'].values,
-        points_strong=bb_df['other_lab_position'].values,
+        points_weak=MadPointArray.from_dataframe(bb_df, 'self_lab_position'),
+        points_strong=MadPointArray.from_dataframe(bb_df, 'other_lab_position'),
         names=bb_df.index.values,
         )
 
     bb_df['separation_x'] = sep_x
     bb_df['separation_y'] = sep_y
 
+def get_normalized_separation(bb_df):
+    '''
+    Separation at the encounters in units of the rms size of the strong
+    beam (from the columns separation_x/y and other_Sigma_11/33).
+    '''
+    return np.sqrt(bb_df['separation_x'].values**2 / bb_df['other_Sigma_11'].values
+                   + bb_df['separation_y'].values**2 / bb_df['other_Sigma_33'].values)
+
 def compute_dpx_dpy(bb_df):
     # Defined as (weak) - (strong)
-    for ee in bb_df.index:
-        dpx = (bb_df.loc[ee, 'self_lab_position'].tpx
-                - bb_df.loc[ee, 'other_lab_position'].tpx)
-        dpy = (bb_df.loc[ee, 'self_lab_position'].tpy
-                - bb_df.loc[ee, 'other_lab_position'].tpy)
-
-        bb_df.loc[ee, 'dpx'] = dpx
-        bb_df.loc[ee, 'dpy'] = dpy
+    bb_df['dpx'] = (bb_df['self_lab_position_tpx'].values
+                    - bb_df['other_lab_position_tpx'].values)
+    bb_df['dpy'] = (bb_df['self_lab_position_tpy'].values
+                    - bb_df['other_lab_position_tpy'].values)
 
 def compute_local_crossing_angle_and_plane(bb_df):
 
-    for ee in bb_df.index:
-        alpha, phi = find_alpha_and_phi(
-                bb_df.loc[ee, 'dpx'], bb_df.loc[ee, 'dpy'])
+    alpha, phi = find_alpha_and_phi_array(
+            bb_df['dpx'].values, bb_df['dpy'].values)
+
+    bb_df['alpha'] = alpha
+    bb_df['phi'] = phi
+
+def find_alpha_and_phi_array(dpx, dpy):
+    '''
+    Array version of find_alpha_and_phi (same octant conventions).
+    '''
+    dpx = np.atleast_1d(np.asarray(dpx, dtype=float))
+    dpy = np.atleast_1d(np.asarray(dpy, dtype=float))
 
-        bb_df.loc[ee, 'alpha'] = alpha
-        bb_df.loc[ee, 'phi'] = phi
+    absphi = np.sqrt(dpx ** 2 + dpy ** 2) / 2.0
+
+    # Same branching as the scalar version (NaNs follow the else branches)
+    small = absphi < 1e-20
+    upper = ~small & (dpy >= 0.)
+    lower = ~small & ~(dpy >= 0.)
+    x_ge_y = np.abs(dpx) >= np.abs(dpy)
+    x_le_y = np.abs(dpx) <= np.abs(dpy)
+
+    octants = [
+        upper & (dpx >= 0) & x_ge_y,        # First octant
+        upper & (dpx >= 0) & ~x_ge_y,       # Second octant
+        upper & ~(dpx >= 0) & ~x_ge_y,      # Third octant
+        upper & ~(dpx >= 0) & x_ge_y,       # Forth octant
+        lower & (dpx <= 0) & x_ge_y,        # Fifth octant
+        lower & (dpx <= 0) & ~x_ge_y,       # Sixth octant
+        lower & ~(dpx <= 0) & x_le_y,       # Seventh octant
+        lower & ~(dpx <= 0) & ~x_le_y,      # Eighth octant
+        ]
+    phi_sign = [1., 1., 1., -1., -1., -1., -1., 1.]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha_from_y = np.arctan(dpy/dpx)
+        alpha_from_x = 0.5*np.pi - np.arctan(dpx/dpy)
+
+    alpha = np.select(octants,
+            [alpha_from_y, alpha_from_x, alpha_from_x, alpha_from_y,
+             alpha_from_y, alpha_from_x, alpha_from_x, alpha_from_y],
+            default=0.)
+    phi = np.select(octants, [ss * absphi for ss in phi_sign],
+            default=absphi)
+
+    return alpha, phi
 
 def find_alpha_and_phi(dpx, dpy):
 
@@ -568,51 +998,100 @@ def compute_shift_strong_beam_based_on_close_ip(
     return strong_shift
 
 
+def _as_point_array(points):
+    if isinstance(points, MadPointArray):
+        return points
+    # List of MadPoint objects
+    return MadPointArray.from_arrays(
+        names=[pp.name for pp in points],
+        tx=[pp.tx or 0. for pp in points],
+        ty=[pp.ty or 0. for pp in points],
+        tpx=[pp.tpx or 0. for pp in points],
+        tpy=[pp.tpy or 0. for pp in points],
+        sp=[pp.p - pp.ex * (pp.tx or 0.) - pp.ey * (pp.ty or 0.)
+            for pp in points],
+        ex=[pp.ex for pp in points],
+        ey=[pp.ey for pp in points],
+        ez=[pp.ez for pp in points])
+
+def find_bb_separations_and_residuals(points_weak, points_strong):
+    '''
+    Batched computation of the separations at the beam-beam encounters.
+
+    Args:
+        points_weak: MadPointArray (or list of MadPoint) of the weak beam
+        points_strong: MadPointArray (or list of MadPoint) of the strong beam
+    Returns:
+        A dictionary of arrays with:
+        - 'separation_x', 'separation_y': separations in the weak beam frame
+        - 'parallelism_residual': norm of the difference of the two frames
+        - 'max_axis_residual': largest difference among ex, ey and ez
+        - 'longitudinal_residual': longitudinal distance of the two points
+    '''
+    pbw = _as_point_array(points_weak)
+    pbs = _as_point_array(points_strong)
+
+    vbb_ws = pbs.p - pbw.p
+
+    axis_residuals = np.array([
+        np.sqrt(np.sum((pbw.ex - pbs.ex) ** 2, axis=1)),
+        np.sqrt(np.sum((pbw.ey - pbs.ey) ** 2, axis=1)),
+        np.sqrt(np.sum((pbw.ez - pbs.ez) ** 2, axis=1))])
+
+    return {
+        'separation_x': np.sum(vbb_ws * pbw.ex, axis=1),
+        'separation_y': np.sum(vbb_ws * pbw.ey, axis=1),
+        'parallelism_residual': np.sqrt(np.sum(axis_residuals ** 2, axis=0)),
+        'max_axis_residual': np.max(axis_residuals, axis=0),
+        'longitudinal_residual': np.sum(vbb_ws * pbw.ez, axis=1),
+        }
+
+def check_bb_separation_residuals(residuals, names,
+        parallelism_tol=1e-10, parallelism_max=5e-3, longitudinal_tol=1e-4):
+    '''
+    Build a report of the encounters violating the tolerances on the
+    parallelism of the reference frames and on the longitudinal shift.
+
+    Returns:
+        A DataFrame (indexed by encounter name) with only the violations.
+        A ValueError is raised if a frame mismatch exceeds parallelism_max.
+    '''
+    report = pd.DataFrame(index=pd.Index(names, name='elementName'))
+    report['parallelism_residual'] = residuals['parallelism_residual']
+    report['longitudinal_residual'] = residuals['longitudinal_residual']
+    report['not_parallel'] = residuals['max_axis_residual'] >= parallelism_tol
+    report['longitudinally_shifted'] = (
+            np.abs(residuals['longitudinal_residual']) >= longitudinal_tol)
+    report = report[report['not_parallel'] | report['longitudinally_shifted']]
+
+    not_parallel = report[report['not_parallel']]
+    if len(not_parallel) > 0:
+        print(f"Reference systems are not parallel at {len(not_parallel)} "
+              f"encounters (largest residual "
+              f"{not_parallel['parallelism_residual'].max():.3e}).")
+        too_large = not_parallel[
+                not_parallel['parallelism_residual'] >= parallelism_max]
+        if len(too_large) > 0:
+            print(too_large)
+            raise ValueError("Too large! Stopping.")
+        print(f"Smaller that {parallelism_max}, tolerated.")
+
+    shifted = report[report['longitudinally_shifted']]
+    if len(shifted) > 0:
+        print(f"The beams are longitudinally shifted at {len(shifted)} "
+              f"encounters: {list(shifted.index)}")
+
+    return report
+
 def find_bb_separations(points_weak, points_strong, names=None):
 
     if names is None:
         names = ["bb_%d" % ii for ii in range(len(points_weak))]
 
-    sep_x = []
-    sep_y = []
-    for i_bb, name_bb in enumerate(names):
-
-        pbw = points_weak[i_bb]
-        pbs = points_strong[i_bb]
-
-        # Find vws
-        vbb_ws = points_strong[i_bb].p - points_weak[i_bb].p
-
-        # Check that the two reference system are parallel
-        try:
-            assert norm(pbw.ex - pbs.ex) < 1e-10  # 1e-4 is a reasonable limit
-            assert norm(pbw.ey - pbs.ey) < 1e-10  # 1e-4 is a reasonable limit
-            assert norm(pbw.ez - pbs.ez) < 1e-10  # 1e-4 is a reasonable limit
-        except AssertionError:
-            print(name_bb, "Reference systems are not parallel")
-            if (
-                np.sqrt(
-                    norm(pbw.ex - pbs.ex) ** 2
-                    + norm(pbw.ey - pbs.ey) ** 2
-                    + norm(pbw.ez - pbs.ez) ** 2
-                )
-                < 5e-3
-            ):
-                print("Smaller that 5e-3, tolerated.")
-            else:
-                raise ValueError("Too large! Stopping.")
+    residuals = find_bb_separations_and_residuals(points_weak, points_strong)
+    check_bb_separation_residuals(residuals, names)
 
-        # Check that there is no longitudinal separation
-        try:
-            assert np.abs(np.dot(vbb_ws, pbw.ez)) < 1e-4
-        except AssertionError:
-            print(name_bb, "The beams are longitudinally shifted")
-
-        # Find separations
-        sep_x.append(np.dot(vbb_ws, pbw.ex))
-        sep_y.append(np.dot(vbb_ws, pbw.ey))
-
-    return sep_x, sep_y
+    return residuals['separation_x'], residuals['separation_y']
 
 def setup_beam_beam_in_line(
     line,
@@ -622,79 +1101,308 @@ def setup_beam_beam_in_line(
     import xfields as xf
     assert bb_coupling is False  # Not implemented
 
-    for ii, (ee, eename) in enumerate(zip(line.elements, line.element_names)):
-        if isinstance(ee, xf.BeamBeamBiGaussian2D):
-            ee.n_particles=bb_df.loc[eename, 'other_num_particles']
-            ee.q0 = bb_df.loc[eename, 'other_particle_charge']
-            ee.sigma_x = np.sqrt(bb_df.loc[eename, 'other_Sigma_11'])
-            ee.sigma_y = np.sqrt(bb_df.loc[eename, 'other_Sigma_33'])
-            ee.beta0 = bb_df.loc[eename, 'other_relativistic_beta']
-            ee.mean_x = bb_df.loc[eename, 'separation_x']
-            ee.mean_y = bb_df.loc[eename, 'separation_y']
-        if isinstance(ee, xf.BeamBeamBiGaussian3D):
-            params = {}
-            params['phi'] = bb_df.loc[eename, 'phi']
-            params['alpha'] =  bb_df.loc[eename, 'alpha']
-            params['x_bb_co'] =  bb_df.loc[eename, 'separation_x']
-            params['y_bb_co'] =  bb_df.loc[eename, 'separation_y']
-            # TODO update xtrack interface to separate charge and b. population
-            params['charge_slices'] =  [(bb_df.loc[eename, 'other_num_particles']
-                                 * bb_df.loc[eename, 'other_particle_charge'])]
-            params['zeta_slices'] =  [0.0]
-            params['sigma_11'] =  bb_df.loc[eename, 'other_Sigma_11']
-            params['sigma_12'] =  bb_df.loc[eename, 'other_Sigma_12']
-            params['sigma_13'] =  bb_df.loc[eename, 'other_Sigma_13']
-            params['sigma_14'] =  bb_df.loc[eename, 'other_Sigma_14']
-            params['sigma_22'] =  bb_df.loc[eename, 'other_Sigma_22']
-            params['sigma_23'] =  bb_df.loc[eename, 'other_Sigma_23']
-            params['sigma_24'] =  bb_df.loc[eename, 'other_Sigma_24']
-            params['sigma_33'] =  bb_df.loc[eename, 'other_Sigma_33']
-            params['sigma_34'] =  bb_df.loc[eename, 'other_Sigma_34']
-            params['sigma_44'] =  bb_df.loc[eename, 'other_Sigma_44']
-
-            if not (bb_coupling):
-                params['sigma_13'] =  0.0
-                params['sigma_14'] =  0.0
-                params['sigma_23'] =  0.0
-                params['sigma_24'] =  0.0
-
-            params["x_co"] = 0
-            params["px_co"] = 0
-            params["y_co"] = 0
-            params["py_co"] = 0
-            params["zeta_co"] = 0
-            params["delta_co"] = 0
-            params["d_x"] = 0
-            params["d_px"] = 0
-            params["d_y"] = 0
-            params["d_py"] = 0
-            params["d_zeta"] = 0
-            params["d_delta"] = 0
-
-            newee = xf.BeamBeamBiGaussian3D(old_interface=params)
-            line.element_dict[eename] = newee
+    # Lenses of the line and their row in bb_df
+    lens_index = get_bb_lens_index(bb_df)
+    lens_names = [nn for nn in line.element_names
+                  if isinstance(line.element_dict[nn],
+                      (xf.BeamBeamBiGaussian2D, xf.BeamBeamBiGaussian3D))]
+    missing = [nn for nn in lens_names if nn not in lens_index]
+    if len(missing) > 0:
+        raise KeyError(f'bb lenses of the line not in bb_df: {missing}')
+
+    _setup_bb_lenses(line, lens_names, lens_index, bb_df, bb_coupling)
+
+def update_beam_beam_in_line(line, bb_df, bb_coupling=False):
+    '''
+    Update the bb lenses of a line configured by setup_beam_beam_in_line
+    after a change of bb_df not affecting the geometry (see rescale_bb_df).
+    Only the lenses in bb_df are visited. The lenses are patched in place,
+    hence the update applies also to a tracker already built on the line.
+    '''
+    assert bb_coupling is False  # Not implemented
+
+    lens_index = get_bb_lens_index(bb_df)
+    lens_names = [nn for nn in bb_df.index if nn in line.element_dict]
 
+    _setup_bb_lenses(line, lens_names, lens_index, bb_df, bb_coupling)
 
+def get_bb_lens_index(bb_df):
+    '''
+    Dictionary lens name -> row of bb_df.
+    '''
+    return {nn: ii for ii, nn in enumerate(bb_df.index)}
+
+_bb_lens_columns = ['other_num_particles', 'other_particle_charge',
+    'other_relativistic_beta', 'separation_x', 'separation_y', 'phi', 'alpha'
+    ] + [f'other_Sigma_{ss}' for ss in _sigma_names]
+
+def _setup_bb_lenses(line, lens_names, lens_index, bb_df, bb_coupling):
+    import xfields as xf
+
+    # Each column extracted once
+    cols = {cc: bb_df[cc].values.astype(float) for cc in _bb_lens_columns}
+    charge = cols['other_num_particles'] * cols['other_particle_charge']
+    sigma_x = np.sqrt(cols['other_Sigma_11'])
+    sigma_y = np.sqrt(cols['other_Sigma_33'])
+
+    sin_phi = np.sin(cols['phi'])
+    cos_phi = np.cos(cols['phi'])
+    tan_phi = np.tan(cols['phi'])
+    sin_alpha = np.sin(cols['alpha'])
+    cos_alpha = np.cos(cols['alpha'])
+    sigmas = {ss: (cols[f'other_Sigma_{ss}'] if bb_coupling
+                   or ss not in (13, 14, 23, 24) else np.zeros(len(bb_df)))
+              for ss in _sigma_names}
+
+    for eename in lens_names:
+        ii = lens_index[eename]
+        ee = line.element_dict[eename]
+        if isinstance(ee, xf.BeamBeamBiGaussian2D):
+            ee.n_particles = cols['other_num_particles'][ii]
+            ee.q0 = cols['other_particle_charge'][ii]
+            ee.sigma_x = sigma_x[ii]
+            ee.sigma_y = sigma_y[ii]
+            ee.beta0 = cols['other_relativistic_beta'][ii]
+            ee.mean_x = cols['separation_x'][ii]
+            ee.mean_y = cols['separation_y'][ii]
+        elif isinstance(ee, xf.BeamBeamBiGaussian3D):
+            # Patched in place (the element may be used by a tracker), as
+            # set by the old interface for a single slice at zeta=0, whose
+            # boosted center does not depend on the angles. The angles are
+            # set first, the boosted sigmas are computed from them.
+            ee._sin_phi = sin_phi[ii]
+            ee._cos_phi = cos_phi[ii]
+            ee._tan_phi = tan_phi[ii]
+            ee._sin_alpha = sin_alpha[ii]
+            ee._cos_alpha = cos_alpha[ii]
+            for ss in _sigma_names:
+                setattr(ee, f'slices_other_beam_Sigma_{ss}', sigmas[ss][ii])
+            ee.other_beam_shift_x = cols['separation_x'][ii]
+            ee.other_beam_shift_y = cols['separation_y'][ii]
+            # TODO update xtrack interface to separate charge and b. population
+            ee.slices_other_beam_num_particles[0] = charge[ii]
+
+def rescale_bb_df(bb_df, intensity_ratio=1., emittance_ratio_x=1.,
+        emittance_ratio_y=1., particle_charge=None):
+    '''
+    Update in place the parameters of the strong beam in a bb dataframe for
+    a change of intensity, particle charge or emittance (the geometry of the
+    encounters does not change). The sigma matrix is scaled with the
+    emittances (the x-y terms with their geometric mean), neglecting the
+    dispersive contribution. The MAD-X strings are dropped, they are
+    regenerated when the lenses are installed.
+    '''
+    bb_df['other_num_particles'] *= intensity_ratio
+    if particle_charge is not None:
+        bb_df['other_particle_charge'] = particle_charge
+
+    ratio = {'1': emittance_ratio_x, '2': emittance_ratio_x,
+             '3': emittance_ratio_y, '4': emittance_ratio_y}
+    for ss in _sigma_names:
+        ii, jj = str(ss)
+        bb_df[f'other_Sigma_{ss}'] *= np.sqrt(ratio[ii] * ratio[jj])
+
+    bb_df.drop(columns=[cc for cc in _bb_df_mad_info_columns
+        if cc in bb_df.columns], inplace=True)
+
+_proton_classical_radius = qe**2 / (4 * np.pi * epsilon_0 * m_p * clight**2)
+
+def estimate_far_field_tune_shifts(bb_df, nemitt_x, nemitt_y,
+        classical_radius=_proton_classical_radius):
+    '''
+    Linear tune shifts of the weak beam from each encounter, treating the
+    strong beam as a line charge (far field, meaningful for long-range
+    encounters). The beta functions are obtained from the weak-beam sigma
+    matrix and the normalized emittances.
+
+    Returns:
+        The arrays of the horizontal and vertical tune shifts.
+    '''
+    beta0 = bb_df['self_relativistic_beta'].values
+    gamma0 = 1. / np.sqrt(1. - beta0**2)
+    betx = bb_df['self_Sigma_11'].values / (nemitt_x / (beta0 * gamma0))
+    bety = bb_df['self_Sigma_33'].values / (nemitt_y / (beta0 * gamma0))
+
+    dx = bb_df['separation_x'].values
+    dy = bb_df['separation_y'].values
+    d2 = dx**2 + dy**2
+
+    strength = (2 * classical_radius / gamma0
+            * bb_df['other_num_particles'].values
+            * bb_df['other_particle_charge'].values
+            * bb_df['self_particle_charge'].values)
+
+    dqx = betx * strength * (dx**2 - dy**2) / (4 * np.pi * d2**2)
+    dqy = bety * strength * (dy**2 - dx**2) / (4 * np.pi * d2**2)
+
+    return dqx, dqy
+
+def prune_bb_df(bb_df, separation_cut, mode='remove', nemitt_x=None,
+        nemitt_y=None, classical_radius=_proton_classical_radius,
+        verbose=False):
+    '''
+    Remove the long-range encounters having normalized separation (see
+    get_normalized_separation) larger than separation_cut.
+
+    Args:
+        bb_df: the bb dataframe
+        separation_cut: normalized separation beyond which the long-range
+            encounters are pruned
+        mode: 'remove' to drop the pruned encounters, 'lump' to replace the
+            pruned encounters of each IR side with the one of them closest to
+            the strong beam, with intensity rescaled to give the same
+            far-field tune shift (in the plane where it is the largest;
+            encounters with |dx| == |dy|, without far-field tune shift, are
+            skipped, and the side falls back to 'remove' if none is left)
+        nemitt_x, nemitt_y: normalized emittances, needed to estimate the
+            tune shifts (otherwise the report contains only the counts)
+        classical_radius: classical radius of the particles
+        verbose: if True the report is printed
+    Returns:
+        The pruned bb dataframe (a copy) and a pandas DF reporting, for each
+        IR side, the number of pruned encounters and the estimated tune shift
+        errors.
+
+    The same pruned dataframe is to be used to install the lenses in MAD-X
+    and to build the xsuite line, so that the two models agree (see the
+    bb_pruning option of generate_bb_dataframes).
+    '''
+
+    if mode not in ['remove', 'lump']:
+        raise ValueError("mode must be 'remove' or 'lump'")
+
+    with_tune_shifts = nemitt_x is not None and nemitt_y is not None
+    # Emittances only scale the tune shifts, the ratios are used for lumping
+    dqx, dqy = estimate_far_field_tune_shifts(bb_df,
+            nemitt_x=(nemitt_x if with_tune_shifts else 1.),
+            nemitt_y=(nemitt_y if with_tune_shifts else 1.),
+            classical_radius=classical_radius)
+
+    normalized_separation = get_normalized_separation(bb_df)
+    to_prune = ((bb_df['label'] == 'bb_lr').values
+                & (normalized_separation > separation_cut))
+    side = np.where(bb_df['identifier'].values > 0, 'right', 'left')
+
+    pruned_bb_df = bb_df[~to_prune].copy()
+    report = []
+    for ip_name, sd in sorted(set(zip(
+            bb_df['ip_name'].values[to_prune], side[to_prune]))):
+        mask = to_prune & (bb_df['ip_name'].values == ip_name) & (side == sd)
+        dqx_err = np.sum(dqx[mask])
+        dqy_err = np.sum(dqy[mask])
+
+        if mode == 'lump':
+            if abs(dqx_err) >= abs(dqy_err):
+                dq_err, dq = dqx_err, dqx
+            else:
+                dq_err, dq = dqy_err, dqy
+            # Closest encounter with a tune shift in that plane (none for
+            # |dx| == |dy|), if any, otherwise the encounters are removed
+            candidates = np.flatnonzero(mask & (dq != 0))
+            if dq_err != 0 and len(candidates) > 0:
+                i_lump = candidates[
+                        np.argmin(normalized_separation[candidates])]
+                scale = dq_err / dq[i_lump]
+                lump_row = bb_df.iloc[[i_lump]].copy()
+                lump_row['other_num_particles'] *= scale
+                pruned_bb_df = pd.concat([pruned_bb_df, lump_row])
+                dqx_err -= scale * dqx[i_lump]
+                dqy_err -= scale * dqy[i_lump]
+
+        report.append({'ip_name': ip_name, 'side': sd,
+            'n_pruned': np.sum(mask),
+            'min_normalized_separation': np.min(normalized_separation[mask]),
+            'dqx_error': dqx_err if with_tune_shifts else np.nan,
+            'dqy_error': dqy_err if with_tune_shifts else np.nan})
+
+    report = pd.DataFrame(report, columns=['ip_name', 'side', 'n_pruned',
+        'min_normalized_separation', 'dqx_error', 'dqy_error'])
+    if verbose:
+        print(f'Pruned {np.sum(to_prune)} of {len(bb_df)} encounters '
+              f'(normalized separation > {separation_cut}):')
+        print(report)
+
+    # Keep the original order and drop the MAD-X strings (not up to date)
+    pruned_bb_df = pruned_bb_df.loc[
+            [nn for nn in bb_df.index if nn in pruned_bb_df.index]]
+    pruned_bb_df.drop(columns=[cc for cc in _bb_df_mad_info_columns
+        if cc in pruned_bb_df.columns], inplace=True)
+
+    return pruned_bb_df, report
 
 
 def crabbing_strong_beam(mad, bb_dfs, z_crab_twiss,
-        save_crab_twiss=True):
+        save_crab_twiss=True, lenses_in_sequence=True, geometry=None):
+
+    crab_response = get_crab_bump_response(mad, bb_dfs, z_crab_twiss,
+            save_crab_twiss=save_crab_twiss,
+            lenses_in_sequence=lenses_in_sequence, geometry=geometry)
+
+    apply_crab_bump_response(bb_dfs, crab_response)
+
+    return crab_response['crab_kicker_dict']
+
+def get_crab_bump_response(mad, bb_dfs, z_crab_twiss,
+        save_crab_twiss=False, lenses_in_sequence=True, geometry=None):
+    '''
+    Crab bump at the bb encounters of b1 and b2 per unit RF modulation.
+    The bump is linear in the crab kick, hence the response computed with
+    one twiss per beam (at z_crab_twiss, with the crossing disabled) can be
+    applied for any z (s_crab of the encounters) and any crab voltage
+    (see apply_crab_bump_response). Each sequence is used again before its
+    twiss (it may have been edited after the geometry snapshot, which is
+    only used to find the rows of the lenses).
+
+    Returns:
+        A dictionary with the response of each beam, the RF parameters
+        needed to compute the modulation and the crab kicker settings.
+    '''
+
+    rf_k = 2.*np.pi*mad.globals.hrf400/mad.globals.lhclength
+    rf_mod_twiss = np.sin(rf_k*z_crab_twiss)
+
+    crab_response = {'rf_k': rf_k, 'crab_kicker_dict': {'z_crab': z_crab_twiss}}
+    crab_kicker_dict = crab_response['crab_kicker_dict']
+
+    # Rows of the lenses from the nominal tables (same table layout), taken
+    # before the crossing is disabled
+    i_lenses = {}
+    if lenses_in_sequence and geometry is not None:
+        for beam in ['b1', 'b2']:
+            i_lenses[beam] = get_table_rows(geometry['lhc'+beam], 'twiss',
+                                            bb_dfs[beam].index + ':1')
 
-    crab_kicker_dict = {'z_crab': z_crab_twiss}
     for beam in ['b1', 'b2']:
         bb_df = bb_dfs[beam]
+        seqn = 'lhc'+beam
 
         # Compute crab bump shape
         mad.input('exec, crossing_disable')
         mad.globals.z_crab = z_crab_twiss
 
-        seqn = 'lhc'+beam
         mad.use(seqn)
         mad.twiss()
-        tw_crab_bump_df = mad.get_twiss_df(table_name='twiss')
         if save_crab_twiss:
-            tw_crab_bump_df.to_parquet(
-                f'twiss_z_crab_{z_crab_twiss:.5f}_seq_{seqn}.parquet')
+            mad.get_twiss_df(table_name='twiss').to_parquet(
+                _crab_twiss_filename(z_crab_twiss, seqn))
+
+        # Get bump at the bb encounters
+        twiss = mad.table.twiss
+        if lenses_in_sequence:
+            if beam in i_lenses:
+                i_twiss = i_lenses[beam]
+            else:
+                i_twiss = get_table_rows(mad, 'twiss', bb_df.index + ':1')
+            bump_at_bbs = {coord: twiss[coord][i_twiss]
+                    for coord in ['x', 'y', 'px', 'py']}
+        else:
+            # From the crab twiss, the lenses may be installed in the meantime
+            i_twiss, l_twiss = _rows_and_drift_lengths(twiss,
+                    get_encounter_s_positions(mad, bb_df))
+            bump_at_bbs = {coord: twiss[coord][i_twiss]
+                    for coord in ['px', 'py']}
+            bump_at_bbs['x'] = twiss.x[i_twiss] + l_twiss * bump_at_bbs['px']
+            bump_at_bbs['y'] = twiss.y[i_twiss] + l_twiss * bump_at_bbs['py']
 
         # Save crab kickers
         seq = mad.sequence[seqn]
@@ -708,19 +1416,32 @@ def crabbing_strong_beam(mad, bb_dfs, z_crab_twiss,
         mad.globals.z_crab = 0
         mad.input('exec, crossing_restore')
 
-        # Remove last part of the name
-        tw_crab_bump_df.index = tw_crab_bump_df.name.apply(
-                lambda nn: ''.join(nn.split(':')[:-1]))
+        crab_response[beam] = pd.DataFrame(
+                {coord: bump_at_bbs[coord]/rf_mod_twiss
+                    for coord in ['x', 'px', 'y', 'py']},
+                index=bb_df.index)
 
-        bump_at_bbs = tw_crab_bump_df.loc[bb_df.index, ['x', 'y', 'px', 'py']]
+    return crab_response
 
-        rf_mod = np.sin(2.*np.pi*mad.globals.hrf400
-                /mad.globals.lhclength*2*bb_df.s_crab)
-        rf_mod_twiss = np.sin(2.*np.pi*mad.globals.hrf400
-                /mad.globals.lhclength*z_crab_twiss)
+def _crab_twiss_filename(z_crab_twiss, seq_name):
+    return f'twiss_z_crab_{z_crab_twiss:.5f}_seq_{seq_name}.parquet'
+
+def apply_crab_bump_response(bb_dfs, crab_response, voltage_ratio=1.):
+    '''
+    Set the crab bump of the four bb dataframes from the response given
+    by get_crab_bump_response (scaled by voltage_ratio) and correct the
+    separations. Can be called again on the same dataframes, e.g. in a
+    scan of the crab voltage.
+    '''
+
+    for beam in ['b1', 'b2']:
+        bb_df = bb_dfs[beam]
+        response = crab_response[beam].loc[bb_df.index]
+        rf_mod = np.sin(crab_response['rf_k']*2*bb_df.s_crab)
 
         for coord in ['x', 'px', 'y', 'py']:
-            bb_df[f'self_{coord}_crab'] = bump_at_bbs[coord]*rf_mod/rf_mod_twiss
+            bb_df[f'self_{coord}_crab'] = (
+                    voltage_ratio*response[coord].values*rf_mod)
 
     for coord in ['x', 'px', 'y', 'py']:
         bb_dfs['b2'][f'other_{coord}_crab'] = bb_dfs['b1'].loc[
@@ -731,20 +1452,21 @@ def crabbing_strong_beam(mad, bb_dfs, z_crab_twiss,
     # Handle b3 and b4
     for bcw, bacw in zip(['b1', 'b2'], ['b3', 'b4']):
         for ww in ['self', 'other']:
-            bb_dfs[bacw][f'{ww}_x_crab'] = bb_dfs[bcw][f'{ww}_x_crab'] * (-1)
-            bb_dfs[bacw][f'{ww}_px_crab'] = bb_dfs[bcw][f'{ww}_px_crab'] * (-1) * (-1)
-            bb_dfs[bacw][f'{ww}_y_crab'] = bb_dfs[bcw][f'{ww}_y_crab']
-            bb_dfs[bacw][f'{ww}_py_crab'] = bb_dfs[bcw][f'{ww}_py_crab'] * (-1)
+            for coord in ['x', 'px', 'y', 'py']:
+                cc = f'{ww}_{coord}_crab'
+                bb_dfs[bacw][cc] = (bb_dfs[bcw][cc]
+                                    * _counter_rotating_parity[cc])
 
-    # Correct separation
+    # Correct separation (with respect to the one without crab)
     for beam in ['b1', 'b2', 'b3', 'b4']:
         bb_df = bb_dfs[beam]
-        bb_df['separation_x_no_crab'] = bb_df['separation_x']
-        bb_df['separation_y_no_crab'] = bb_df['separation_y']
-        bb_df['separation_x'] += bb_df['other_x_crab']
-        bb_df['separation_y'] += bb_df['other_y_crab']
-
-    return crab_kicker_dict
+        if 'separation_x_no_crab' not in bb_df.columns:
+            bb_df['separation_x_no_crab'] = bb_df['separation_x']
+            bb_df['separation_y_no_crab'] = bb_df['separation_y']
+        bb_df['separation_x'] = (bb_df['separation_x_no_crab']
+                + bb_df['other_x_crab'])
+        bb_df['separation_y'] = (bb_df['separation_y_no_crab']
+                + bb_df['other_y_crab'])
 
 def generate_bb_dataframes(mad,
     ip_names=['ip1', 'ip2', 'ip5', 'ip8'],
@@ -756,11 +1478,53 @@ def generate_bb_dataframes(mad,
     bunch_particle_charge=None,
     sigmaz_m=None,
     z_crab_twiss=0.,
-    remove_dummy_lenses=True):
+    remove_dummy_lenses=True,
+    install_dummy_lenses=True,
+    cache_folder=None,
+    ho_slices_accuracy=0.5,
+    max_HO_slices=None,
+    bb_pruning=None,
+    geometry=None):
+    '''
+    geometry: optional GeometrySnapshot of the sequences without the bb
+    lenses, e.g. taken by the caller for other checks. Tables already taken
+    are not taken again after installing the dummy lenses.
+
+    bb_pruning: optional dict of arguments of prune_bb_df (e.g.
+    {'separation_cut': 10., 'mode': 'lump'}), applied to the four returned
+    dataframes. The pruned dataframes are then used both to install the
+    lenses in MAD-X and to build the xsuite line. The report of
+    prune_bb_df is in bb_df.attrs['pruning_report']. The cache stores the
+    dataframes before pruning.
+    '''
 
     for pp in ['circ', 'npart', 'gamma']:
         assert mad.sequence.lhcb1.beam[pp] == mad.sequence.lhcb2.beam[pp]
 
+    if cache_folder is not None:
+        cache_key = get_bb_cache_key(mad, bb_config={
+            'ip_names': ip_names,
+            'numberOfLRPerIRSide': numberOfLRPerIRSide,
+            'harmonic_number': harmonic_number,
+            'bunch_spacing_buckets': bunch_spacing_buckets,
+            'numberOfHOSlices': numberOfHOSlices,
+            'ho_slices_accuracy': ho_slices_accuracy,
+            'max_HO_slices': max_HO_slices,
+            'bunch_num_particles': bunch_num_particles,
+            'bunch_particle_charge': bunch_particle_charge,
+            'sigmaz_m': sigmaz_m,
+            'z_crab_twiss': z_crab_twiss,
+            'install_dummy_lenses': install_dummy_lenses})
+        bb_dfs = load_bb_dfs_from_cache(cache_folder, cache_key)
+        if bb_dfs is not None:
+            print(f'bb dataframes loaded from cache (key {cache_key})')
+            # Files written by the computation (crab twiss)
+            restore_side_outputs_from_cache(cache_folder, cache_key)
+            _complete_bb_dfs_from_cache(mad, bb_dfs,
+                keep_dummy_lenses=(install_dummy_lenses
+                                   and not remove_dummy_lenses))
+            return _prune_bb_dfs(mad, bb_dfs, bb_pruning)
+
     circumference = mad.sequence.lhcb1.beam.circ
     madx_reference_bunch_num_particles = mad.sequence.lhcb1.beam.npart
 
@@ -779,6 +1543,16 @@ def generate_bb_dataframes(mad,
     else:
         sigt = mad.sequence.lhcb1.beam.sigt
 
+    # Single use, twiss and survey per beam, shared by the steps below
+    if geometry is None:
+        geometry = GeometrySnapshot(mad)
+
+    if isinstance(numberOfHOSlices, str) and numberOfHOSlices == 'auto':
+        # Orbit and beam sizes at the IPs do not depend on the dummy lenses
+        numberOfHOSlices = get_auto_ho_slices(geometry, ip_names, sigt,
+                accuracy=ho_slices_accuracy, max_slices=max_HO_slices)
+        print(f'Number of head-on slices: {numberOfHOSlices}')
+
     bb_df_b1 = generate_set_of_bb_encounters_1beam(
         circumference, harmonic_number,
         bunch_spacing_buckets,
@@ -802,17 +1576,41 @@ def generate_bb_dataframes(mad,
     generate_mad_bb_info(bb_df_b1, mode='dummy')
     generate_mad_bb_info(bb_df_b2, mode='dummy')
 
-    # Install dummy bb lenses in mad sequences
-    install_lenses_in_sequence(mad, bb_df=bb_df_b1, sequence_name='lhcb1',
-            regenerate_mad_bb_info_in_df=False) # We cannot regenerate because dummy does not have all columns!!!!!!!!!!!!
-    install_lenses_in_sequence(mad, bb_df=bb_df_b2, sequence_name='lhcb2',
-            regenerate_mad_bb_info_in_df=False)
+    # Tables taken before installing the lenses (e.g. for the head-on slices)
+    # are kept, the encounters are then located by s
+    lenses_in_tables = install_dummy_lenses and not geometry.taken
+
+    if install_dummy_lenses:
+        # Install dummy bb lenses in mad sequences
+        install_lenses_in_sequence(mad, bb_df=bb_df_b1, sequence_name='lhcb1',
+                regenerate_mad_bb_info_in_df=False) # We cannot regenerate because dummy does not have all columns!!!!!!!!!!!!
+        install_lenses_in_sequence(mad, bb_df=bb_df_b2, sequence_name='lhcb2',
+                regenerate_mad_bb_info_in_df=False)
+        if lenses_in_tables:
+            # Tables are to be taken on the modified sequences
+            geometry.invalidate()
+        else:
+            # Dummy lenses do not change the optics
+            geometry.keep()
+    geometry.take()
 
     # Use mad survey and twiss to get geometry and locations of all encounters
-    get_geometry_and_optics_b1_b2(mad, bb_df_b1, bb_df_b2)
+    # (propagated from the closest element if the lenses are not in the tables)
+    try:
+        get_geometry_and_optics_b1_b2(mad, bb_df_b1, bb_df_b2,
+                lenses_in_sequence=lenses_in_tables, geometry=geometry)
+    except EncounterInThickElementError:
+        if not install_dummy_lenses or lenses_in_tables:
+            raise
+        # Encounters inside thick elements, use the installed lenses
+        lenses_in_tables = True
+        geometry.invalidate()
+        get_geometry_and_optics_b1_b2(mad, bb_df_b1, bb_df_b2,
+                lenses_in_sequence=lenses_in_tables, geometry=geometry)
 
     # Get the position of the IPs in the surveys of the two beams
-    ip_position_df = get_survey_ip_position_b1_b2(mad, ip_names)
+    ip_position_df = get_survey_ip_position_b1_b2(mad, ip_names,
+            geometry=geometry)
 
     # Get geometry and optics at the partner encounter
     get_partner_corrected_position_and_optics(
@@ -847,52 +1645,174 @@ def generate_bb_dataframes(mad,
         'b3': bb_df_b3,
         'b4': bb_df_b4}
 
+    side_outputs = []
     if abs(z_crab_twiss)>0:
         crab_kicker_dict = crabbing_strong_beam(mad, bb_dfs,
                 z_crab_twiss=z_crab_twiss,
-                save_crab_twiss=True)
+                save_crab_twiss=True,
+                lenses_in_sequence=lenses_in_tables,
+                geometry=geometry)
+        side_outputs = [_crab_twiss_filename(z_crab_twiss, seqn)
+                        for seqn in ['lhcb1', 'lhcb2']]
     else:
         print('Crabbing of strong beam skipped!')
 
-    if remove_dummy_lenses:
+    if remove_dummy_lenses and install_dummy_lenses:
         for beam in ['b1', 'b2']:
             bbdf = bb_dfs[beam]
-            mad.input(f'seqedit, sequence={"lhc"+beam};')
-            mad.input('flatten;')
-            for nn in bbdf.elementName.values:
-                print(f'remove, element={nn}')
-                mad.input(f'remove, element={nn}')
-            mad.input('flatten;')
-            mad.input(f'endedit;')
+            run_seqedit(mad, "lhc"+beam,
+                    {'mode': 'remove', 'element': bbdf.elementName.values},
+                    use_sequence=False)
 
-    return bb_dfs
+    if cache_folder is not None:
+        save_bb_dfs_to_cache(bb_dfs, cache_folder, cache_key,
+                side_outputs=side_outputs)
 
-def find_bb_xma_yma(points_weak, points_strong, names=None):
-    ''' To be used in the compute_xma_yma function'''
-    if names is None:
-        names = ["bb_%d" % ii for ii in range(len(points_weak))]
+    return _prune_bb_dfs(mad, bb_dfs, bb_pruning)
 
-    xma = []
-    yma = []
-    for i_bb, name_bb in enumerate(names):
+def _prune_bb_dfs(mad, bb_dfs, bb_pruning):
 
-        pbw = points_weak[i_bb]
-        pbs = points_strong[i_bb]
+    if bb_pruning is None:
+        return bb_dfs
+
+    madx_reference_bunch_num_particles = mad.sequence.lhcb1.beam.npart
+    pruned_bb_dfs = {}
+    for beam, bb_df in bb_dfs.items():
+        pruned_bb_dfs[beam], report = prune_bb_df(bb_df, **bb_pruning)
+        pruned_bb_dfs[beam].attrs['pruning_report'] = report
+        generate_mad_bb_info(pruned_bb_dfs[beam], mode='from_dataframe',
+            madx_reference_bunch_num_particles=madx_reference_bunch_num_particles)
+    return pruned_bb_dfs
+
+# Elements ignored by get_bb_cache_key
+_cache_key_excluded_base_types = ('octupole',)
+# Variables read directly by generate_bb_dataframes (crab bump)
+_cache_key_globals = ['hrf400', 'lhclength']
+
+def get_bb_cache_key(mad, bb_config,
+        exclude_base_types=_cache_key_excluded_base_types,
+        exclude_variables=()):
+    '''
+    Key identifying the result of generate_bb_dataframes, obtained hashing
+    the MAD-X variables, the beam attributes, the element names and
+    positions of the sequences and the bb configuration. Changes of element
+    attributes not going through the variables are not detected.
+
+    With a Madxp handle only the variables used by the elements of the
+    sequences (directly or through other variables) are hashed, i.e. the
+    ones that can change the geometry and the optics. The elements of the
+    base types in exclude_base_types (by default the octupoles, whose
+    effect on the closed orbit and on the linear optics is neglected) and
+    the variables in exclude_variables are ignored.
+    '''
+    if isinstance(mad, Madxp):
+        graph = mad.get_variable_graph()
+        used = set(nn for nn in _cache_key_globals if nn in graph.values)
+        for seq_name in ['lhcb1', 'lhcb2']:
+            used.update(mad.get_element_parameters(seq_name,
+                    exclude_base_types=exclude_base_types))
+        used = graph.get_parameters_closure(used - set(exclude_variables))
+        variables = {nn: (str(graph.expressions[nn])
+                          if nn in graph.parameters else graph.values.get(nn))
+                     for nn in sorted(used - set(exclude_variables))}
+    else:
+        variables = {nn: mad.globals[nn] for nn in mad.globals}
+
+    beams = {}
+    sequences = {}
+    for seq_name in ['lhcb1', 'lhcb2']:
+        seq = mad.sequence[seq_name]
+        beam = seq.beam
+        beams[seq_name] = {kk: beam[kk] for kk in beam}
+        sequence_digest = hashlib.sha256()
+        sequence_digest.update('\n'.join(seq.element_names()).encode())
+        sequence_digest.update(
+                np.asarray(seq.element_positions(), dtype=float).tobytes())
+        sequences[seq_name] = sequence_digest.hexdigest()
+
+    content = json.dumps({
+        'variables': variables,
+        'beams': beams,
+        'sequences': sequences,
+        'bb_config': bb_config}, sort_keys=True, default=repr)
+
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def save_bb_dfs_to_cache(bb_dfs, cache_folder, cache_key, side_outputs=()):
+    '''
+    Store the bb dataframes in the cache, together with the files in
+    side_outputs (written by the computation, restored on a cache hit by
+    restore_side_outputs_from_cache).
+    '''
+
+    cache_folder = Path(cache_folder)
+    cache_folder.mkdir(parents=True, exist_ok=True)
+
+    # Written in a temporary folder and renamed, as several jobs can share
+    # the same cache
+    temp_folder = Path(tempfile.mkdtemp(dir=cache_folder))
+    for beam, bb_df in bb_dfs.items():
+        save_bb_df(bb_df, temp_folder / f'bb_df_{beam}.parquet')
+    if len(side_outputs) > 0:
+        (temp_folder / 'side_outputs').mkdir()
+        for ff in side_outputs:
+            shutil.copy(ff, temp_folder / 'side_outputs' / Path(ff).name)
+    try:
+        os.rename(temp_folder, cache_folder / cache_key)
+    except OSError:
+        # Already written by another job
+        shutil.rmtree(temp_folder)
+
+def load_bb_dfs_from_cache(cache_folder, cache_key):
+
+    entry = Path(cache_folder) / cache_key
+    if not entry.is_dir():
+        return None
+
+    return {beam: load_bb_df(entry / f'bb_df_{beam}.parquet')
+            for beam in ['b1', 'b2', 'b3', 'b4']}
+
+def restore_side_outputs_from_cache(cache_folder, cache_key,
+        destination_folder='.'):
+
+    side_outputs = Path(cache_folder) / cache_key / 'side_outputs'
+    if side_outputs.is_dir():
+        for ff in side_outputs.iterdir():
+            shutil.copy(ff, Path(destination_folder) / ff.name)
+
+def _complete_bb_dfs_from_cache(mad, bb_dfs, keep_dummy_lenses):
+
+    madx_reference_bunch_num_particles = mad.sequence.lhcb1.beam.npart
+    for bb_df in bb_dfs.values():
+        generate_mad_bb_info(bb_df, mode='from_dataframe',
+            madx_reference_bunch_num_particles=madx_reference_bunch_num_particles)
+
+    # Leave the sequences as they would be without cache
+    if keep_dummy_lenses:
+        for beam in ['b1', 'b2']:
+            dummy_df = bb_dfs[beam].copy()
+            generate_mad_bb_info(dummy_df, mode='dummy')
+            install_lenses_in_sequence(mad, bb_df=dummy_df,
+                sequence_name='lhc'+beam, regenerate_mad_bb_info_in_df=False)
+
+def find_bb_xma_yma(points_weak, points_strong, names=None):
+    ''' To be used in the compute_xma_yma function'''
+    pbw = _as_point_array(points_weak)
+    pbs = _as_point_array(points_strong)
 
-        # Find as the position of the strong in the lab frame (points_strong[i_bb].p) 
-        # the reference frame of the weak in the lab frame (points_weak[i_bb].sp) 
-        vbb_ws = points_strong[i_bb].p - points_weak[i_bb].sp
-        # Find separations
-        xma.append(np.dot(vbb_ws, pbw.ex))
-        yma.append(np.dot(vbb_ws, pbw.ey))
+    # Find as the position of the strong in the lab frame (points_strong.p)
+    # the reference frame of the weak in the lab frame (points_weak.sp)
+    vbb_ws = pbs.p - pbw.sp
+    xma = np.sum(vbb_ws * pbw.ex, axis=1)
+    yma = np.sum(vbb_ws * pbw.ey, axis=1)
 
     return xma, yma
 
 def compute_xma_yma(bb_df):
 
     xma, yma = find_bb_xma_yma(
-        points_weak=bb_df['self_lab_position'].values,
-        points_strong=bb_df['other_lab_position'].values,
+        points_weak=MadPointArray.from_dataframe(bb_df, 'self_lab_position'),
+        points_strong=MadPointArray.from_dataframe(bb_df, 'other_lab_position'),
         names=bb_df.index.values,
         )
 
@@ -0,0 +1,121 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from .beambeam import get_normalized_separation
+
+# Offset (in 25 ns slots) between the bunches colliding head-on at each IP:
+# bunch i of b1 collides with bunch i + offset of b2
+default_ip_bunch_offsets = {'ip1': 0, 'ip2': 891, 'ip5': 0, 'ip8': -894}
+
+def load_filling_scheme(filling_scheme_json):
+    '''
+    Read a filling scheme json file (keys 'beam1' and 'beam2', one entry
+    per 25 ns slot).
+
+    Returns:
+        A dictionary with the boolean arrays of the filled slots of 'b1'
+        and 'b2'.
+    '''
+    with open(filling_scheme_json, 'r') as fid:
+        filling = json.load(fid)
+    return {'b1': np.array(filling['beam1'], dtype=bool),
+            'b2': np.array(filling['beam2'], dtype=bool)}
+
+def get_encounter_masks(bb_df, filling_scheme, ip_bunch_offsets=None):
+    '''
+    Encounters of a bb dataframe that are active for each bunch of its beam.
+
+    Bunch i of b1 meets at the encounter with identifier k (k=0 for head-on)
+    of IP n the bunch i + offset_n + k of b2, hence bunch j of b2 meets
+    the bunch j - offset_n - k of b1.
+
+    Args:
+        bb_df: bb dataframe of any of the four beams (the column 'beam'
+            gives the filling to be used)
+        filling_scheme: dictionary with the boolean arrays of the filled
+            slots of 'b1' and 'b2' (see load_filling_scheme)
+        ip_bunch_offsets: dictionary with the head-on offset of each IP in
+            slots (default_ip_bunch_offsets if None)
+    Returns:
+        A boolean pandas DF with the filled slots of the beam as index
+        and the encounters (index of bb_df) as columns.
+    '''
+
+    if ip_bunch_offsets is None:
+        ip_bunch_offsets = default_ip_bunch_offsets
+
+    beams = np.unique(bb_df['beam'].values.astype(str))
+    if len(beams) != 1:
+        raise ValueError(f'bb_df contains several beams: {beams}')
+    beam = beams[0]
+    other_beam = {'b1': 'b2', 'b2': 'b1'}[beam]
+    sign = {'b1': 1, 'b2': -1}[beam]
+
+    self_filling = np.asarray(filling_scheme[beam], dtype=bool)
+    other_filling = np.asarray(filling_scheme[other_beam], dtype=bool)
+    n_slots = len(self_filling)
+    assert len(other_filling) == n_slots
+
+    is_lr = (bb_df['label'] == 'bb_lr').values
+    shifts = (bb_df['ip_name'].map(ip_bunch_offsets).values.astype(int)
+            + np.where(is_lr, bb_df['identifier'].values, 0))
+
+    bunches = np.flatnonzero(self_filling)
+    partners = np.mod(bunches[:, None] + sign * shifts[None, :], n_slots)
+
+    return pd.DataFrame(other_filling[partners],
+            index=pd.Index(bunches, name='bunch'), columns=bb_df.index)
+
+def get_filling_scheme_masks(bb_dfs, filling_scheme, ip_bunch_offsets=None):
+    '''
+    Encounter masks (see get_encounter_masks) for all the bb dataframes
+    in bb_dfs (e.g. as returned by generate_bb_dataframes).
+    '''
+    return {beam: get_encounter_masks(bb_df, filling_scheme,
+                                      ip_bunch_offsets=ip_bunch_offsets)
+            for beam, bb_df in bb_dfs.items()}
+
+def get_bunch_bb_df(bb_df, masks, bunch):
+    '''
+    Encounters of bb_df seen by a given bunch.
+    '''
+    return bb_df.loc[masks.loc[bunch].values]
+
+def get_bunch_equivalence_classes(masks, bb_df=None, lr_separation_cut=None):
+    '''
+    Group the bunches seeing the same set of encounters.
+
+    Args:
+        masks: encounter masks of one beam (see get_encounter_masks)
+        bb_df: bb dataframe used to build the masks (needed only with
+            lr_separation_cut)
+        lr_separation_cut: if not None, the long-range encounters with
+            normalized separation (in sigmas of the strong beam) larger than
+            this value are ignored when comparing the bunches
+    Returns:
+        A pandas DF with one row per class, indexed by the first bunch of
+        the class (representative) and with the columns 'multiplicity' and
+        'bunches' (list of the bunches in the class).
+    '''
+
+    mask_values = masks.values
+    if lr_separation_cut is not None:
+        if bb_df is None:
+            raise ValueError('bb_df is needed to apply lr_separation_cut')
+        bb_df = bb_df.loc[masks.columns]
+        relevant = ~((bb_df['label'] == 'bb_lr').values
+                     & (get_normalized_separation(bb_df) > lr_separation_cut))
+        mask_values = mask_values[:, relevant]
+
+    _, i_first, i_class, multiplicity = np.unique(mask_values, axis=0,
+            return_index=True, return_inverse=True, return_counts=True)
+    i_class = i_class.ravel()
+
+    bunches = masks.index.values
+    order = np.argsort(i_first)
+    return pd.DataFrame({
+        'multiplicity': multiplicity[order],
+        'bunches': [list(bunches[i_class == ii]) for ii in order]},
+        index=pd.Index(bunches[i_first[order]], name='representative'))
@@ -1,5 +1,7 @@
 import numpy as np
 
+from .madxp import get_table_rows
+
 class MadPoint(object):
     @classmethod
     def from_survey(cls, name, mad):
@@ -22,16 +24,11 @@ class MadPoint(object):
         self.name = name
         if use_twiss:
             twiss = mad.table.twiss
-            names = twiss.name
+            idx = get_table_rows(mad, 'twiss', [name])[0]
         if use_survey:
             survey = mad.table.survey
-            names = survey.name
-            # patch for this issue https://github.com/hibtc/cpymad/issues/91 
-            for ii, nn in enumerate(names):
-                if not nn.endswith(':1'):
-                    names[ii] = nn+':1'
-
-        idx = np.where(names == name)[0][0]
+            # patch for this issue https://github.com/hibtc/cpymad/issues/91
+            idx = get_table_rows(mad, 'survey', [name], add_suffix=True)[0]
 
         if use_twiss:
             self.tx = twiss.x[idx]
@@ -108,3 +105,209 @@ class MadPoint(object):
     def distxy(self, other):
         dd = self.p - other.p
         return np.dot(dd, self.ex), np.dot(dd, self.ey)
+
+    @classmethod
+    def _from_values(cls, name, tx, ty, tpx, tpy, sp, ex, ey, ez,
+            use_twiss=True, use_survey=True):
+        self = cls.__new__(cls)
+        self.use_twiss = use_twiss
+        self.use_survey = use_survey
+        self.name = name
+        self.tx = tx
+        self.ty = ty
+        self.tpx = tpx
+        self.tpy = tpy
+        self.sp = np.array(sp, dtype=float)
+        self.sx, self.sy, self.sz = self.sp
+        self.ex = np.array(ex, dtype=float)
+        self.ey = np.array(ey, dtype=float)
+        self.ez = np.array(ez, dtype=float)
+        self.p = self.sp + self.ex * tx + self.ey * ty
+        return self
+
+
+class MadPointArray(object):
+    '''
+    Struct-of-arrays version of MadPoint for a set of N elements.
+
+    Positions (sp, p) and frame vectors (ex, ey, ez) are stored as (N,3)
+    arrays, closed orbit (tx, ty, tpx, tpy) as (N,) arrays. The frame
+    rotations are computed in a single vectorized pass.
+    '''
+
+    _frame_columns = [f'{vv}_{cc}' for vv in ['ex', 'ey', 'ez']
+                                   for cc in ['x', 'y', 'z']]
+    columns = ['sx', 'sy', 'sz', 'tx', 'ty', 'tpx', 'tpy'] + _frame_columns
+
+    @classmethod
+    def from_survey(cls, names, mad):
+        return cls(names, mad, use_twiss=False, use_survey=True)
+
+    @classmethod
+    def from_twiss(cls, names, mad):
+        return cls(names, mad, use_twiss=True, use_survey=False)
+
+    def __init__(self, names, mad, use_twiss=True, use_survey=True):
+
+        if not (use_survey) and not (use_twiss):
+            raise ValueError(
+                "use_survey and use_twiss cannot be False at the same time"
+            )
+
+        names = np.array(names, dtype=object)
+        n_points = len(names)
+
+        if use_twiss:
+            twiss = mad.table.twiss
+            idx = get_table_rows(mad, 'twiss', names)
+        if use_survey:
+            survey = mad.table.survey
+            idx = get_table_rows(mad, 'survey', names, add_suffix=True)
+
+        if use_twiss:
+            tx = twiss.x[idx]
+            ty = twiss.y[idx]
+            tpx = twiss.px[idx]
+            tpy = twiss.py[idx]
+        else:
+            tx = ty = tpx = tpy = np.zeros(n_points)
+
+        if use_survey:
+            sp = np.array([survey.x[idx], survey.y[idx], survey.z[idx]]).T
+            theta = survey.theta[idx]
+            phi = survey.phi[idx]
+            psi = survey.psi[idx]
+        else:
+            sp = np.zeros((n_points, 3))
+            theta = phi = psi = np.zeros(n_points)
+
+        wm = _rotation_matrices(theta, phi, psi)
+
+        self._set_values(names, tx, ty, tpx, tpy, sp,
+                ex=wm[:, :, 0], ey=wm[:, :, 1], ez=wm[:, :, 2],
+                use_twiss=use_twiss, use_survey=use_survey)
+
+    @classmethod
+    def from_arrays(cls, names, tx, ty, tpx, tpy, sp, ex, ey, ez,
+            use_twiss=True, use_survey=True):
+        self = cls.__new__(cls)
+        self._set_values(np.array(names, dtype=object),
+                tx, ty, tpx, tpy, sp, ex, ey, ez,
+                use_twiss=use_twiss, use_survey=use_survey)
+        return self
+
+    @classmethod
+    def from_dataframe(cls, df, prefix):
+        '''
+        Rebuild the points from the columns written by to_columns.
+        '''
+        cc = {kk: df[f'{prefix}_{kk}'].values.astype(float)
+                for kk in cls.columns}
+        frame = {vv: np.array([cc[f'{vv}_{xx}'] for xx in 'xyz']).T
+                for vv in ['ex', 'ey', 'ez']}
+        return cls.from_arrays(df.index.values,
+                tx=cc['tx'], ty=cc['ty'], tpx=cc['tpx'], tpy=cc['tpy'],
+                sp=np.array([cc['sx'], cc['sy'], cc['sz']]).T,
+                **frame)
+
+    def _set_values(self, names, tx, ty, tpx, tpy, sp, ex, ey, ez,
+            use_twiss, use_survey):
+        self.use_twiss = use_twiss
+        self.use_survey = use_survey
+        self.name = names
+        self.tx = np.array(tx, dtype=float)
+        self.ty = np.array(ty, dtype=float)
+        self.tpx = np.array(tpx, dtype=float)
+        self.tpy = np.array(tpy, dtype=float)
+        self.sp = np.array(sp, dtype=float).reshape(-1, 3)
+        self.ex = np.array(ex, dtype=float).reshape(-1, 3)
+        self.ey = np.array(ey, dtype=float).reshape(-1, 3)
+        self.ez = np.array(ez, dtype=float).reshape(-1, 3)
+        self.p = (self.sp + self.ex * self.tx[:, None]
+                          + self.ey * self.ty[:, None])
+
+    @property
+    def sx(self):
+        return self.sp[:, 0]
+
+    @property
+    def sy(self):
+        return self.sp[:, 1]
+
+    @property
+    def sz(self):
+        return self.sp[:, 2]
+
+    def __len__(self):
+        return len(self.name)
+
+    def __getitem__(self, key):
+        if np.isscalar(key):
+            # Single point, returned as MadPoint for backward compatibility
+            return MadPoint._from_values(self.name[key],
+                    self.tx[key], self.ty[key], self.tpx[key], self.tpy[key],
+                    self.sp[key], self.ex[key], self.ey[key], self.ez[key],
+                    use_twiss=self.use_twiss, use_survey=self.use_survey)
+        return MadPointArray.from_arrays(self.name[key],
+                self.tx[key], self.ty[key], self.tpx[key], self.tpy[key],
+                self.sp[key], self.ex[key], self.ey[key], self.ez[key],
+                use_twiss=self.use_twiss, use_survey=self.use_survey)
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self[ii]
+
+    def shift_survey(self, delta):
+        # delta can be a single (3,) vector or one (N,3) shift per point
+        delta = np.asarray(delta, dtype=float)
+        self.sp -= delta
+        self.p -= delta
+
+    def dist(self, other):
+        return np.sqrt(np.sum((self.p - other.p) ** 2, axis=1))
+
+    def distxy(self, other):
+        dd = self.p - other.p
+        return np.sum(dd * self.ex, axis=1), np.sum(dd * self.ey, axis=1)
+
+    def to_columns(self, prefix):
+        '''
+        Flatten the points into a dictionary of float columns named
+        f'{prefix}_{column}' (to be stored in a DataFrame).
+        '''
+        out = {f'{prefix}_{kk}': getattr(self, kk)
+                for kk in ['sx', 'sy', 'sz', 'tx', 'ty', 'tpx', 'tpy']}
+        for vv in ['ex', 'ey', 'ez']:
+            for ii, xx in enumerate('xyz'):
+                out[f'{prefix}_{vv}_{xx}'] = getattr(self, vv)[:, ii]
+        return out
+
+
+def _rotation_matrices(theta, phi, psi):
+    '''
+    Survey rotation matrices W = Theta.Phi.Psi as a (N,3,3) array.
+    '''
+    theta = np.asarray(theta, dtype=float)
+    phi = np.asarray(phi, dtype=float)
+    psi = np.asarray(psi, dtype=float)
+    zeros = np.zeros_like(theta)
+    ones = np.ones_like(theta)
+
+    cth, sth = np.cos(theta), np.sin(theta)
+    cph, sph = np.cos(phi), np.sin(phi)
+    cps, sps = np.cos(psi), np.sin(psi)
+
+    thetam = np.array([
+        [cth, zeros, sth],
+        [zeros, ones, zeros],
+        [-sth, zeros, cth]]).transpose(2, 0, 1)
+    phim = np.array([
+        [ones, zeros, zeros],
+        [zeros, cph, sph],
+        [zeros, -sph, cph]]).transpose(2, 0, 1)
+    psim = np.array([
+        [cps, -sps, zeros],
+        [sps, cps, zeros],
+        [zeros, zeros, ones]]).transpose(2, 0, 1)
+
+    return np.matmul(thetam, np.matmul(phim, psim))
@@ -1,4 +1,8 @@
+import copy
+import functools
 import itertools
+import re
+import time
 
 import numpy as np
 import pandas as pd
@@ -6,19 +10,34 @@ import pandas as pd
 from cpymad.madx import Madx
 import cpymad
 
-def knob_df(my_knob,my_df):
+def knob_df(my_knob,my_df,knob_index=None,seq_name=None):
     '''
     Filter the pandas DF, 'my_df', returning only the rows that depend on the selected knob, 'my_knob'.
 
     Args:
         my_knob: the name of the knob to filter.
         my_df: a pandas DF (it assumes that DF has a column called "knobs").
+        knob_index: optional KnobIndex (see Madxp.get_knob_index), used to
+            select the rows without scanning the knobs.
+        seq_name: with knob_index, the sequence of the elements in my_df
+            (None if my_df is the DF of the dependent variables).
     Returns:
         The filter pandas DF showing the rows that depend on the selected knob, 'my_knob'.
 
     See madxp/examples/variablesExamples/000_run.py
     '''
-    return my_df[my_df['knobs'].apply(lambda x: my_knob in x)]
+    if knob_index is not None:
+        if seq_name is None:
+            names=knob_index.get_variables(my_knob)
+        else:
+            names=knob_index.get_elements(my_knob, seq_name)
+        rows=my_df.index.get_indexer_for(names)
+        return my_df.iloc[np.unique(rows[rows>=0])]
+
+    # Knob lists flattened once, rows selected by position
+    knobs=my_df['knobs'].reset_index(drop=True).explode()
+    rows=np.unique(knobs.index[(knobs==my_knob).values])
+    return my_df.iloc[rows]
 
 def _knobs_from_parameters(parameters, indep_df, dep_df):
     '''
@@ -46,6 +65,44 @@ def _knobs_from_parameters(parameters, indep_df, dep_df):
                 my_knobs.append([i])
     return list(itertools.chain.from_iterable(my_knobs))
 
+def _knobs_from_graph(parameters, graph):
+    '''
+    Same as _knobs_from_parameters, using a VariableGraph (sorted list
+    without repetitions).
+    '''
+    my_knobs=set()
+    for i in parameters:
+        if i in graph.parameters:
+            my_knobs |= graph.knobs[i]
+        elif i in graph.values:
+            if not graph.is_constant(i):
+                my_knobs.add(i)
+        else:
+            print(f'Variable {i} not defined! Cosidered as a knob.')
+            my_knobs.add(i)
+    return sorted(my_knobs)
+
+# MAD-X functions, not to be taken as parameters of the expressions
+_madx_functions = frozenset([
+    'sqrt', 'log', 'log10', 'exp', 'sin', 'cos', 'tan', 'asin', 'acos',
+    'atan', 'sinh', 'cosh', 'tanh', 'sinc', 'abs', 'erf', 'erfc', 'floor',
+    'ceil', 'round', 'frac', 'ranf', 'gauss', 'tgauss'])
+
+# Names (letter first) or numeric literals (digit or dot first, e.g. 1.5e-3)
+_expression_tokens = re.compile(
+        r'([A-Za-z_][\w.$]*)|[\d.](?:[\w.]|(?<=[eE])[-+])*')
+
+@functools.lru_cache(maxsize=None)
+def _parse_parameters(my_string):
+    if 'table(' in my_string:
+        return ()
+    parameters = set()
+    for match in _expression_tokens.finditer(my_string):
+        name = match.group(1)
+        if name is not None and name != 'None' and name not in _madx_functions:
+            parameters.add(name)
+    return tuple(sorted(parameters))
+
 def _extract_parameters(my_string):
     '''
     Extract all the parameters of a MAD-X expression.
@@ -55,54 +112,604 @@ def _extract_parameters(my_string):
     Returns:
         The list of the parameters present in the MAD-X expression.
     '''
-    if (type(my_string)=='NoneType' or my_string==None
-            or my_string=='None' or my_string=='[None]' or 'table(' in my_string):
+    if my_string is None:
         return []
+    return list(_parse_parameters(my_string))
+# Statements of a MAD-X input that do not modify the global variables
+_variable_assignment = re.compile(
+        r'^(?:(?:const|real|int)\s+)*([A-Za-z_][\w.$]*)\s*:?=')
+_read_only_commands = frozenset(['twiss', 'survey', 'use', 'select', 'option',
+    'show', 'value', 'print', 'printf', 'write'])
+
+def _assigned_variables(text):
+    '''
+    Global variables assigned by a MAD-X input. None if the input contains
+    other statements that can modify the variables (call, match, macros...).
+    '''
+    names = set()
+    text = re.sub(r'(!|//)[^\n]*', '', text)
+    if '{' in text:
+        return None
+    for statement in text.split(';'):
+        statement = statement.strip().lower()
+        if statement == '':
+            continue
+        match = _variable_assignment.match(statement)
+        if match is not None:
+            names.add(match.group(1))
+        elif re.split(r'[\s,]', statement, 1)[0] not in _read_only_commands:
+            return None
+    return names
+
+def _name_to_row(table_names, add_suffix=False):
+    # patch for this issue https://github.com/hibtc/cpymad/issues/91
+    if add_suffix:
+        table_names = [nn if nn.endswith(':1') else nn+':1'
+                for nn in table_names]
+    # First occurrence wins, as with np.where(...)[0][0]
+    name_to_row = {}
+    for ii, nn in enumerate(table_names):
+        name_to_row.setdefault(nn, ii)
+    return name_to_row
+
+def get_table_index(mad, table_name, add_suffix=False):
+    '''
+    Dictionary name->row of a MAD-X table.
+
+    For Madxp instances the index is built once per table evaluation and
+    cached until the next MAD-X input (e.g. a new twiss or survey).
+
+    Args:
+        mad: the MAD-X handle
+        table_name: name of the table
+        add_suffix: if True ':1' is appended to the names not having it
+            (survey tables, see https://github.com/hibtc/cpymad/issues/91)
+    Returns:
+        The dictionary name->row.
+    '''
+    if isinstance(mad, (Madxp, FrozenTables)):
+        return mad.get_table_index(table_name, add_suffix=add_suffix)
+    return _name_to_row(mad.table[table_name].name, add_suffix=add_suffix)
+
+def get_table_rows(mad, table_name, names, add_suffix=False):
+    '''
+    Rows of a MAD-X table corresponding to a list of element names.
+    '''
+    index = get_table_index(mad, table_name, add_suffix=add_suffix)
+    return np.array([index[nn] for nn in names], dtype=int)
+
+# Columns needed by each seqedit mode ('from' is optional for install)
+_seqedit_required_columns = {
+    'install': ['element', 'class', 'at'],
+    'remove': ['element'],
+    'replace': ['element', 'by'],
+    'skip': []}
+
+def _seqedit_str(values):
+    return np.asarray(values).astype(str).astype(object)
+
+def get_seqedit_input(seq_name, editing, use_sequence=True):
+    '''
+    MAD-X input performing a table of edits of a sequence in a single
+    seqedit block.
+
+    Args:
+        seq_name: name of the sequence
+        editing: dict or pandas DF with the column 'mode' (install, remove,
+            replace or skip) and the columns needed by the modes
+            (element, class, at, from, by)
+        use_sequence: if True the sequence is used before and after editing
+    Returns:
+        The MAD-X input as a string.
+    '''
+
+    editing = pd.DataFrame(editing)
+
+    unknown_modes = set(editing['mode']) - set(_seqedit_required_columns)
+    if len(unknown_modes) > 0:
+        raise ValueError(f'Unknown seqedit modes: {unknown_modes}')
+
+    for mode, columns in _seqedit_required_columns.items():
+        is_mode = (editing['mode'] == mode).values
+        if not np.any(is_mode):
+            continue
+        for cc in columns:
+            if cc not in editing.columns:
+                raise ValueError(f'Column "{cc}" is needed for {mode}')
+            if np.any(pd.isnull(editing[cc].values[is_mode])):
+                raise ValueError(f'Missing "{cc}" for {mode}')
+
+    # Sorting prior to the installation
+    if 'at' in editing.columns:
+        editing = editing.sort_values('at', kind='stable')
+
+    mode = editing['mode'].values
+    entries = np.full(len(editing), '', dtype=object)
+
+    is_install = mode == 'install'
+    if np.any(is_install):
+        install = editing[is_install]
+        install_str = ('install,element = ' + _seqedit_str(install['element'])
+                + ',class=' + _seqedit_str(install['class'])
+                + ',at = ' + _seqedit_str(install['at']))
+        if 'from' in install.columns:
+            from_location = install['from'].values
+            install_str = np.where(pd.isnull(from_location), install_str,
+                    install_str + ',from = ' + _seqedit_str(from_location))
+        entries[is_install] = install_str + ';'
+
+    is_remove = mode == 'remove'
+    if np.any(is_remove):
+        entries[is_remove] = ('remove,element = '
+                + _seqedit_str(editing['element'].values[is_remove]) + ';')
+
+    is_replace = mode == 'replace'
+    if np.any(is_replace):
+        entries[is_replace] = ('replace,element = '
+                + _seqedit_str(editing['element'].values[is_replace])
+                + ',by = ' + _seqedit_str(editing['by'].values[is_replace])
+                + ';')
+
+    elements_entry = '\n'.join(entries[mode != 'skip'])
+
+    use_str = f'use, sequence = {seq_name};' if use_sequence else ''
+    return '\n'.join([use_str,
+        f'SEQEDIT, SEQUENCE={seq_name};',
+        'FLATTEN;',
+        elements_entry,
+        'FLATTEN;',
+        'ENDEDIT;',
+        use_str])
+
+def run_seqedit(mad, seq_name, editing, use_sequence=True, verbose=False):
+    '''
+    Apply a table of edits to a sequence with a single MAD-X input (see
+    get_seqedit_input). With verbose=True the time spent in MAD-X is
+    printed.
+
+    Returns:
+        The MAD-X input as a string.
+    '''
+    mad_input = get_seqedit_input(seq_name, editing, use_sequence=use_sequence)
+    t0 = time.time()
+    mad.input(mad_input)
+    if verbose:
+        print(f'seqedit of {seq_name}: {len(editing["mode"])} edits, '
+              f'{time.time() - t0:.3f} s in MAD-X')
+    return mad_input
+
+class FrozenTable(dict):
+    '''
+    Copy of (some of) the columns of a MAD-X table, with attribute access
+    to the columns and to the summary (if any) as for cpymad tables.
+    '''
+
+    def __init__(self, table, columns=None, summary=None):
+        if columns is None:
+            columns = list(table)
+        super().__init__({cc: np.array(table[cc]) for cc in columns})
+        self.summary = summary
+
+    @classmethod
+    def from_mad(cls, mad, table_name, columns=None):
+        table = mad.table[table_name]
+        try:
+            summary = FrozenTable(table.summary)
+        except Exception:
+            summary = None
+        return cls(table, columns=columns, summary=summary)
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+class FrozenTables:
+    '''
+    Set of frozen MAD-X tables that can be used in place of the MAD-X handle
+    by the functions only reading tables (mad.table.<name>, get_table_rows).
+    '''
+
+    def __init__(self, **tables):
+        self.table = FrozenTable({}, columns=[])
+        self.table.update(tables)
+        self._table_index_cache = {}
+
+    def get_table_index(self, table_name, add_suffix=False):
+        key = (table_name, add_suffix)
+        if key not in self._table_index_cache:
+            self._table_index_cache[key] = _name_to_row(
+                    self.table[table_name].name, add_suffix=add_suffix)
+        return self._table_index_cache[key]
+
+class LazyTable:
+    '''
+    DataFrame-like view of some rows of a MAD-X table (see
+    Madxp.get_twiss_df). The columns are read from MAD-X at the first access
+    and then kept: the view has to be used before the table is recomputed.
+    '''
+
+    def __init__(self, table, row_indices):
+        self._table = table
+        self._row_indices = row_indices
+        self._cache = {}
+        self.index = pd.Index(self._get_column('name'), name='')
+        self._name_to_row = _name_to_row(self.index)
+
+    def _get_column(self, column):
+        column = column.lower()
+        if column not in self._cache:
+            if column not in self.columns:
+                raise KeyError(column)
+            self._cache[column] = self._table.column(column,
+                                                     rows=self._row_indices)
+        return self._cache[column]
+
+    @property
+    def columns(self):
+        return pd.Index(self._table.col_names())
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return pd.Series(self._get_column(key), index=self.index,
+                             name=key)
+        return self.to_df(columns=key)
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except (KeyError, ValueError):
+            raise AttributeError(key)
+
+    @property
+    def loc(self):
+        return _LazyTableLocator(self)
+
+    def to_df(self, columns=None):
+        '''
+        pandas DF with the given columns (all if None).
+        '''
+        if columns is None:
+            columns = self.columns
+        return pd.DataFrame({cc: self._get_column(cc) for cc in columns},
+                            index=self.index)
+
+class _LazyTableLocator:
+    # loc[name] reads a single row, loc[name, column] a single column
+    def __init__(self, lazy_table):
+        self._lazy_table = lazy_table
+
+    def __getitem__(self, key):
+        tt = self._lazy_table
+        if isinstance(key, str):
+            row = tt._table.row(int(tt._row_indices[tt._name_to_row[key]]))
+            return pd.Series(dict(row), name=key)
+        if (isinstance(key, tuple) and len(key) == 2
+                and isinstance(key[0], str) and isinstance(key[1], str)):
+            return tt._get_column(key[1])[tt._name_to_row[key[0]]]
+        return tt.to_df().loc[key]
+
+_volatile_expression = re.compile(r'table\(|->|\b(?:ranf|gauss|tgauss)\b')
+
+def _deferred_expression(expr):
+    # Expression string of a variable, None if it is a plain value
+    if isinstance(expr, str):
+        return expr
+    return getattr(expr, 'expr', None)
+
+class VariableGraph:
+    '''
+    Dependency graph of the MAD-X global variables, built from a single
+    pass on the globals.
+
+    The dependent variables are the ones defined by an expression with at
+    least one parameter. For each of them the graph stores the parameters
+    (forward adjacency), for each variable the dependent variables using it
+    (reverse adjacency), a topological order of the dependent variables and
+    their knobs, i.e. the non-constant independent variables they depend
+    on, through any number of levels.
+
+    A graph is a snapshot of the variables: Madxp keeps the last one and
+    refreshes only the variables written since (see VariableGraph.refresh),
+    diff_variable_snapshots compares two of them.
+    '''
+
+    def __init__(self, expressions, values, var_types):
+        '''
+        Args:
+            expressions: dictionary name -> MAD-X expression (as returned
+                by _libmadx.get_var) of the global variables
+            values: dictionary name -> value of the global variables
+            var_types: dictionary name -> MAD-X variable type (0 for the
+                constants)
+        '''
+        self.expressions = expressions
+        self.values = values
+        self.var_types = var_types
+
+        self.parameters = {}
+        for nn, expr in expressions.items():
+            aux = _extract_parameters(str(expr))
+            if aux != []:
+                self.parameters[nn] = sorted(set(aux))
+
+        self.dependents = {}
+        for nn, params in self.parameters.items():
+            for pp in params:
+                self.dependents.setdefault(pp, []).append(nn)
+
+        self.order = self._topological_order()
+        self.knobs = self._knob_closure()
+
+        # Values that can change without any assignment (tables, element
+        # attributes, random numbers), read again at each refresh
+        self.volatile = set(nn for nn, expr in expressions.items()
+                            if _volatile_expression.search(str(expr)))
+
+    @classmethod
+    def from_mad(cls, mad):
+        expressions = {}
+        values = {}
+        var_types = {}
+        for nn in list(mad.globals):
+            expressions[nn] = mad._libmadx.get_var(nn)
+            values[nn] = mad.globals[nn]
+            var_types[nn] = mad._libmadx.get_var_type(nn)
+        return cls(expressions, values, var_types)
+
+    def refresh(self, mad, names):
+        '''
+        New snapshot in which only the given variables, the volatile ones and
+        the ones depending on them are read again from MAD-X.
+        '''
+        expressions = self.expressions.copy()
+        values = self.values.copy()
+        var_types = self.var_types.copy()
+
+        structure_changed = False
+        for nn in names:
+            expr = mad._libmadx.get_var(nn)
+            var_type = mad._libmadx.get_var_type(nn)
+            # A new value of an independent variable keeps the structure
+            if (nn not in expressions or var_type != var_types[nn]
+                    or _deferred_expression(expr)
+                        != _deferred_expression(expressions[nn])):
+                structure_changed = True
+            expressions[nn] = expr
+            var_types[nn] = var_type
+
+        if structure_changed:
+            graph = VariableGraph(expressions, values, var_types)
+        else:
+            graph = copy.copy(self)
+            graph.expressions = expressions
+            graph.values = values
+            graph.var_types = var_types
+
+        to_update = set(names) | graph.volatile
+        for nn in list(to_update):
+            to_update |= graph.get_dependents(nn)
+        for nn in to_update:
+            values[nn] = mad.globals[nn]
+        return graph
+
+    def is_constant(self, name):
+        return self.var_types.get(name) == 0
+
+    def _topological_order(self):
+        # Kahn's algorithm on the dependent variables
+        n_dep_parameters = {nn: sum(pp in self.parameters for pp in params)
+                            for nn, params in self.parameters.items()}
+        ready = [nn for nn, cc in n_dep_parameters.items() if cc == 0]
+        order = []
+        while ready:
+            nn = ready.pop()
+            order.append(nn)
+            for dd in self.dependents.get(nn, []):
+                n_dep_parameters[dd] -= 1
+                if n_dep_parameters[dd] == 0:
+                    ready.append(dd)
+        if len(order) < len(self.parameters):
+            cyclic = set(self.parameters) - set(order)
+            print(f'Circular dependencies for {sorted(cyclic)}!')
+            order += sorted(cyclic)
+        return order
+
+    def _knob_closure(self):
+        knobs = {}
+        # Inverted index knob -> dependent variables
+        self.knob_variables = {}
+        for nn in self.order:
+            my_knobs = set()
+            for pp in self.parameters[nn]:
+                if pp in self.parameters:
+                    my_knobs |= knobs.get(pp, set())
+                elif not self.is_constant(pp):
+                    my_knobs.add(pp)
+            knobs[nn] = my_knobs
+            for kk in my_knobs:
+                self.knob_variables.setdefault(kk, set()).add(nn)
+        return knobs
+
+    def get_dependents(self, name):
+        '''
+        All the dependent variables affected by a variable (transitive).
+        '''
+        found = set()
+        to_visit = [name]
+        while to_visit:
+            for dd in self.dependents.get(to_visit.pop(), []):
+                if dd not in found:
+                    found.add(dd)
+                    to_visit.append(dd)
+        return found
+
+    def get_parameters_closure(self, names):
+        '''
+        The given variables and all the variables they depend on
+        (transitive).
+        '''
+        found = set()
+        to_visit = list(names)
+        while to_visit:
+            nn = to_visit.pop()
+            if nn not in found:
+                found.add(nn)
+                to_visit.extend(self.parameters.get(nn, []))
+        return found
+
+    def dependent_variables_df(self):
+        my_dict = {}
+        for nn in self.parameters:
+            my_dict[nn] = {
+                'value': self.values[nn],
+                'expression': self.expressions[nn],
+                'parameters': self.parameters[nn],
+                'knobs': sorted(self.knobs[nn])}
+        if len(my_dict)>0:
+            return pd.DataFrame(my_dict).transpose()[['value','expression','parameters','knobs']].sort_index()
+        else:
+            return pd.DataFrame()
+
+    def independent_variables_df(self):
+        my_dict = {}
+        for nn in self.values:
+            if nn not in self.parameters:
+                my_dict[nn] = {'value': self.values[nn],
+                               'constant': self.is_constant(nn)}
+        return pd.DataFrame(my_dict).transpose()[['value','constant']].sort_index()
+
+def diff_variable_snapshots(snapshot_a, snapshot_b):
+    '''
+    Variables differing (in value or expression) between two snapshots
+    (VariableGraph, e.g. from Madxp.get_variable_graph at two stages).
+
+    Returns:
+        A pandas DF indexed by the variable names with the columns
+        'value_a', 'value_b', 'expression_a', 'expression_b' (None for the
+        variables missing in one of the snapshots) and 'knob' (non-constant
+        independent variable in snapshot_b).
+    '''
+    my_dict = {}
+    for nn in set(snapshot_a.values) | set(snapshot_b.values):
+        value_a = snapshot_a.values.get(nn)
+        value_b = snapshot_b.values.get(nn)
+        expr_a = snapshot_a.expressions.get(nn)
+        expr_b = snapshot_b.expressions.get(nn)
+        if value_a != value_b or str(expr_a) != str(expr_b):
+            my_dict[nn] = {'value_a': value_a, 'value_b': value_b,
+                'expression_a': None if expr_a is None else str(expr_a),
+                'expression_b': None if expr_b is None else str(expr_b),
+                'knob': (nn in snapshot_b.values
+                         and nn not in snapshot_b.parameters
+                         and not snapshot_b.is_constant(nn))}
+    columns = ['value_a', 'value_b', 'expression_a', 'expression_b', 'knob']
+    if len(my_dict)>0:
+        return pd.DataFrame(my_dict).transpose()[columns].sort_index()
     else:
-        for i in [
-        '*','->','-','/','+','^','(',')','[',']',',','\'','None']:
-            my_string=my_string.replace(i,' ')
-        my_list=my_string.split(' ')
-        my_list=list(np.unique(my_list))
-        if '' in my_list:
-            my_list.remove('')
-        if type(my_list)=='NoneType':
-            my_list=[]
-        for i in my_list.copy():
-            if i.isdigit() or i[0].isdigit() or i[0]=='.':
-                my_list.remove(i)
-        my_list=list(set(my_list)-
-        set([
-            'sqrt',
-            'log',
-            'log10',
-            'exp',
-            'sin',
-            'cos',
-            'tan',
-            'asin',
-            'acos',
-            'atan',
-            'sinh',
-            'cosh',
-            'tanh',
-            'sinc',
-            'abs',
-            'erf',
-            'erfc',
-            'floor',
-            'ceil',
-            'round',
-            'frac',
-            'ranf',
-            'gauss',
-            'tgauss']))
-        return my_list
+        return pd.DataFrame(columns=columns)
+
+class KnobIndex:
+    '''
+    Inverted index from the knobs to the dependent variables and to the
+    sequence elements they control, built from a VariableGraph and from
+    sequence DFs (as given by Madxp.get_sequence_df).
+    '''
+
+    def __init__(self, graph, sequence_dfs=None, sequence_elements=None):
+        '''
+        Args:
+            graph: the VariableGraph
+            sequence_dfs: dictionary sequence -> sequence DF
+            sequence_elements: dictionary sequence -> knob -> elements,
+                already indexed (see Madxp.get_knob_index)
+        '''
+        self.graph = graph
+        self.variables = graph.knob_variables
+        self.sequence_elements = dict(sequence_elements or {})
+        if sequence_dfs is not None:
+            for seq_name, seq_df in sequence_dfs.items():
+                self.add_sequence_df(seq_name, seq_df)
+
+    @staticmethod
+    def index_elements(element_knobs):
+        '''
+        Dictionary knob -> elements from (element, knobs) pairs.
+        '''
+        elements = {}
+        for element, knobs in element_knobs:
+            for kk in knobs:
+                elements.setdefault(kk, []).append(element)
+        return elements
+
+    def add_sequence_df(self, seq_name, seq_df):
+        self.sequence_elements[seq_name] = self.index_elements(
+                zip(seq_df.index, seq_df['knobs']))
+
+    def get_variables(self, knob):
+        '''
+        Dependent variables controlled by a knob.
+        '''
+        return sorted(self.variables.get(knob, set()))
+
+    def get_elements(self, knob, seq_name=None):
+        '''
+        Elements controlled by a knob, as a dictionary sequence -> list of
+        elements (or as a list if seq_name is given).
+        '''
+        if seq_name is not None:
+            return list(self.sequence_elements.get(seq_name, {}).get(knob, []))
+        return {ss: list(ee[knob]) for ss, ee in self.sequence_elements.items()
+                if knob in ee}
 
 
 class Madxp(Madx):
     pass
 
+    def input(self, text):
+        # Any input can regenerate the tables (twiss, survey, use, call...)
+        self._table_index_cache = {}
+        # All the writes to the globals (globals[...] =, commands) pass here
+        names = _assigned_variables(text)
+        if names is None or len(names) > 0:
+            self._model_version = self.model_version + 1
+        dirty = self.__dict__.get('_dirty_variables')
+        if dirty is not None:
+            if names is None:
+                self._dirty_variables = None
+            else:
+                dirty.update(names)
+        if names is None:
+            # Elements and sequences can have been edited
+            self._element_index_cache = {}
+        return super().input(text)
+
+    @property
+    def model_version(self):
+        '''
+        Counter of the inputs that can have modified the model (variables,
+        elements, sequences, beams...). Read-only commands (twiss, survey,
+        use, select...) do not increase it.
+        '''
+        return self.__dict__.get('_model_version', 0)
+
+    def get_table_index(self, table_name, add_suffix=False):
+        '''
+        Cached dictionary name->row of a MAD-X table (see get_table_index).
+        '''
+        cache = self.__dict__.setdefault('_table_index_cache', {})
+        key = (table_name, add_suffix)
+        if key not in cache:
+            cache[key] = _name_to_row(self.table[table_name].name,
+                    add_suffix=add_suffix)
+        return cache[key]
+
     def set_variables_from_dict(self, params):
         for nn in params.keys():
             self.input(f'{nn}={params[nn]};')
@@ -150,17 +757,108 @@ class Madxp(Madx):
         else:
             return pd.DataFrame()
 
+    def get_variable_graph(self):
+        '''
+        Dependency graph of the global variables (see VariableGraph).
+
+        The last graph is kept as a snapshot: only the variables assigned
+        through input since then are read again from MAD-X (any other
+        statement, e.g. a call, triggers a full reload).
+        '''
+        graph = self.__dict__.get('_variable_graph')
+        dirty = self.__dict__.get('_dirty_variables')
+        if graph is None or dirty is None:
+            graph = VariableGraph.from_mad(self)
+        else:
+            graph = graph.refresh(self, dirty)
+        self._variable_graph = graph
+        self._dirty_variables = set()
+        return graph
+
+    def invalidate_variables(self):
+        '''
+        Force a full reload of the variables at the next request (e.g. after
+        writing them directly through _libmadx).
+        '''
+        self._dirty_variables = None
+        self._element_index_cache = {}
+
+    def get_knob_index(self, sequence_names=(), graph=None):
+        '''
+        Inverted index knob -> variables -> elements (see KnobIndex) for the
+        global variables and the elements of the given sequences.
+
+        The parameters of the elements are kept until an input other than
+        variable assignments (as for get_variable_graph), the elements of
+        each knob until the structure of the variable graph changes.
+        '''
+        if graph is None:
+            graph = self.get_variable_graph()
+        sequence_elements = {}
+        for nn in sequence_names:
+            entry = self._get_element_index_entry(nn)
+            # Graphs with the same structure share the knobs
+            if entry['knobs'] is not graph.knobs:
+                entry['elements'] = KnobIndex.index_elements(
+                    (ee, _knobs_from_graph(pp, graph))
+                    for ee, _, pp in entry['parameters'])
+                entry['knobs'] = graph.knobs
+            sequence_elements[nn] = entry['elements']
+        return KnobIndex(graph, sequence_elements=sequence_elements)
+
+    def get_element_parameters(self, sequenceName, exclude_base_types=()):
+        '''
+        Variables used by the deferred attributes of the elements of a
+        sequence, kept as get_knob_index does.
+
+        Args:
+            sequenceName: the sequence name
+            exclude_base_types: base types of the elements to be ignored
+        Returns:
+            The sorted list of the variables.
+        '''
+        parameters = set()
+        for _, base_type, pp in self._get_element_index_entry(
+                sequenceName)['parameters']:
+            if base_type not in exclude_base_types:
+                parameters.update(pp)
+        return sorted(parameters)
+
+    def _get_element_index_entry(self, sequenceName):
+        cache = self.__dict__.setdefault('_element_index_cache', {})
+        entry = cache.get(sequenceName)
+        if entry is None:
+            entry = {'parameters': self._get_element_parameters(sequenceName),
+                     'knobs': None}
+            cache[sequenceName] = entry
+        return entry
+
+    def _get_element_parameters(self, sequenceName):
+        # List of (element, base type, parameters of its deferred attributes)
+        element_parameters = []
+        for my_index in range(self._libmadx.get_element_count(sequenceName)):
+            aux = self._libmadx.get_element(sequenceName, my_index)
+            parameters = []
+            for vv in aux['data'].values():
+                if isinstance(vv, cpymad.types.Parameter):
+                    parameters += _extract_parameters(str(vv.expr))
+            element_parameters.append(
+                    (aux['name'], aux['base_type'], np.unique(parameters)))
+        return element_parameters
+
     def get_variables_dicts(self, expressions_as_str=True):
-        variables_df = self.get_variables_dataframes()
-        outp = {
-            'constants': variables_df['constants'].to_dict()['value'],
-            'independent_variables':
-                variables_df['independent_variables'].to_dict()['value'],
-            'dependent_variables_expr':
-                variables_df['dependent_variables'].to_dict()['expression'],
-            'dependent_variables_val':
-                variables_df['dependent_variables'].to_dict()['value'],
-            }
+        # Directly from the snapshot, same content as get_variables_dataframes
+        graph = self.get_variable_graph()
+        outp = {'constants': {}, 'independent_variables': {},
+                'dependent_variables_expr': {}, 'dependent_variables_val': {}}
+        for nn in sorted(graph.values):
+            if nn in graph.parameters:
+                outp['dependent_variables_expr'][nn] = str(graph.expressions[nn])
+                outp['dependent_variables_val'][nn] = graph.values[nn]
+            elif graph.is_constant(nn):
+                outp['constants'][nn] = graph.values[nn]
+            else:
+                outp['independent_variables'][nn] = graph.values[nn]
 
         outp['all_variables_val'] = {kk:outp['constants'][kk] for
                 kk in outp['constants'].keys()}
@@ -188,15 +886,16 @@ class Madxp(Madx):
               whereas the 'knobs' are only independent variables.
         '''
         my_dict={}
-        aux=self._independent_variables_df()
-        import numpy as np
+        # A single pass on the MAD-X globals
+        graph=self.get_variable_graph()
+        aux=self._independent_variables_df(graph)
         independent_variables_df=aux[np.logical_not(aux['constant'])].copy()
         del independent_variables_df['constant']
         constant_df=aux[aux['constant']].copy()
         del constant_df['constant']
         my_dict['constants']=constant_df
         my_dict['independent_variables']=independent_variables_df
-        my_dict['dependent_variables']=self._dependent_variables_df()
+        my_dict['dependent_variables']=self._dependent_variables_df(graph)
 
         if expressions_as_str:
             my_dict['dependent_variables']['expression'] = (
@@ -204,7 +903,7 @@ class Madxp(Madx):
                          str))
         return my_dict
 
-    def _dependent_variables_df(self):
+    def _dependent_variables_df(self, graph=None):
         '''
         Extract the pandas DF with the dependent variables of the MAD-X handle.
 
@@ -218,41 +917,11 @@ class Madxp(Madx):
 
         See madxp/examples/variablesExamples/000_run.py
         '''
-        my_dict={}
-        for i in list(self.globals):
-            aux=_extract_parameters(str(self._libmadx.get_var(i)))
-            if aux!=[]:
-                my_dict[i]={}
-                my_dict[i]['parameters']=list(np.unique(aux))
-
-        myhash=hash(str(my_dict))
-        while True:
-            for i in my_dict:
-                aux=[]
-                for j in my_dict[i]['parameters']:
-                    try:
-                        aux=aux+my_dict[j]['parameters']
-                    except:
-                        aux=aux+[j]
-                my_dict[i]['knobs']=list(np.unique(aux))
-            if myhash==hash(str(my_dict)):
-                break
-            else:
-                myhash=hash(str(my_dict))
-
-        for i in my_dict:
-            for j in my_dict[i]['knobs'].copy():
-                if self._libmadx.get_var_type(j)==0:
-                    my_dict[i]['knobs'].remove(j)
-            my_dict[i]['expression']=self._libmadx.get_var(i)
-            my_dict[i]['value']=self.globals[i]
+        if graph is None:
+            graph = self.get_variable_graph()
+        return graph.dependent_variables_df()
 
-        if len(my_dict)>0:
-            return pd.DataFrame(my_dict).transpose()[['value','expression','parameters','knobs']].sort_index()
-        else:
-            return pd.DataFrame()
-
-    def _independent_variables_df(self):
+    def _independent_variables_df(self, graph=None):
         '''
         Extract the pandas DF with the independent variables of the MAD-X handle.
 
@@ -263,46 +932,38 @@ class Madxp(Madx):
 
         See madxp/examples/variablesExamples/000_run.py
         '''
-
-        dep_df=self._dependent_variables_df()
-        #if len(dep_df)>0:
-        #    aux=list(dep_df['knobs'].values)
-        #    aux=list(itertools.chain.from_iterable(aux))
-        #fundamentalSet=set(np.unique(aux))
-        independent_variable_set=set(self.globals)-set(dep_df.index)
-        my_dict={}
-        for i in independent_variable_set:
-            my_dict[i]={}
-            if self._libmadx.get_var_type(i)==0:
-                my_dict[i]['constant']=True
-                # my_dict[i]['knob']=False
-            else:
-                my_dict[i]['constant']=False
-                # if i in fundamentalSet:
-                #    my_dict[i]['knob']=True
-                # else:
-                #    my_dict[i]['knob']=False
-            my_dict[i]['value']=self.globals[i]
-
-        return pd.DataFrame(my_dict).transpose()[['value','constant']].sort_index()
+        if graph is None:
+            graph = self.get_variable_graph()
+        return graph.independent_variables_df()
 
 
-    def get_sequence_df(self,sequenceName):
+    def get_sequence_df(self,sequenceName,graph=None,columnar=False,columns=None):
         '''
         Extract a pandas DF of the list of the elements and all their attributes for a given sequence.
 
         Args:
             sequenceName: the sequence name
+            graph: VariableGraph of the variables (built if None)
+            columnar: if True, the attributes are extracted in typed
+                columns (see _get_sequence_columnar_df), without the
+                parameters and knobs of the elements
+            columns: list of the attributes to be extracted in columnar mode
+                (all if None)
         Returns:
             The list of knobs corresponding to the list of parameters.
 
         See madxp/examples/variablesExamples/000_run.py
         '''
+        if columnar:
+            return self._get_sequence_columnar_df(sequenceName, columns)
+        elif columns is not None:
+            raise ValueError('columns can be selected only in columnar mode')
+
         my_list=[]
         sequences=self.sequence
         my_sequence=sequences[sequenceName]
-        indep_df=self._independent_variables_df()
-        dep_df=self._dependent_variables_df()
+        if graph is None:
+            graph=self.get_variable_graph()
 
         for my_index, _ in enumerate(my_sequence.elements):
             aux=self._libmadx.get_element(sequenceName,my_index)
@@ -322,18 +983,114 @@ class Madxp(Madx):
         my_df=pd.DataFrame(my_list)
         my_df=my_df.set_index('name')
         my_df.index.name=''
-        my_df['knobs']=my_df['parameters'].apply(lambda x: _knobs_from_parameters(x,indep_df,dep_df))
+        my_df['knobs']=my_df['parameters'].apply(lambda x: _knobs_from_graph(x,graph))
         first_columns=['position','parent','base_type','length','parameters','knobs']
         last_columns=list(set(my_df.columns)-set(first_columns))
         last_columns.sort()
         return my_df[first_columns+last_columns]
 
-    def get_twiss_df(self, table_name):
+    def _get_sequence_columnar_df(self, sequenceName, columns=None):
+        '''
+        Sequence DF with one typed column per attribute: '<attr>' has the
+        values (float, or object for strings and arrays) and '<attr> expr'
+        the MAD-X expressions (None where the attribute is not deferred).
+        The elements are grouped by base type (same attributes) and each
+        column is filled as a numpy array. As in get_sequence_df, an
+        attribute with the name of a field of the nodes (e.g. chkick of the
+        kickers) replaces the field for the elements having it.
+        '''
+        n_elements = self._libmadx.get_element_count(sequenceName)
+        element_info = {}
+        groups = {}
+        for ii in range(n_elements):
+            aux = self._libmadx.get_element(sequenceName, ii)
+            for kk in aux:
+                if kk != 'data':
+                    element_info.setdefault(kk, []).append(aux[kk])
+            group = groups.setdefault(aux['base_type'],
+                    {'rows': [], 'attributes': {}})
+            i_group = len(group['rows'])
+            group['rows'].append(ii)
+            for kk, par in aux['data'].items():
+                if columns is not None and kk not in columns:
+                    continue
+                if isinstance(par, cpymad.types.Parameter):
+                    value, expr = par.value, par.expr
+                    # Written as in get_sequence_df (for the arrays, the
+                    # values where the components are not deferred)
+                    deferred = (any(expr) if isinstance(expr, list)
+                                else bool(expr))
+                    expr = str(par) if deferred else None
+                else:
+                    value, expr = par, None
+                group['attributes'].setdefault(kk, []).append(
+                        (i_group, value, expr))
+
+        group_dfs = []
+        for group in groups.values():
+            n_group = len(group['rows'])
+            group_columns = {}
+            for kk, entries in group['attributes'].items():
+                i_rows, values, exprs = zip(*entries)
+                i_rows = np.array(i_rows, dtype=int)
+                if all(isinstance(vv, (bool, int, float)) for vv in values):
+                    col = np.full(n_group, np.nan)
+                    col[i_rows] = values
+                else:
+                    col = np.full(n_group, None, dtype=object)
+                    col[i_rows] = values
+                group_columns[kk] = col
+                if any(ee is not None for ee in exprs):
+                    col_expr = np.full(n_group, None, dtype=object)
+                    col_expr[i_rows] = exprs
+                    group_columns[kk+' expr'] = col_expr
+            group_dfs.append(pd.DataFrame(group_columns,
+                    index=np.array(group['rows'], dtype=int)))
+        attributes_df = pd.concat(group_dfs).sort_index()
+
+        my_df = pd.DataFrame({kk: np.array(vv) for kk, vv
+                              in element_info.items()})
+        for kk in set(my_df.columns) & set(attributes_df.columns):
+            attributes_df[kk] = attributes_df[kk].where(
+                    attributes_df[kk].notna(), my_df[kk].values)
+            my_df = my_df.drop(columns=kk)
+        first_columns = ['position','parent','base_type','length']
+        first_columns += sorted(set(my_df.columns) - set(first_columns)
+                                - set(['name']))
+        last_columns = sorted(attributes_df.columns)
+        my_df = pd.concat([my_df[first_columns],
+                           attributes_df.reset_index(drop=True)[last_columns]],
+                          axis=1)
+        my_df.index = pd.Index(element_info['name'], name='')
+        return my_df
+
+    def save_sequence_df(self, sequenceName, filename, columns=None):
+        '''
+        Write the columnar sequence DF (see get_sequence_df) to a parquet
+        file, with the names and the expressions dictionary-encoded
+        (categorical columns).
+        '''
+        my_df = self.get_sequence_df(sequenceName, columnar=True,
+                                     columns=columns)
+        my_df = my_df.rename_axis('name').reset_index()
+        for cc in my_df.columns:
+            if (cc in ['name', 'parent', 'base_type']
+                    or cc.endswith(' expr')):
+                my_df[cc] = my_df[cc].astype('category')
+        my_df.to_parquet(filename)
+
+    def get_twiss_df(self, table_name, columns=None, rows=None, lazy=False):
         '''
         Extract the pandas DF of a MAD-X table.
 
         Args:
             table_name: Name of the table
+            columns: list of the columns to be extracted (all if None)
+            rows: rows to be extracted (all if None), as a regular
+                expression searched in the names, a slice or range of
+                indices, or an array of indices or booleans
+            lazy: if True, a LazyTable reading the columns only when
+                accessed is returned (columns is then ignored)
 
         Returns:
             The pandas DF of a MAD-X table.
@@ -341,11 +1098,35 @@ class Madxp(Madx):
         See madxp/examples/variablesExamples/000_run.py
         '''
         table = self.table[table_name]
-        my_df=pd.DataFrame(dict(table))
+        if columns is None and rows is None and not lazy:
+            my_df=pd.DataFrame(dict(table))
+        else:
+            # Only the selected rows are transferred, as numpy arrays
+            row_indices = self._get_table_row_indices(table_name, rows)
+            if lazy:
+                return LazyTable(table, row_indices)
+            if columns is None:
+                columns = table.col_names()
+            my_df=pd.DataFrame({cc: table.column(cc, rows=row_indices)
+                for cc in ['name'] + [cc for cc in columns if cc != 'name']})
         my_df=my_df.set_index('name', drop = False)
         my_df.index.name=''
         return my_df
 
+    def _get_table_row_indices(self, table_name, rows):
+        if rows is None:
+            rows = slice(None)
+        if isinstance(rows, str):
+            names = pd.Series(self.table[table_name].column('name'))
+            return np.flatnonzero(names.str.contains(rows, regex=True).values)
+        if isinstance(rows, slice):
+            n_rows = self._libmadx.get_table_row_count(table_name)
+            return np.arange(n_rows)[rows]
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            return np.flatnonzero(rows)
+        return rows.astype(int)
+
     def get_summ_df(self, table_name):
         '''
         Extract the pandas DF of a MAD-X summary table.
@@ -3,13 +3,13 @@ import pickle
 import json
 
 import numpy as np
-import pandas as pd
 
 import xtrack as xt
 import xpart as xp
 import xfields as xf
 
 from . import beambeam as bb
+from .madxp import get_seqedit_input, run_seqedit
 
 class JEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -549,7 +549,7 @@ def _restore_beam_beam(line):
 
 
 
-def seqedit(mad,seq_name,editing,madInput = True):
+def seqedit(mad,seq_name,editing,madInput = True,verbose = False):
     """Wrapper for MADX seqedit function
 
     -> editing: dict or pd.DataFrame,
@@ -557,48 +557,11 @@ def seqedit(mad,seq_name,editing,madInput = True):
         other columns need to be specified depending on the chosen mode, based on the parameters from the MADX user guide.
     -> madInput: bool,
         used to skip the mad.input() call and simply return the string
+    -> verbose: bool,
+        used to print the time spent in MAD-X
     """
-    
-    # Converting to pd.DataFrame
-    if type(editing) is dict:
-        editing = pd.DataFrame(editing)
-    
-    # SORTING prior to the installation
-    if 'at' in list(editing.columns):
-        editing.sort_values('at',inplace=True)
-    
-    
-    # ELEMENTS
-    def installStr(row):
-        return f'{row["mode"]},element = {row["element"]},class={row["class"]},at = {row["at"]},from = {row["from"]};'
-
-    def removeStr(row):
-        return f'{row["mode"]},element = {row["element"]};' 
-    
-    def replaceStr(row):
-        return f'{row["mode"]},element = {row["element"]},by = {row["by"]};' 
-    
-    def skipStr(row):
-        return ''
-
-    entryStr = {'install':installStr,'remove':removeStr,'replace':replaceStr,'skip':skipStr}
-    elementsEntry = '\n'.join(filter(None, [entryStr[row['mode']](row) for _,row in editing.iterrows()]))
-    
-    
-    # Generating MADX call
-    output = f'''
-        use, sequence = {seq_name};
-        SEQEDIT, SEQUENCE={seq_name};
-            FLATTEN;
-            {elementsEntry}
-            FLATTEN;
-        ENDEDIT;
-
-        use, sequence = {seq_name};
-    '''
-
-    
-    # Sending input to mad and returning it as a string
+
+    # Validated and sent to MAD-X as a single block
     if madInput:
-        mad.input(output)
-    return output
+        return run_seqedit(mad, seq_name, editing, verbose=verbose)
+    return get_seqedit_input(seq_name, editing)
@@ -81,15 +81,6 @@ ALIGN_RECIPE = {'b1':  {'bbcwe': """{xma} :=      {x_b}+{rw} ; {yma} := {y_b}
 #=====================================================
 def install_wires(mad,configuration,seq_name):
     
-    # installing monitors if not in seq_name:
-    if configuration['wires_at_fallback']:
-        to_install = pd.DataFrame(WIRE_INSTALL_FALLBACK[seq_name[-2:]],columns=['element','at','from'])
-        to_install.insert(0,'mode','install')
-        to_install.insert(2,'class','monitor')
-        
-        pmTools.seqedit(mad,seq_name=seq_name,editing = to_install)
-    
-    
     WIRE_LENGTH = configuration['wires_L']
     
     # Extracting information for each wire
@@ -123,14 +114,21 @@ def install_wires(mad,configuration,seq_name):
     # DEFINITION FOR INSTALLATION
     madInput += ';\n'.join(wires_def) + ';\n'
 
-    # SEQEDIT FOR INSTALLATION
-    madInput += pmTools.seqedit(mad,
-                                madInput = False,
-                                seq_name = seq_name,
-                                editing  = {'mode'      : 'replace',
-                                            'element'   : WIRE_MARKERS[seq_name[-2:]],
-                                            'by'        : [_def.split(':')[0] for _def in wires_def]})
     mad.input(madInput)
+
+    # SEQEDIT FOR INSTALLATION (single block)
+    editing = pd.DataFrame({'mode'      : 'replace',
+                            'element'   : WIRE_MARKERS[seq_name[-2:]],
+                            'by'        : [_def.split(':')[0].strip() for _def in wires_def]})
+
+    # installing monitors if not in seq_name:
+    if configuration['wires_at_fallback']:
+        to_install = pd.DataFrame(WIRE_INSTALL_FALLBACK[seq_name[-2:]],columns=['element','at','from'])
+        to_install.insert(0,'mode','install')
+        to_install.insert(2,'class','monitor')
+        editing = pd.concat([to_install, editing], ignore_index=True)
+
+    pmTools.seqedit(mad,seq_name=seq_name,editing = editing)
     
     # Creating single knobs for the wires in each IP:
     make_knobs(mad)
@@ -28,5 +28,6 @@ setup(
         'numpy',
         'cpymad',
         'pandas',
+        'pyarrow',
     ],
 )
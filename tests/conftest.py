@@ -0,0 +1,55 @@
+import pytest
+
+from pymask.madxp import Madxp
+
+
+@pytest.fixture
+def two_beam_mad():
+    # Minimal ring with the names of the LHC sequences
+    mad = Madxp(stdout=False)
+    mad.input('''
+    kqf = 0.01; kqd = -0.01;
+    qf: quadrupole, l=1, k1:=kqf;
+    qd: quadrupole, l=1, k1:=kqd;
+    ''')
+    for bb in ['b1', 'b2']:
+        mad.input(f'''
+        lhc{bb}: sequence, l=100, refer=centre;
+        ip1: marker, at=0;
+        qf.{bb}: qf, at=25;
+        qd.{bb}: qd, at=75;
+        endsequence;
+        beam, sequence=lhc{bb}, particle=proton, energy=7000;
+        use, sequence=lhc{bb};
+        ''')
+    yield mad
+    mad.quit()
+
+@pytest.fixture
+def crossing_mad():
+    # Ring with the ip1 in the middle and a horizontal crossing
+    mad = Madxp(stdout=False)
+    mad.input('''
+    kqf = 0.01; kqd = -0.01; on_x1 = 1;
+    hrf400 = 35640; lhclength = 100; z_crab = 0;
+    crossing_disable: macro = {on_x1 = 0;};
+    crossing_restore: macro = {on_x1 = 1;};
+    qf: quadrupole, l=1, k1:=kqf;
+    qd: quadrupole, l=1, k1:=kqd;
+    ''')
+    for bb, sign in [('b1', 1), ('b2', -1)]:
+        mad.input(f'''
+        lhc{bb}: sequence, l=100, refer=centre;
+        qf.{bb}: qf, at=25;
+        mcb.{bb}: hkicker, at=35, kick:={sign}*1e-5*on_x1;
+        acfga.{bb}: hkicker, at=40, kick:=1e-5*z_crab;
+        ip1: marker, at=50;
+        qd.{bb}: qd, at=75;
+        endsequence;
+        beam, sequence=lhc{bb}, particle=proton, energy=7000,
+            npart=1e11, sigt=0.075, ex=1e-9, ey=1e-9;
+        use, sequence=lhc{bb};
+        twiss;
+        ''')
+    yield mad
+    mad.quit()
@@ -0,0 +1,76 @@
+from pymask.beambeam import (get_bb_cache_key, save_bb_dfs_to_cache,
+        load_bb_dfs_from_cache, restore_side_outputs_from_cache)
+from pymask.madxp import run_seqedit
+
+
+bb_config = {'ip_names': ['ip1'], 'numberOfHOSlices': 11}
+
+def test_key_depends_on_variables(two_beam_mad):
+    mad = two_beam_mad
+    key = get_bb_cache_key(mad, bb_config)
+    assert get_bb_cache_key(mad, bb_config) == key
+    assert get_bb_cache_key(mad, {**bb_config, 'numberOfHOSlices': 5}) != key
+
+    mad.globals['kqf'] = 0.02
+    assert get_bb_cache_key(mad, bb_config) != key
+
+def test_key_ignores_unrelated_variables(two_beam_mad):
+    mad = two_beam_mad
+    mad.input('i_oct = 0; oct: octupole, l=0.3, k3:=i_oct * 0.1;')
+    run_seqedit(mad, 'lhcb1', {'mode': 'install', 'element': ['oct.b1'],
+                               'class': 'oct', 'at': [10.], 'from': ['ip1']})
+    key = get_bb_cache_key(mad, bb_config)
+
+    # Octupole current, settings and leftovers not used by the sequences
+    mad.input('i_oct = 400; par_qx0 = 62.31; kqf_aux := kqf * 2;')
+    assert get_bb_cache_key(mad, bb_config) == key
+
+    # Excluded explicitly
+    key_no_kqd = get_bb_cache_key(mad, bb_config, exclude_variables=['kqd'])
+    mad.globals['kqd'] = -0.02
+    assert get_bb_cache_key(mad, bb_config, exclude_variables=['kqd']) \
+        == key_no_kqd
+    assert get_bb_cache_key(mad, bb_config) != key
+
+    # Variables reaching the quadrupoles through other variables
+    mad.input('kmain = 0.01; kqf := kmain * 1;')
+    key = get_bb_cache_key(mad, bb_config)
+    mad.globals['kmain'] = 0.011
+    assert get_bb_cache_key(mad, bb_config) != key
+
+    # Octupoles included on request
+    key = get_bb_cache_key(mad, bb_config, exclude_base_types=())
+    mad.globals['i_oct'] = 0
+    assert get_bb_cache_key(mad, bb_config, exclude_base_types=()) != key
+
+def test_key_depends_on_sequence(two_beam_mad):
+    mad = two_beam_mad
+    key = get_bb_cache_key(mad, bb_config)
+
+    # Same variables, edited sequence
+    run_seqedit(mad, 'lhcb1', {'mode': 'install', 'element': ['mk.test'],
+                               'class': 'marker', 'at': [10.], 'from': ['ip1']})
+    key_installed = get_bb_cache_key(mad, bb_config)
+    assert key_installed != key
+
+    run_seqedit(mad, 'lhcb1', {'mode': 'remove', 'element': ['mk.test']})
+    assert get_bb_cache_key(mad, bb_config) == key
+
+def test_side_outputs_restored(tmp_path, monkeypatch):
+    job_folder = tmp_path / 'job'
+    job_folder.mkdir()
+    (job_folder / 'twiss_z_crab.parquet').write_bytes(b'crab twiss')
+
+    cache_folder = tmp_path / 'cache'
+    save_bb_dfs_to_cache({}, cache_folder, 'key',
+            side_outputs=[job_folder / 'twiss_z_crab.parquet'])
+
+    other_job_folder = tmp_path / 'other_job'
+    other_job_folder.mkdir()
+    monkeypatch.chdir(other_job_folder)
+    restore_side_outputs_from_cache(cache_folder, 'key')
+    assert (other_job_folder / 'twiss_z_crab.parquet').read_bytes() == b'crab twiss'
+
+def test_missing_entry(tmp_path):
+    assert load_bb_dfs_from_cache(tmp_path, 'key') is None
+    restore_side_outputs_from_cache(tmp_path, 'key', tmp_path)
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pymask.beambeam import (generate_bb_dataframes, get_crab_bump_response,
+        generate_mad_bb_info, install_lenses_in_sequence, GeometrySnapshot,
+        get_ho_slices_from_piwinski_angle)
+from pymask.madxp import run_seqedit
+
+
+def _generate(mad, numberOfHOSlices, **kwargs):
+    return generate_bb_dataframes(mad, ip_names=['ip1'],
+            numberOfLRPerIRSide=[2], harmonic_number=100,
+            bunch_spacing_buckets=10, numberOfHOSlices=numberOfHOSlices,
+            ho_slices_accuracy=0.5, **kwargs)
+
+def _count_surveys(mad):
+    counter = {'n': 0}
+    survey = mad.survey
+    def counting_survey(*args, **kwargs):
+        counter['n'] += 1
+        return survey(*args, **kwargs)
+    mad.survey = counting_survey
+    return counter
+
+def test_auto_ho_slices_single_snapshot(crossing_mad, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mad = crossing_mad
+    counter = _count_surveys(mad)
+    bb_dfs_auto = _generate(mad, 'auto', z_crab_twiss=0.1)
+    # One twiss and survey per beam, taken before installing the lenses
+    assert counter['n'] == 2
+
+    n_slices = (bb_dfs_auto['b1']['label'] == 'bb_ho').sum()
+    bb_dfs_fixed = _generate(mad, n_slices, z_crab_twiss=0.1)
+
+    for beam in ['b1', 'b2', 'b3', 'b4']:
+        auto = bb_dfs_auto[beam]
+        fixed = bb_dfs_fixed[beam]
+        assert list(auto.index) == list(fixed.index)
+        assert auto['separation_x'].abs().max() > 0
+        for cc in auto.columns:
+            if pd.api.types.is_float_dtype(auto[cc]):
+                assert np.allclose(auto[cc], fixed[cc], rtol=1e-9,
+                                   atol=1e-15, equal_nan=True), (beam, cc)
+
+def test_crab_bump_response_after_lens_install(crossing_mad):
+    mad = crossing_mad
+    bb_dfs = _generate(mad, 1, remove_dummy_lenses=False)
+    reference = get_crab_bump_response(mad, bb_dfs, z_crab_twiss=0.1,
+            lenses_in_sequence=True)
+
+    # Snapshot of the sequences without the lenses, installed afterwards
+    for beam in ['b1', 'b2']:
+        run_seqedit(mad, 'lhc'+beam, {'mode': 'remove',
+            'element': bb_dfs[beam].elementName.values}, use_sequence=False)
+    geometry = GeometrySnapshot(mad).take()
+    for beam in ['b1', 'b2']:
+        dummy_df = bb_dfs[beam].copy()
+        generate_mad_bb_info(dummy_df, mode='dummy')
+        install_lenses_in_sequence(mad, dummy_df, 'lhc'+beam,
+                regenerate_mad_bb_info_in_df=False)
+    geometry.keep()
+
+    response = get_crab_bump_response(mad, bb_dfs, z_crab_twiss=0.1,
+            lenses_in_sequence=False, geometry=geometry)
+    for beam in ['b1', 'b2']:
+        assert reference[beam]['x'].abs().max() > 0
+        pd.testing.assert_frame_equal(response[beam], reference[beam],
+                rtol=1e-9)
+
+def test_drift_propagation_same_as_installed_lenses(crossing_mad):
+    mad = crossing_mad
+    # Encounters located by s and propagated in the drifts from the tables
+    # of the sequences without lenses
+    propagated = _generate(mad, 5, install_dummy_lenses=False)
+    # Encounters read from the tables of the sequences with the lenses
+    installed = _generate(mad, 5)
+
+    for beam in ['b1', 'b2', 'b3', 'b4']:
+        assert list(propagated[beam].index) == list(installed[beam].index)
+        assert installed[beam]['separation_x'].abs().max() > 0
+        for cc in installed[beam].columns:
+            if pd.api.types.is_float_dtype(installed[beam][cc]):
+                assert np.allclose(propagated[beam][cc], installed[beam][cc],
+                        rtol=1e-9, atol=1e-15, equal_nan=True), (beam, cc)
+
+def test_ho_slices_max_slices_odd():
+    assert get_ho_slices_from_piwinski_angle(0.1) == 1
+    assert get_ho_slices_from_piwinski_angle(2.) == 9
+    assert get_ho_slices_from_piwinski_angle(2., max_slices=9) == 9
+    assert get_ho_slices_from_piwinski_angle(2., max_slices=6) == 5
+    assert get_ho_slices_from_piwinski_angle(2., max_slices=1) == 1
+    assert get_ho_slices_from_piwinski_angle(0.1, max_slices=2) == 1
+    with pytest.raises(ValueError):
+        get_ho_slices_from_piwinski_angle(2., max_slices=0)
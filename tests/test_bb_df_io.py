@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pymask.beambeam import (generate_set_of_bb_encounters_1beam,
+        generate_mad_bb_info, get_counter_rotating,
+        save_bb_df, load_bb_df, save_bb_dfs_to_cache, load_bb_dfs_from_cache,
+        _sigma_names, _bb_df_categorical_columns)
+
+
+def _bb_df(beam='b1', other_beam='b2'):
+    bb_df = generate_set_of_bb_encounters_1beam(numberOfHOSlices=5,
+            bunch_num_particles=1.2e11, bunch_particle_charge=1.,
+            relativistic_beta=0.99999, beam_name=beam,
+            other_beam_name=other_beam)
+    rng = np.random.default_rng(0)
+    n = len(bb_df)
+    for ww in ['self', 'other']:
+        for ss in _sigma_names:
+            bb_df[f'{ww}_Sigma_{ss}'] = rng.uniform(1e-10, 1e-9, n)
+    for cc in ['separation_x', 'separation_y', 'xma', 'yma', 'dpx', 'dpy']:
+        bb_df[cc] = rng.normal(size=n)
+    bb_df['other_num_particles'] = 1.1e11
+    bb_df['other_particle_charge'] = 1.
+    bb_df['other_relativistic_beta'] = 0.99999
+    generate_mad_bb_info(bb_df, mode='from_dataframe',
+            madx_reference_bunch_num_particles=1e11)
+    return bb_df
+
+def _assert_same_bb_df(fresh, loaded):
+    # The categorical columns of the loaded dataframes (those not rewritten
+    # by generate_mad_bb_info) are kept
+    fresh = fresh.astype({cc: loaded[cc].dtype
+                          for cc in _bb_df_categorical_columns})
+    pd.testing.assert_frame_equal(fresh, loaded)
+
+@pytest.mark.parametrize('suffix', ['parquet', 'feather'])
+def test_round_trip(tmp_path, suffix):
+    fresh = _bb_df()
+    save_bb_df(fresh, tmp_path / f'bb_df.{suffix}')
+    loaded = load_bb_df(tmp_path / f'bb_df.{suffix}')
+
+    # The MAD-X strings are not stored
+    assert loaded['elementDefinition'].isna().all()
+    for cc in _bb_df_categorical_columns:
+        assert isinstance(loaded[cc].dtype, pd.CategoricalDtype)
+    assert loaded.index.equals(pd.Index(fresh['elementName']))
+    generate_mad_bb_info(loaded, mode='from_dataframe',
+            madx_reference_bunch_num_particles=1e11)
+
+    _assert_same_bb_df(fresh, loaded)
+
+def test_round_trip_counter_rotating(tmp_path):
+    fresh = get_counter_rotating(_bb_df('b2', 'b1'))
+    generate_mad_bb_info(fresh, mode='from_dataframe',
+            madx_reference_bunch_num_particles=1e11)
+    save_bb_df(fresh, tmp_path / 'bb_df.parquet')
+    loaded = load_bb_df(tmp_path / 'bb_df.parquet')
+    generate_mad_bb_info(loaded, mode='from_dataframe',
+            madx_reference_bunch_num_particles=1e11)
+
+    _assert_same_bb_df(fresh, loaded)
+
+def test_duplicated_names(tmp_path):
+    bb_df = _bb_df()
+    bb_df['elementName'] = bb_df['elementName'].iloc[0]
+    save_bb_df(bb_df, tmp_path / 'bb_df.parquet')
+    with pytest.raises(ValueError):
+        load_bb_df(tmp_path / 'bb_df.parquet')
+
+def test_cache(tmp_path):
+    bb_dfs = {'b1': _bb_df('b1', 'b2'), 'b2': _bb_df('b2', 'b1')}
+    bb_dfs['b3'] = get_counter_rotating(bb_dfs['b1'])
+    bb_dfs['b4'] = get_counter_rotating(bb_dfs['b2'])
+
+    assert load_bb_dfs_from_cache(tmp_path, 'key') is None
+    save_bb_dfs_to_cache(bb_dfs, tmp_path, 'key')
+    # A second job writing the same entry
+    save_bb_dfs_to_cache(bb_dfs, tmp_path, 'key')
+
+    cached = load_bb_dfs_from_cache(tmp_path, 'key')
+    for beam, bb_df in bb_dfs.items():
+        generate_mad_bb_info(cached[beam], mode='from_dataframe',
+                madx_reference_bunch_num_particles=1e11)
+        generate_mad_bb_info(bb_df, mode='from_dataframe',
+                madx_reference_bunch_num_particles=1e11)
+        _assert_same_bb_df(bb_df, cached[beam])
+        assert cached[beam]['beam'].str.startswith('b').all()
@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import xtrack as xt
+import xfields as xf
+
+from pymask.beambeam import (setup_beam_beam_in_line,
+        update_beam_beam_in_line, rescale_bb_df, _sigma_names)
+
+
+def _loader_lens(name):
+    # Lenses as created by the MAD-X loader of xtrack (before the setup)
+    if name.startswith('bb_ho'):
+        return xf.BeamBeamBiGaussian3D(old_interface={
+            'phi': 0., 'alpha': 0., 'x_bb_co': 0., 'y_bb_co': 0.,
+            'charge_slices': [0.], 'zeta_slices': [0.],
+            'sigma_11': 1., 'sigma_12': 0., 'sigma_13': 0., 'sigma_14': 0.,
+            'sigma_22': 1., 'sigma_23': 0., 'sigma_24': 0., 'sigma_33': 0.,
+            'sigma_34': 0., 'sigma_44': 0., 'x_co': 0., 'px_co': 0.,
+            'y_co': 0., 'py_co': 0., 'zeta_co': 0., 'delta_co': 0.,
+            'd_x': 0., 'd_px': 0., 'd_y': 0., 'd_py': 0., 'd_zeta': 0.,
+            'd_delta': 0.})
+    return xf.BeamBeamBiGaussian2D(n_particles=0., q0=0., beta0=1.,
+            mean_x=0., mean_y=0., sigma_x=1., sigma_y=1., d_px=0, d_py=0)
+
+def _bb_df():
+    names = ['bb_ho.c1b1_00', 'bb_ho.c1b1_01', 'bb_lr.l1b1_01',
+             'bb_lr.r1b1_01']
+    rng = np.random.default_rng(1)
+    n = len(names)
+    bb_df = pd.DataFrame(index=names)
+    bb_df['other_num_particles'] = 1e11
+    bb_df['other_particle_charge'] = 1.
+    bb_df['other_relativistic_beta'] = 0.99999
+    bb_df['separation_x'] = rng.normal(size=n) * 1e-4
+    bb_df['separation_y'] = rng.normal(size=n) * 1e-4
+    bb_df['phi'] = rng.uniform(1e-4, 2e-4, n)
+    bb_df['alpha'] = rng.uniform(0, np.pi, n)
+    for ss in _sigma_names:
+        bb_df[f'other_Sigma_{ss}'] = rng.uniform(1e-11, 1e-10, n)
+    for ss in [11, 22, 33, 44]:
+        bb_df[f'other_Sigma_{ss}'] = rng.uniform(1e-10, 2e-10, n)
+    return bb_df
+
+def _line(bb_df):
+    elements = {'start': xt.Drift(length=1.)}
+    for nn in bb_df.index:
+        elements[nn] = _loader_lens(nn)
+    elements['end'] = xt.Drift(length=1.)
+    return xt.Line(elements=elements, element_names=list(elements))
+
+def _assert_same_lenses(line_a, line_b, names):
+    for nn in names:
+        dict_a = line_a.element_dict[nn].to_dict()
+        dict_b = line_b.element_dict[nn].to_dict()
+        assert dict_a.keys() == dict_b.keys()
+        for kk in dict_a:
+            if kk in ('__class__', 'name'):
+                assert dict_a[kk] == dict_b[kk]
+            else:
+                assert np.allclose(dict_a[kk], dict_b[kk], rtol=1e-12,
+                                   atol=0), (nn, kk)
+
+def test_update_reaches_the_tracker():
+    bb_df = _bb_df()
+    line = _line(bb_df)
+    setup_beam_beam_in_line(line, bb_df)
+    line.build_tracker(compile=False)
+    tracker_elements = list(line.tracker._tracker_data_base.elements)
+
+    rescale_bb_df(bb_df, intensity_ratio=2., emittance_ratio_x=1.5,
+                  emittance_ratio_y=0.5)
+    update_beam_beam_in_line(line, bb_df)
+
+    # Same objects in the line and in the tracker
+    for ii, nn in enumerate(line.element_names):
+        assert line.element_dict[nn] is tracker_elements[ii]
+    ho = line.element_dict['bb_ho.c1b1_00']
+    assert ho.slices_other_beam_num_particles[0] == 2e11
+    assert np.isclose(ho.slices_other_beam_Sigma_11[0],
+                      bb_df.loc['bb_ho.c1b1_00', 'other_Sigma_11'])
+    assert line.element_dict['bb_lr.l1b1_01'].n_particles == 2e11
+
+    # Same lenses as a line configured directly with the new parameters
+    fresh = _line(bb_df)
+    setup_beam_beam_in_line(fresh, bb_df)
+    _assert_same_lenses(line, fresh, bb_df.index)
+
+def _setup_beam_beam_in_line_baseline(line, bb_df):
+    # Former implementation (one dict and one new element per 3D lens)
+    for ee, eename in zip(line.elements, line.element_names):
+        if isinstance(ee, xf.BeamBeamBiGaussian2D):
+            ee.n_particles=bb_df.loc[eename, 'other_num_particles']
+            ee.q0 = bb_df.loc[eename, 'other_particle_charge']
+            ee.sigma_x = np.sqrt(bb_df.loc[eename, 'other_Sigma_11'])
+            ee.sigma_y = np.sqrt(bb_df.loc[eename, 'other_Sigma_33'])
+            ee.beta0 = bb_df.loc[eename, 'other_relativistic_beta']
+            ee.mean_x = bb_df.loc[eename, 'separation_x']
+            ee.mean_y = bb_df.loc[eename, 'separation_y']
+        if isinstance(ee, xf.BeamBeamBiGaussian3D):
+            params = {}
+            params['phi'] = bb_df.loc[eename, 'phi']
+            params['alpha'] =  bb_df.loc[eename, 'alpha']
+            params['x_bb_co'] =  bb_df.loc[eename, 'separation_x']
+            params['y_bb_co'] =  bb_df.loc[eename, 'separation_y']
+            params['charge_slices'] =  [(bb_df.loc[eename, 'other_num_particles']
+                                 * bb_df.loc[eename, 'other_particle_charge'])]
+            params['zeta_slices'] =  [0.0]
+            for ss in _sigma_names:
+                params[f'sigma_{ss}'] = bb_df.loc[eename, f'other_Sigma_{ss}']
+            for ss in [13, 14, 23, 24]:
+                params[f'sigma_{ss}'] = 0.0
+            for cc in ['x_co', 'px_co', 'y_co', 'py_co', 'zeta_co',
+                       'delta_co', 'd_x', 'd_px', 'd_y', 'd_py', 'd_zeta',
+                       'd_delta']:
+                params[cc] = 0
+            line.element_dict[eename] = xf.BeamBeamBiGaussian3D(
+                    old_interface=params)
+
+def test_setup_same_as_baseline():
+    bb_df = _bb_df()
+    line = _line(bb_df)
+    setup_beam_beam_in_line(line, bb_df)
+    reference = _line(bb_df)
+    _setup_beam_beam_in_line_baseline(reference, bb_df)
+    _assert_same_lenses(line, reference, bb_df.index)
+
+    # Configured twice, e.g. from a line saved after a first setup
+    setup_beam_beam_in_line(line, bb_df)
+    _assert_same_lenses(line, reference, bb_df.index)
+
+def test_lens_missing_in_bb_df():
+    bb_df = _bb_df()
+    line = _line(bb_df)
+    with pytest.raises(KeyError, match='bb_lr.r1b1_01'):
+        setup_beam_beam_in_line(line, bb_df.drop(index='bb_lr.r1b1_01'))
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+
+from pymask.beambeam import (generate_set_of_bb_encounters_1beam,
+        get_normalized_separation, estimate_far_field_tune_shifts,
+        prune_bb_df, _prune_bb_dfs, _sigma_names)
+
+
+def _bb_df():
+    bb_df = generate_set_of_bb_encounters_1beam(numberOfHOSlices=5,
+            bunch_num_particles=1.2e11, bunch_particle_charge=1.,
+            relativistic_beta=0.99999, beam_name='b1',
+            other_beam_name='b2')
+    n = len(bb_df)
+    for ww in ['self', 'other']:
+        for ss in _sigma_names:
+            bb_df[f'{ww}_Sigma_{ss}'] = 0.
+        bb_df[f'{ww}_Sigma_11'] = 1e-10
+        bb_df[f'{ww}_Sigma_33'] = 1e-10
+    # Normalized separation of 10 sigmas per long-range encounter
+    bb_df['separation_x'] = 1e-4 * np.abs(bb_df['identifier'].values) + 1e-6
+    bb_df['separation_y'] = 2e-6
+    for cc in ['xma', 'yma', 'dpx', 'dpy']:
+        bb_df[cc] = 0.
+    bb_df['alpha'] = 0.
+    bb_df['phi'] = 0.
+    bb_df['other_num_particles'] = 1.1e11
+    bb_df['other_particle_charge'] = 1.
+    bb_df['other_relativistic_beta'] = 0.99999
+    return bb_df
+
+def test_remove(capsys):
+    bb_df = _bb_df()
+    pruned, report = prune_bb_df(bb_df, separation_cut=55.)
+
+    # The report is printed only on request
+    assert capsys.readouterr().out == ''
+
+    far = ((bb_df['label'] == 'bb_lr')
+           & (get_normalized_separation(bb_df) > 55.))
+    assert far.sum() > 0
+    assert list(pruned.index) == list(bb_df.index[~far.values])
+    assert report['n_pruned'].sum() == far.sum()
+    assert report['dqx_error'].isna().all()
+
+    prune_bb_df(bb_df, separation_cut=55., verbose=True)
+    assert 'Pruned' in capsys.readouterr().out
+
+def test_lump_preserves_tune_shift():
+    bb_df = _bb_df()
+    nemitt = dict(nemitt_x=2.5e-6, nemitt_y=2.5e-6)
+    pruned, report = prune_bb_df(bb_df, separation_cut=55., mode='lump',
+            **nemitt)
+
+    dqx, dqy = estimate_far_field_tune_shifts(bb_df, **nemitt)
+    dqx_p, dqy_p = estimate_far_field_tune_shifts(pruned, **nemitt)
+    # Horizontal separation, the horizontal tune shift is preserved
+    assert np.isclose(np.sum(dqx_p), np.sum(dqx), rtol=1e-12)
+    assert np.allclose(report['dqx_error'], 0., atol=1e-15)
+    # One lumped encounter per IR side
+    assert len(pruned) == (len(bb_df) - report['n_pruned'].sum()
+                           + len(report))
+
+def test_prune_bb_dfs(two_beam_mad):
+    bb_dfs = {'b1': _bb_df()}
+    assert _prune_bb_dfs(two_beam_mad, bb_dfs, None) is bb_dfs
+
+    pruned = _prune_bb_dfs(two_beam_mad, bb_dfs,
+            {'separation_cut': 55.})['b1']
+    assert len(pruned) < len(bb_dfs['b1'])
+    # MAD-X strings regenerated for the remaining encounters only
+    assert not pruned['elementDefinition'].isna().any()
+    assert all(nn in inst for nn, inst in zip(pruned.index,
+                                              pruned['elementInstallation']))
+
+def test_lump_without_far_field_tune_shift():
+    bb_df = _bb_df()
+    nemitt = dict(nemitt_x=2.5e-6, nemitt_y=2.5e-6)
+    far = ((bb_df['label'] == 'bb_lr')
+           & (get_normalized_separation(bb_df) > 55.)).values
+    # The closest pruned encounter of each side at |dx| == |dy|
+    normalized_separation = get_normalized_separation(bb_df)
+    closest = []
+    for ip_name in set(bb_df['ip_name']):
+        for sign in [-1, 1]:
+            side = (far & (bb_df['ip_name'] == ip_name).values
+                    & (np.sign(bb_df['identifier'].values) == sign))
+            if side.any():
+                closest.append(np.flatnonzero(side)[
+                    np.argmin(normalized_separation[side])])
+    ii = bb_df.columns.get_loc('separation_y')
+    for cc in closest:
+        bb_df.iloc[cc, ii] = bb_df['separation_x'].values[cc]
+
+    pruned, report = prune_bb_df(bb_df, separation_cut=55., mode='lump',
+            **nemitt)
+    assert np.all(np.isfinite(pruned['other_num_particles']))
+    # Lumped in the next encounter, tune shift preserved
+    assert not set(bb_df.index[closest]) & set(pruned.index)
+    dqx, _ = estimate_far_field_tune_shifts(bb_df, **nemitt)
+    dqx_p, _ = estimate_far_field_tune_shifts(pruned, **nemitt)
+    assert np.isclose(np.sum(dqx_p), np.sum(dqx), rtol=1e-12)
+
+    # All pruned encounters at |dx| == |dy|: removed
+    bb_df.loc[far, 'separation_y'] = bb_df.loc[far, 'separation_x']
+    pruned, report = prune_bb_df(bb_df, separation_cut=55., mode='lump',
+            **nemitt)
+    assert len(pruned) == len(bb_df) - far.sum()
+    assert np.all(np.isfinite(report[['dqx_error', 'dqy_error']]))
+
+def test_pruning_report_attached(two_beam_mad):
+    bb_dfs = {'b1': _bb_df()}
+    pruned = _prune_bb_dfs(two_beam_mad, bb_dfs,
+            {'separation_cut': 55., 'nemitt_x': 2.5e-6, 'nemitt_y': 2.5e-6})
+    report = pruned['b1'].attrs['pruning_report']
+    assert report['n_pruned'].sum() == len(bb_dfs['b1']) - len(pruned['b1'])
+    assert not report['dqx_error'].isna().any()
@@ -0,0 +1,69 @@
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+from pymask.madxp import Madxp, run_seqedit
+
+sys.path.insert(0, str(Path(__file__).parents[1]
+                       / 'python_examples' / 'run3_collisions_wire'))
+import bbcw
+
+
+def _ring():
+    # Ring with ip1 and ip5, the fallback positions of the wires of beam 1
+    # (148.54 m and 147.35 m upstream of the ips for the offsets below)
+    mad = Madxp(stdout=False)
+    mad.input('''
+    ds = 1; ip1ofs.b1 = 0; ip5ofs.b1 = -308;
+    lhcb1: sequence, l=1000, refer=centre;
+    qf: quadrupole, l=1, k1=0.001, at=20;
+    ip1: marker, at=300;
+    qd: quadrupole, l=1, k1=-0.001, at=450;
+    ip5: marker, at=800;
+    endsequence;
+    beam, sequence=lhcb1, particle=proton, energy=7000;
+    use, sequence=lhcb1;
+    ''')
+    return mad
+
+def _sequence(mad):
+    mad.use(sequence='lhcb1')
+    seq = mad.sequence.lhcb1.expanded_elements
+    return pd.DataFrame({'name': [ee.name for ee in seq],
+                         'parent': [ee.parent.name for ee in seq],
+                         'base_type': [ee.base_type.name for ee in seq],
+                         'at': [ee.position for ee in seq]})
+
+def test_install_wires_matches_separate_seqedits(capsys):
+    configuration = {'wires_L': 1., 'wires_at_fallback': True}
+
+    # Single seqedit installing the monitors and replacing them by the wires
+    mad = _ring()
+    bbcw.install_wires(mad, configuration, 'lhcb1')
+    merged = _sequence(mad)
+    assert capsys.readouterr().out == ''
+
+    # Baseline: installation and replacement in two seqedits
+    mad_ref = _ring()
+    wire_names = []
+    for name in bbcw.WIRE_MARKERS['b1']:
+        w_type, loc, s, beam = name.split('.')
+        wire_name = f'{w_type}_wire.{loc}.{s}.{beam}'
+        mad_ref.input(f'{wire_name}: wire, current=0, L=0, L_phy=1, L_int=2;')
+        wire_names.append(wire_name)
+    to_install = pd.DataFrame(bbcw.WIRE_INSTALL_FALLBACK['b1'],
+                              columns=['element', 'at', 'from'])
+    to_install.insert(0, 'mode', 'install')
+    to_install.insert(2, 'class', 'monitor')
+    run_seqedit(mad_ref, 'lhcb1', to_install)
+    run_seqedit(mad_ref, 'lhcb1', {'mode': 'replace',
+        'element': bbcw.WIRE_MARKERS['b1'], 'by': wire_names})
+    reference = _sequence(mad_ref)
+
+    assert set(wire_names) <= set(merged['name'])
+    assert not set(bbcw.WIRE_MARKERS['b1']) & set(merged['name'])
+    pd.testing.assert_frame_equal(merged, reference)
+
+    mad.quit()
+    mad_ref.quit()
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+from pymask.beambeam import (get_counter_rotating, find_alpha_and_phi,
+        _sigma_names)
+
+# Expected signs for b2 -> b4 (x -> -x, s -> -s, hence px -> px, y -> y,
+# py -> -py), written explicitly as in the original implementation
+expected_sign = {
+    'atPosition': -1.,
+    'separation_x': -1., 'separation_y': 1.,
+    'xma': -1., 'yma': 1.,
+    'dpx': 1., 'dpy': -1.,
+    'Sigma_11': 1., 'Sigma_12': -1., 'Sigma_13': -1., 'Sigma_14': 1.,
+    'Sigma_22': 1., 'Sigma_23': 1., 'Sigma_24': -1.,
+    'Sigma_33': 1., 'Sigma_34': -1., 'Sigma_44': 1.,
+    'x_crab': -1., 'px_crab': 1., 'y_crab': 1., 'py_crab': -1.,
+}
+
+copied_columns = ['beam', 'other_beam', 'ip_name', 'label', 'identifier',
+    'elementClass', 'elementName', 'self_num_particles',
+    'other_num_particles', 'self_particle_charge', 'other_particle_charge',
+    'other_elementName', 'other_relativistic_beta']
+
+
+def _bb_df_b2(n=20, seed=0):
+    rng = np.random.default_rng(seed)
+    names = [f'bb_lr.r1b2_{ii}' for ii in range(n)]
+    bb_df = pd.DataFrame(index=names)
+    bb_df['beam'] = 'b2'
+    bb_df['other_beam'] = 'b1'
+    bb_df['ip_name'] = 'ip1'
+    bb_df['label'] = 'bb_lr'
+    bb_df['identifier'] = np.arange(n)
+    bb_df['elementClass'] = 'beambeam'
+    bb_df['elementName'] = names
+    bb_df['self_num_particles'] = 1.2e11
+    bb_df['other_num_particles'] = 1.1e11
+    bb_df['self_particle_charge'] = 1.
+    bb_df['other_particle_charge'] = 1.
+    bb_df['other_elementName'] = [nn.replace('b2', 'b1') for nn in names]
+    bb_df['other_relativistic_beta'] = 0.99999
+    for cc in expected_sign:
+        if cc.startswith('Sigma') or cc.endswith('_crab'):
+            for ww in ['self', 'other']:
+                bb_df[f'{ww}_{cc}'] = rng.normal(size=n)
+        else:
+            bb_df[cc] = rng.normal(size=n)
+    # Both signs of the crossing angle, one zero separation
+    bb_df['dpx'] *= 1e-4
+    bb_df['dpy'] *= 1e-4
+    bb_df.loc[names[0], ['dpx', 'dpy']] = 0.
+    return bb_df
+
+def test_parity_b2_to_b4():
+    bb_df_b2 = _bb_df_b2()
+    bb_df_b4 = get_counter_rotating(bb_df_b2)
+
+    assert bb_df_b4.index.equals(bb_df_b2.index)
+    for cc, sign in expected_sign.items():
+        if cc.startswith('Sigma') or cc.endswith('_crab'):
+            columns = [f'self_{cc}', f'other_{cc}']
+        else:
+            columns = [cc]
+        for col in columns:
+            assert np.array_equal(bb_df_b4[col].values,
+                                  sign * bb_df_b2[col].values), col
+
+    for cc in copied_columns:
+        assert bb_df_b4[cc].equals(bb_df_b2[cc]), cc
+
+    # MAD-X strings are regenerated for the counter-rotating beam
+    assert bb_df_b4['elementDefinition'].isna().all()
+    assert bb_df_b4['elementInstallation'].isna().all()
+
+def test_all_sigma_columns_transformed():
+    bb_df_b4 = get_counter_rotating(_bb_df_b2())
+    for ww in ['self', 'other']:
+        for ss in _sigma_names:
+            assert f'{ww}_Sigma_{ss}' in bb_df_b4.columns
+
+def test_crossing_angle_recomputed():
+    bb_df_b2 = _bb_df_b2()
+    bb_df_b4 = get_counter_rotating(bb_df_b2)
+    for nn in bb_df_b4.index:
+        alpha, phi = find_alpha_and_phi(bb_df_b4.loc[nn, 'dpx'],
+                                        bb_df_b4.loc[nn, 'dpy'])
+        assert bb_df_b4.loc[nn, 'alpha'] == alpha
+        assert bb_df_b4.loc[nn, 'phi'] == phi
+
+def test_parity_is_an_involution():
+    bb_df_b2 = _bb_df_b2()
+    bb_df_back = get_counter_rotating(get_counter_rotating(bb_df_b2))
+    for cc in ['atPosition', 'separation_x', 'dpy', 'self_Sigma_12',
+               'other_Sigma_34', 'self_x_crab']:
+        assert np.array_equal(bb_df_back[cc].values, bb_df_b2[cc].values)
@@ -0,0 +1,61 @@
+import numpy as np
+
+from pymask.beambeam import find_alpha_and_phi, find_alpha_and_phi_array
+
+
+def _scalar_reference(dpx, dpy):
+    out = [find_alpha_and_phi(xx, yy) for xx, yy in zip(dpx, dpy)]
+    return np.array([oo[0] for oo in out]), np.array([oo[1] for oo in out])
+
+def test_all_octants():
+    # One point per octant, on both sides of each octant boundary
+    angles = np.deg2rad(np.arange(0., 360., 7.5) + 1.)
+    dpx = 2e-4 * np.cos(angles)
+    dpy = 2e-4 * np.sin(angles)
+
+    alpha, phi = find_alpha_and_phi_array(dpx, dpy)
+    alpha_ref, phi_ref = _scalar_reference(dpx, dpy)
+
+    assert np.allclose(alpha, alpha_ref, rtol=0, atol=1e-15)
+    assert np.allclose(phi, phi_ref, rtol=0, atol=1e-20)
+    assert np.allclose(np.abs(phi), 1e-4)
+
+def test_octant_boundaries():
+    # Axes and diagonals, where the branches of the scalar version meet
+    values = np.array([-1., 0., 1.]) * 3e-4
+    dpx, dpy = [vv.ravel() for vv in np.meshgrid(values, values)]
+    keep = (dpx != 0) | (dpy != 0)
+    dpx, dpy = dpx[keep], dpy[keep]
+
+    alpha, phi = find_alpha_and_phi_array(dpx, dpy)
+    alpha_ref, phi_ref = _scalar_reference(dpx, dpy)
+
+    assert np.array_equal(alpha, alpha_ref)
+    assert np.array_equal(phi, phi_ref)
+
+def test_zero_separation():
+    alpha, phi = find_alpha_and_phi_array([0., 0., 1e-25], [0., -0., 0.])
+    assert np.array_equal(alpha, np.zeros(3))
+    assert np.array_equal(phi[:2], np.zeros(2))
+
+    for xx, yy in [(0., 0.), (1e-25, 0.)]:
+        alpha_ref, phi_ref = find_alpha_and_phi(xx, yy)
+        assert alpha_ref == 0.
+        assert phi_ref == find_alpha_and_phi_array(xx, yy)[1][0]
+
+def test_scalar_input():
+    alpha, phi = find_alpha_and_phi_array(1e-4, -3e-4)
+    alpha_ref, phi_ref = find_alpha_and_phi(1e-4, -3e-4)
+    assert alpha.shape == (1,)
+    assert alpha[0] == alpha_ref
+    assert phi[0] == phi_ref
+
+def test_random_parity():
+    rng = np.random.default_rng(1)
+    dpx, dpy = rng.normal(scale=1e-4, size=(2, 1000))
+
+    alpha, phi = find_alpha_and_phi_array(dpx, dpy)
+    alpha_ref, phi_ref = _scalar_reference(dpx, dpy)
+
+    assert np.array_equal(alpha, alpha_ref)
+    assert np.array_equal(phi, phi_ref)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from pymask.madxp import _extract_parameters, _parse_parameters
+
+
+def _extract_parameters_baseline(my_string):
+    # Parser replaced by the memoized tokenizer, kept as reference
+    if (type(my_string)=='NoneType' or my_string==None
+            or my_string=='None' or my_string=='[None]' or 'table(' in my_string):
+        return []
+    else:
+        for i in [
+        '*','->','-','/','+','^','(',')','[',']',',','\'','None']:
+            my_string=my_string.replace(i,' ')
+        my_list=my_string.split(' ')
+        my_list=list(np.unique(my_list))
+        if '' in my_list:
+            my_list.remove('')
+        for i in my_list.copy():
+            if i.isdigit() or i[0].isdigit() or i[0]=='.':
+                my_list.remove(i)
+        my_list=list(set(my_list)-
+        set(['sqrt', 'log', 'log10', 'exp', 'sin', 'cos', 'tan', 'asin',
+             'acos', 'atan', 'sinh', 'cosh', 'tanh', 'sinc', 'abs', 'erf',
+             'erfc', 'floor', 'ceil', 'round', 'frac', 'ranf', 'gauss',
+             'tgauss']))
+        return my_list
+
+@pytest.mark.parametrize('expression', [
+    'kqf',
+    'on_x1 * 1e-6',
+    '2.5E+3 * kq4.l1b1 + 1.E-3 * on_sep1',
+    '.5 * a_b.c1 - 3.e2',
+    'sqrt(kqf ^ 2 + kqd ^ 2) / log10(abs(on_x1))',
+    'sin(pi * z_crab / lhclength) * 2 * pi',
+    'exp(-x_1) + cosh(tanh(y.b2)) + erfc(gauss())',
+    '(-(acbh14.r1b1 * 1.2) + [kq.4]) / nrj',
+    "qf->k1 * 'l'",
+    'kd$1 + twopi',
+    'floor(n) + ceil(m) + round(q) + frac(r) + ranf()',
+    '-1',
+    '3',
+    'None',
+    '[None]',
+    'table(twiss, ip1, betx) * kqf',
+])
+def test_same_parameters_as_baseline(expression):
+    assert (sorted(_extract_parameters(expression))
+            == sorted(_extract_parameters_baseline(expression)))
+
+def test_parameters():
+    assert _extract_parameters('2.5E+3 * kq4.l1b1 + 1.e-3 * on_sep1') \
+        == ['kq4.l1b1', 'on_sep1']
+    assert _extract_parameters('sqrt(pi) * e1') == ['e1', 'pi']
+    assert _extract_parameters(None) == []
+
+def test_memoized():
+    _parse_parameters.cache_clear()
+    parameters = _extract_parameters('kqf * kqd')
+    # A list owned by the caller, the cached tuple is not modified
+    parameters.append('x')
+    assert _extract_parameters('kqf * kqd') == ['kqd', 'kqf']
+    assert _parse_parameters.cache_info().hits == 1
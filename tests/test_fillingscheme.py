@@ -0,0 +1,187 @@
+import numpy as np
+import pytest
+
+from pymask.beambeam import generate_set_of_bb_encounters_1beam
+from pymask.fillingscheme import (default_ip_bunch_offsets,
+        get_encounter_masks, get_filling_scheme_masks,
+        get_bunch_bb_df, get_bunch_equivalence_classes)
+
+n_slots = 3564
+ip_names = ['ip1', 'ip2', 'ip5', 'ip8']
+
+
+def _bb_dfs(n_lr=5):
+    return {beam: generate_set_of_bb_encounters_1beam(numberOfHOSlices=1,
+                    ip_names=ip_names, numberOfLRPerIRSide=[n_lr] * 4,
+                    beam_name=beam, other_beam_name=other_beam)
+            for beam, other_beam in [('b1', 'b2'), ('b2', 'b1')]}
+
+def _random_filling_scheme(seed=0, fraction=0.3):
+    rng = np.random.default_rng(seed)
+    return {beam: rng.random(n_slots) < fraction for beam in ['b1', 'b2']}
+
+def _ho_name(bb_df, ip_nn):
+    mask = (bb_df['label'] == 'bb_ho') & (bb_df['ip_name'] == ip_nn)
+    return bb_df.index[mask.values][0]
+
+def test_head_on_offsets():
+    bb_dfs = _bb_dfs()
+    bunch = 100
+    # b2 bunches colliding head-on with b1 bunch 100 at each IP
+    partners = {ip_nn: (bunch + default_ip_bunch_offsets[ip_nn]) % n_slots
+                for ip_nn in ip_names}
+    assert partners == {'ip1': 100, 'ip2': 991, 'ip5': 100, 'ip8': 2770}
+
+    filling_scheme = {'b1': np.zeros(n_slots, dtype=bool),
+                      'b2': np.zeros(n_slots, dtype=bool)}
+    filling_scheme['b1'][bunch] = True
+    filling_scheme['b2'][[100, 991]] = True
+
+    masks = get_encounter_masks(bb_dfs['b1'], filling_scheme)
+    assert list(masks.index) == [bunch]
+    row = masks.loc[bunch]
+    assert row[_ho_name(bb_dfs['b1'], 'ip1')]
+    assert row[_ho_name(bb_dfs['b1'], 'ip2')]
+    assert row[_ho_name(bb_dfs['b1'], 'ip5')]
+    assert not row[_ho_name(bb_dfs['b1'], 'ip8')]
+    # No long-range partner
+    assert row.sum() == 3
+
+    # Seen from b2
+    masks_b2 = get_encounter_masks(bb_dfs['b2'], filling_scheme)
+    assert masks_b2.loc[991, _ho_name(bb_dfs['b2'], 'ip2')]
+    assert not masks_b2.loc[991, _ho_name(bb_dfs['b2'], 'ip1')]
+    assert masks_b2.loc[100, _ho_name(bb_dfs['b2'], 'ip1')]
+
+def test_long_range_identifier():
+    bb_dfs = _bb_dfs()
+    filling_scheme = {'b1': np.zeros(n_slots, dtype=bool),
+                      'b2': np.zeros(n_slots, dtype=bool)}
+    filling_scheme['b1'][200] = True
+    filling_scheme['b2'][203] = True
+
+    masks = get_encounter_masks(bb_dfs['b1'], filling_scheme)
+    active = bb_dfs['b1'].loc[masks.loc[200].values]
+    assert set(active['ip_name']) == {'ip1', 'ip5'}
+    assert (active['label'] == 'bb_lr').all()
+    assert (active['identifier'] == 3).all()
+
+def test_custom_offsets():
+    bb_dfs = _bb_dfs()
+    filling_scheme = {'b1': np.zeros(n_slots, dtype=bool),
+                      'b2': np.zeros(n_slots, dtype=bool)}
+    filling_scheme['b1'][0] = True
+    filling_scheme['b2'][10] = True
+    offsets = {'ip1': 10, 'ip2': 0, 'ip5': 0, 'ip8': 0}
+
+    masks = get_encounter_masks(bb_dfs['b1'], filling_scheme,
+                                ip_bunch_offsets=offsets)
+    assert masks.loc[0, _ho_name(bb_dfs['b1'], 'ip1')]
+    assert not masks.loc[0, _ho_name(bb_dfs['b1'], 'ip5')]
+
+def test_mask_symmetry():
+    bb_dfs = _bb_dfs()
+    filling_scheme = _random_filling_scheme()
+    masks = get_filling_scheme_masks(bb_dfs, filling_scheme)
+
+    assert list(masks['b1'].index) == list(np.flatnonzero(filling_scheme['b1']))
+    assert list(masks['b2'].index) == list(np.flatnonzero(filling_scheme['b2']))
+
+    # Encounter e of b1 bunch i is active iff the partner encounter of the
+    # b2 bunch it meets is active
+    bb_df_b1 = bb_dfs['b1']
+    n_checked = 0
+    for name in bb_df_b1.index:
+        ip_nn = bb_df_b1.loc[name, 'ip_name']
+        shift = default_ip_bunch_offsets[ip_nn]
+        if bb_df_b1.loc[name, 'label'] == 'bb_lr':
+            shift += bb_df_b1.loc[name, 'identifier']
+        partner_name = bb_df_b1.loc[name, 'other_elementName']
+        for bunch in masks['b1'].index:
+            other_bunch = (bunch + shift) % n_slots
+            active = masks['b1'].loc[bunch, name]
+            assert active == filling_scheme['b2'][other_bunch]
+            if active:
+                assert masks['b2'].loc[other_bunch, partner_name]
+                n_checked += 1
+    assert n_checked > 0
+
+    # Same number of active encounters seen from the two beams
+    assert masks['b1'].values.sum() == masks['b2'].values.sum()
+
+def test_several_beams_rejected():
+    bb_dfs = _bb_dfs()
+    both = bb_dfs['b1'].copy()
+    both.iloc[0, both.columns.get_loc('beam')] = 'b2'
+    with pytest.raises(ValueError):
+        get_encounter_masks(both, _random_filling_scheme())
+
+def test_equivalence_classes():
+    bb_dfs = _bb_dfs()
+    masks = get_encounter_masks(bb_dfs['b1'], _random_filling_scheme())
+    classes = get_bunch_equivalence_classes(masks)
+
+    assert classes['multiplicity'].sum() == len(masks)
+    all_bunches = np.concatenate(classes['bunches'].values)
+    assert sorted(all_bunches) == list(masks.index)
+
+    rows = {}
+    for representative, cl in classes.iterrows():
+        assert cl['bunches'][0] == representative
+        assert len(cl['bunches']) == cl['multiplicity']
+        # Same encounters for all the bunches of a class
+        class_masks = masks.loc[cl['bunches']].values
+        assert (class_masks == class_masks[0]).all()
+        rows[representative] = tuple(class_masks[0])
+    # Different encounters for different classes
+    assert len(set(rows.values())) == len(classes)
+
+def test_equivalence_classes_separation_cut():
+    bb_df = _bb_dfs()['b1']
+    is_lr = (bb_df['label'] == 'bb_lr').values
+    bb_df['separation_x'] = np.where(is_lr,
+            np.abs(bb_df['identifier'].values) * 1e-3, 0.)
+    bb_df['separation_y'] = 0.
+    bb_df['other_Sigma_11'] = 1e-8
+    bb_df['other_Sigma_33'] = 1e-8
+
+    masks = get_encounter_masks(bb_df, _random_filling_scheme())
+    classes = get_bunch_equivalence_classes(masks)
+    # Long-range encounters at 10 sigma and more are ignored
+    classes_cut = get_bunch_equivalence_classes(masks, bb_df=bb_df,
+                                                lr_separation_cut=15.)
+    assert len(classes_cut) < len(classes)
+
+    kept = ~(is_lr & (np.abs(bb_df['identifier'].values) * 10 > 15.))
+    for representative, cl in classes_cut.iterrows():
+        class_masks = masks.loc[cl['bunches']].values[:, kept]
+        assert (class_masks == class_masks[0]).all()
+
+    with pytest.raises(ValueError):
+        get_bunch_equivalence_classes(masks, lr_separation_cut=15.)
+
+def test_bunch_bb_df():
+    bb_dfs = _bb_dfs()
+    masks = get_filling_scheme_masks(bb_dfs, _random_filling_scheme())
+
+    for beam in ['b1', 'b2']:
+        bb_df = bb_dfs[beam]
+        for bunch in masks[beam].index[::50]:
+            bunch_bb_df = get_bunch_bb_df(bb_df, masks[beam], bunch)
+            row = masks[beam].loc[bunch]
+            # Exactly the encounters masked out are dropped
+            assert list(bunch_bb_df.index) == list(row.index[row.values])
+            assert set(bb_df.index) - set(bunch_bb_df.index) == set(
+                    row.index[~row.values])
+            assert bunch_bb_df.equals(bb_df.loc[bunch_bb_df.index])
+
+def test_bunch_bb_df_empty():
+    bb_dfs = _bb_dfs()
+    filling_scheme = {'b1': np.zeros(n_slots, dtype=bool),
+                      'b2': np.zeros(n_slots, dtype=bool)}
+    filling_scheme['b1'][5] = True
+    masks = get_encounter_masks(bb_dfs['b1'], filling_scheme)
+
+    bunch_bb_df = get_bunch_bb_df(bb_dfs['b1'], masks, 5)
+    assert len(bunch_bb_df) == 0
+    assert list(bunch_bb_df.columns) == list(bb_dfs['b1'].columns)
@@ -0,0 +1,38 @@
+import pytest
+
+from pymask.beambeam import GeometrySnapshot
+
+
+@pytest.fixture
+def mad(two_beam_mad):
+    return two_beam_mad
+
+def test_tables_reused(mad):
+    geometry = GeometrySnapshot(mad)
+    tables = geometry['lhcb1']
+    geometry.take()
+    assert geometry['lhcb1'] is tables
+
+    # Read-only commands do not invalidate the snapshot
+    mad.use(sequence='lhcb2')
+    mad.twiss()
+    mad.input('select, flag=twiss, column=name, s;')
+    assert geometry['lhcb1'] is tables
+
+def test_invalidated_by_inputs(mad):
+    geometry = GeometrySnapshot(mad)
+    tables = geometry['lhcb1']
+
+    mad.globals['kqf'] = 0.011
+    new_tables = geometry['lhcb1']
+    assert new_tables is not tables
+    assert new_tables.table.twiss.betx[0] != tables.table.twiss.betx[0]
+
+    mad.input('seqedit, sequence=lhcb1; flatten; endedit;')
+    assert geometry['lhcb1'] is not new_tables
+
+def test_explicit_invalidate(mad):
+    geometry = GeometrySnapshot(mad)
+    tables = geometry['lhcb1']
+    geometry.invalidate()
+    assert geometry['lhcb1'] is not tables
@@ -0,0 +1,61 @@
+from pymask.madxp import knob_df
+
+
+def _count_element_reads(mad, monkeypatch):
+    counter = {'n': 0}
+    get_element = mad._libmadx.get_element
+    def counting_get_element(*args, **kwargs):
+        counter['n'] += 1
+        return get_element(*args, **kwargs)
+    monkeypatch.setattr(mad._libmadx, 'get_element', counting_get_element)
+    return counter
+
+def test_elements_of_knobs(two_beam_mad):
+    mad = two_beam_mad
+    index = mad.get_knob_index(['lhcb1', 'lhcb2'])
+    assert index.get_elements('kqf', 'lhcb1') == ['qf.b1']
+    assert index.get_elements('kqd') == {'lhcb1': ['qd.b1'],
+                                         'lhcb2': ['qd.b2']}
+    assert index.get_elements('not_a_knob') == {}
+
+    # Same content as the sequence DF
+    seq_df = mad.get_sequence_df('lhcb1')
+    for kk in ['kqf', 'kqd']:
+        assert (list(knob_df(kk, seq_df, knob_index=index, seq_name='lhcb1')
+                     .index) == list(knob_df(kk, seq_df).index))
+
+def test_element_index_cache(two_beam_mad, monkeypatch):
+    mad = two_beam_mad
+    mad.get_knob_index(['lhcb1'])
+    counter = _count_element_reads(mad, monkeypatch)
+
+    # New knob values and read-only commands keep the index
+    mad.input('kqf = 0.011; twiss, sequence=lhcb1;')
+    mad.globals['kqd'] = -0.011
+    index = mad.get_knob_index(['lhcb1'])
+    assert counter['n'] == 0
+    assert index.get_elements('kqf', 'lhcb1') == ['qf.b1']
+
+    # New expressions change the knobs, the elements are not read again
+    mad.input('kmain = 0.01; kqf := 2*kmain;')
+    index = mad.get_knob_index(['lhcb1'])
+    assert counter['n'] == 0
+    assert index.get_elements('kmain', 'lhcb1') == ['qf.b1']
+    assert index.get_elements('kqf', 'lhcb1') == []
+
+    # Element edits invalidate the index
+    mad.input('qf.b1, k1 := kqd;')
+    index = mad.get_knob_index(['lhcb1'])
+    assert counter['n'] > 0
+    assert index.get_elements('kqd', 'lhcb1') == ['qf.b1', 'qd.b1']
+
+def test_knob_df_with_index(two_beam_mad):
+    mad = two_beam_mad
+    mad.input('kmain = 0.01; kqf := 2*kmain; kqd := -kqf + on_x;')
+    dependent_df = mad.get_variables_dataframes()['dependent_variables']
+    index = mad.get_knob_index()
+    for kk in ['kmain', 'on_x', 'kqf', 'not_a_knob']:
+        fast_df = knob_df(kk, dependent_df, knob_index=index)
+        assert list(fast_df.index) == list(knob_df(kk, dependent_df).index)
+    assert list(knob_df('kmain', dependent_df, knob_index=index).index) \
+        == ['kqd', 'kqf']
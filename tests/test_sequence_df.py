@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+
+def _small_sequence(mad):
+    mad.input('''
+    kmq = 0.02;
+    mq: multipole, knl:={0, kmq};
+    hk: hkicker, kick:=2*kqd;
+    seq: sequence, l=10, refer=centre;
+    qf.s: qf, at=2;
+    mq.s: mq, at=4;
+    hk.s: hk, at=6;
+    qd.s: qd, at=8;
+    endsequence;
+    beam, sequence=seq, particle=proton, energy=7000;
+    use, sequence=seq;
+    ''')
+    return 'seq'
+
+def _same_values(columnar, values):
+    for cc, vv in zip(columnar, values):
+        if np.ndim(cc) == 0 and pd.isna(cc):
+            assert np.ndim(vv) == 0 and pd.isna(vv)
+        else:
+            assert np.array_equal(np.asarray(cc), np.asarray(vv))
+
+def _assert_same_as_sequence_df(columnar, full):
+    assert list(columnar.index) == list(full.index)
+    for cc in ['position', 'parent', 'base_type', 'length']:
+        assert list(columnar[cc]) == list(full[cc])
+    for cc in full.columns:
+        if cc.endswith(' value') and cc[:-len(' value')] in columnar.columns:
+            attr = cc[:-len(' value')]
+            # Fields of the nodes (e.g. chkick) for the elements without the
+            # attribute, NaN for the others
+            _same_values(columnar[attr],
+                         full[cc].where(full[cc].notna(), full[attr]))
+            # The expressions of the deferred attributes
+            if attr+' expr' in columnar.columns:
+                has_expr = columnar[attr+' expr'].notna()
+                assert (list(columnar.loc[has_expr, attr+' expr'])
+                        == list(full.loc[has_expr, attr]))
+
+def test_columnar_same_as_sequence_df(two_beam_mad):
+    mad = two_beam_mad
+    seq = _small_sequence(mad)
+    full = mad.get_sequence_df(seq)
+    columnar = mad.get_sequence_df(seq, columnar=True)
+
+    assert columnar['k1 expr'].dropna().to_dict() == {'qf.s': 'kqf',
+                                                       'qd.s': 'kqd'}
+    assert columnar.loc['hk.s', 'kick expr'] == '2 * kqd'
+    assert columnar['knl expr'].notna().sum() == 1
+    assert columnar.columns.is_unique
+    _assert_same_as_sequence_df(columnar, full)
+
+    selected = mad.get_sequence_df(seq, columnar=True, columns=['k1', 'knl'])
+    assert set(selected.columns) - set(columnar.columns) == set()
+    assert {'k1', 'k1 expr', 'knl'} <= set(selected.columns)
+    assert 'kick' not in selected.columns
+    _assert_same_as_sequence_df(selected, full)
+
+def test_save_sequence_df(two_beam_mad, tmp_path):
+    mad = two_beam_mad
+    seq = _small_sequence(mad)
+    mad.save_sequence_df(seq, tmp_path / 'seq.parquet')
+
+    # Names and expressions dictionary-encoded
+    schema = pq.read_schema(tmp_path / 'seq.parquet')
+    for cc in ['name', 'parent', 'base_type', 'k1 expr', 'kick expr']:
+        assert str(schema.field(cc).type).startswith('dictionary'), cc
+
+    loaded = pd.read_parquet(tmp_path / 'seq.parquet')
+    for cc in ['name', 'k1 expr']:
+        assert isinstance(loaded[cc].dtype, pd.CategoricalDtype)
+    loaded = loaded.set_index('name')
+    loaded.index = loaded.index.astype(str)
+    loaded.index.name = ''
+    _assert_same_as_sequence_df(
+            loaded.astype({cc: object for cc in loaded.columns
+                           if isinstance(loaded[cc].dtype,
+                                         pd.CategoricalDtype)}),
+            mad.get_sequence_df(seq))
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.mark.parametrize('rows', [
+    None, '^q', slice(1, 5), slice(None, None, 3), range(2, 6), [8, 0, 3],
+    np.array([True, False] * 6 + [True])])
+def test_selection_same_as_full_df(crossing_mad, rows):
+    mad = crossing_mad
+    full = mad.get_twiss_df('twiss')
+    if rows is None:
+        expected = full
+    elif isinstance(rows, str):
+        expected = full[full['name'].str.contains(rows)]
+    else:
+        expected = full.iloc[rows]
+
+    columns = ['s', 'keyword', 'betx', 'x', 'sig11']
+    selected = mad.get_twiss_df('twiss', columns=columns, rows=rows)
+    pd.testing.assert_frame_equal(selected, expected[['name'] + columns])
+
+    lazy = mad.get_twiss_df('twiss', rows=rows, lazy=True)
+    assert len(lazy) == len(expected)
+    assert list(lazy.columns) == list(full.columns)
+    pd.testing.assert_index_equal(lazy.index, expected.index)
+    pd.testing.assert_frame_equal(lazy.to_df(), expected)
+    pd.testing.assert_frame_equal(lazy[columns], expected[columns])
+    pd.testing.assert_series_equal(lazy['betx'], expected['betx'])
+    pd.testing.assert_series_equal(lazy.BETX, expected['betx'],
+                                   check_names=False)
+
+def test_lazy_table_loc(crossing_mad):
+    mad = crossing_mad
+    full = mad.get_twiss_df('twiss')
+    lazy = mad.get_twiss_df('twiss', rows='^(?:q|ip)', lazy=True)
+
+    for name in lazy.index:
+        assert lazy.loc[name, 'betx'] == full.loc[name, 'betx']
+        row = lazy.loc[name]
+        for cc in ['name', 'keyword', 's', 'x', 'sig33']:
+            assert row[cc] == full.loc[name, cc]
+    pd.testing.assert_frame_equal(lazy.loc[['ip1:1', 'qd.b2:1'], ['s', 'x']],
+                                  full.loc[['ip1:1', 'qd.b2:1'], ['s', 'x']])
+    with pytest.raises(KeyError):
+        lazy.loc['mcb.b2:1', 'betx']
+    with pytest.raises(KeyError):
+        lazy['not_a_column']
+    assert not hasattr(lazy, 'not_a_column')
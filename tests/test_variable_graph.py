@@ -0,0 +1,39 @@
+from pymask.madxp import Madxp, VariableGraph, knob_df
+
+
+def test_knob_closure_deep_chain():
+    # d -> c -> b -> a -> k, plus a knob at each level and a constant
+    expressions = {'k': 0., 'on_x': 0., 'on_sep': 0., 'on_a': 0., 'cc': 2.,
+                   'a': 'k * cc + on_a', 'b': 'a + 1', 'c': 'b * 3 + on_sep',
+                   'd': 'c + on_x'}
+    values = {nn: 0. for nn in expressions}
+    var_types = {nn: 1 for nn in expressions}
+    var_types['cc'] = 0
+    graph = VariableGraph(expressions, values, var_types)
+
+    assert graph.knobs['a'] == {'k', 'on_a'}
+    assert graph.knobs['b'] == {'k', 'on_a'}
+    assert graph.knobs['c'] == {'k', 'on_a', 'on_sep'}
+    # Four levels down to k, only independent variables as knobs
+    assert graph.knobs['d'] == {'k', 'on_a', 'on_sep', 'on_x'}
+
+    assert graph.knob_variables['k'] == {'a', 'b', 'c', 'd'}
+    assert graph.knob_variables['on_x'] == {'d'}
+    assert 'cc' not in graph.knob_variables
+    assert graph.order.index('a') < graph.order.index('b') \
+        < graph.order.index('c') < graph.order.index('d')
+
+def test_knob_df_deep_chain():
+    mad = Madxp(stdout=False)
+    mad.input('''
+    k = 1; on_x = 0; const cc = 2;
+    a := k * cc; b := a + 1; c := b * 3; d := c + on_x;
+    ''')
+    dependent_df = mad.get_variables_dataframes()['dependent_variables']
+
+    assert dependent_df.loc['d', 'knobs'] == ['k', 'on_x']
+    assert list(knob_df('k', dependent_df).index) == ['a', 'b', 'c', 'd']
+    assert list(knob_df('on_x', dependent_df).index) == ['d']
+    # Intermediate variables are not knobs
+    assert len(knob_df('b', dependent_df)) == 0
+    mad.quit()
@@ -0,0 +1,74 @@
+from pymask.madxp import Madxp, diff_variable_snapshots
+
+
+def _mad():
+    mad = Madxp(stdout=False)
+    mad.input('''
+    on_x1 = 1; kmain = 0.1; const cc = 2;
+    a := kmain * cc; b := a + on_x1; c := b * 3;
+    other := kmain;
+    ''')
+    return mad
+
+def test_knob_through_input_marks_dependents():
+    mad = _mad()
+    graph = mad.get_variable_graph()
+    assert mad._dirty_variables == set()
+
+    mad.input('on_x1 = 2;')
+    assert mad._dirty_variables == {'on_x1'}
+    mad.globals['kmain'] = 0.2
+    assert mad._dirty_variables == {'on_x1', 'kmain'}
+    # Read-only commands do not mark anything
+    mad.input('show, on_x1; value, c;')
+    assert mad._dirty_variables == {'on_x1', 'kmain'}
+
+    refreshed = mad.get_variable_graph()
+    assert mad._dirty_variables == set()
+    for nn in ['on_x1', 'kmain', 'a', 'b', 'c', 'other']:
+        assert refreshed.values[nn] == mad.globals[nn]
+    assert refreshed.values['c'] == (0.2 * 2 + 2) * 3
+    # Values unchanged, same structure (knobs shared)
+    assert refreshed.knobs is graph.knobs
+    assert graph.values['c'] == (0.1 * 2 + 1) * 3
+
+def test_diff_reports_changed_rows():
+    mad = _mad()
+    before = mad.get_variable_graph()
+    mad.input('on_x1 = 2; b := a - on_x1; new_knob = 1;')
+    after = mad.get_variable_graph()
+
+    # New expression, parameters and knobs updated
+    assert after.parameters['b'] == ['a', 'on_x1']
+    mad.input('c := b * new_knob;')
+    after = mad.get_variable_graph()
+    assert after.knobs['c'] == {'kmain', 'new_knob', 'on_x1'}
+    assert after.knob_variables['new_knob'] == {'c'}
+
+    diff = diff_variable_snapshots(before, after)
+    # kmain, a, other and cc are unchanged
+    assert list(diff.index) == ['b', 'c', 'new_knob', 'on_x1']
+    assert diff.loc['on_x1', 'value_a'] == 1
+    assert diff.loc['on_x1', 'value_b'] == 2
+    assert diff.loc['on_x1', 'knob']
+    assert diff.loc['b', 'expression_a'] == str(before.expressions['b'])
+    assert diff.loc['b', 'expression_b'] == str(mad._libmadx.get_var('b'))
+    assert diff.loc['b', 'expression_a'] != diff.loc['b', 'expression_b']
+    assert not diff.loc['b', 'knob']
+    assert diff.loc['c', 'value_b'] == mad.globals['c']
+    assert diff.loc['new_knob', 'value_a'] is None
+    assert diff.loc['new_knob', 'knob']
+
+    assert len(diff_variable_snapshots(after, after)) == 0
+
+def test_other_statements_force_full_reload():
+    mad = _mad()
+    mad.get_variable_graph()
+    mad.input('exec_me: macro = {kmain = 0.3;}; exec, exec_me;')
+    assert mad._dirty_variables is None
+    assert mad.get_variable_graph().values['a'] == 0.3 * 2
+
+    # Writes bypassing input
+    mad._libmadx.input('kmain = 0.4;')
+    mad.invalidate_variables()
+    assert mad.get_variable_graph().values['a'] == 0.4 * 2